@@ -1,12 +1,14 @@
+import asyncio
 import bson
 import time
 import json
 import functools
 from typing import Callable, Optional, Union, Tuple
 
-from channels.generic.websocket import JsonWebsocketConsumer, WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, AsyncWebsocketConsumer
 from django.conf import settings
-from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
 import logging
 from sentry_sdk import capture_exception, capture_message
 from django.core.exceptions import ObjectDoesNotExist
@@ -14,6 +16,7 @@ from django.utils.timezone import now
 import newrelic.agent
 from channels_presence.models import Room
 from channels_presence.models import Presence
+from rest_framework.renderers import JSONRenderer
 
 from lib import cache
 from lib import channels
@@ -27,6 +30,11 @@ from .serializers import PublicPrinterSerializer, PrinterSerializer
 LOGGER = logging.getLogger(__name__)
 TOUCH_MIN_SECS = 30
 STATUS_UPDATE_MIN_SECS = 45
+TUNNEL_USAGE_SYNC_SECS = 5
+
+# The consumers are async, so that a worker holds many agent and tunnel connections on its event loop. Relayed
+# messages never leave the loop. What needs the database, or else blocks, runs on a thread through
+# database_sync_to_async or sync_to_async.
 
 
 def report_error(
@@ -37,7 +45,7 @@ def report_error(
     sentry: bool = True,
     close: bool = False,
 ) -> Callable:
-    """Decorator for consumer message handlers. May close connections on error and reports causes to sentry."""
+    """Decorator for consumer message handlers, sync or async. May close connections on error and reports causes to sentry."""
 
     # @decorator vs @partial_decorator
     # When decorator is a partial function, we need to handle it differently, as fn comes as an argument.
@@ -45,17 +53,33 @@ def report_error(
         return report_error(None, exc_class=exc_class, msg=msg, sentry=sentry, close=close)(fn)
 
     klass = Exception if exc_class is None else exc_class
+
+    def report(fn, exc):
+        import traceback
+        traceback.print_exc()
+        LOGGER.exception(msg or f'{exc.__class__.__name__} in {fn.__module__}.{fn.__qualname__}')
+        if sentry:
+            capture_exception()
+
     def outer(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_inner(self, *args, **kwargs):
+                try:
+                    return await fn(self, *args, **kwargs)
+                except klass as exc:
+                    report(fn, exc)
+                    if close:
+                        await self.close()
+                    return
+            return async_inner
+
         @functools.wraps(fn)
         def inner(self, *args, **kwargs):
             try:
                 return fn(self, *args, **kwargs)
             except klass as exc:
-                import traceback
-                traceback.print_exc()
-                LOGGER.exception(msg or f'{exc.__class__.__name__} in {fn.__module__}.{fn.__qualname__}')
-                if sentry:
-                    capture_exception()
+                report(fn, exc)
                 if close:
                     self.close()
                 return
@@ -67,7 +91,7 @@ close_on_error = functools.partial(report_error, close=True)
 close_on_error.__doc__ = """Reports error and closes consumer connection when specified exception raised"""
 
 
-class WebConsumer(JsonWebsocketConsumer):
+class WebConsumer(AsyncJsonWebsocketConsumer):
 
     def get_printer(self):
         """
@@ -89,71 +113,83 @@ class WebConsumer(JsonWebsocketConsumer):
             id=self.scope['url_route']['kwargs']['printer_id']
         )
 
+    def join_room(self):
+        Room.objects.add(
+            channels.web_group_name(self.printer.id),
+            self.channel_name
+        )
+        touch_user_last_active(self.printer.user)
+
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def connect(self):
+    async def connect(self):
         self.printer = None
-        self.printer = self.get_printer()
+        self.printer = await database_sync_to_async(self.get_printer)()
 
-        self.accept()
+        await self.accept()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.web_group_name(self.printer.id),
             self.channel_name
         )
         self.last_touch = time.time()
-        self.printer_status_last_sent = 0
 
-        Room.objects.add(
-            channels.web_group_name(self.printer.id),
-            self.channel_name
-        )
+        await database_sync_to_async(self.join_room)()
 
         # Send printer status to web frontend as soon as it connects
-        self.printer_status(None)
-
-        touch_user_last_active(self.printer.user)
+        await self.printer_status(None)
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn(
             "WebConsumer: Closed websocket with code: {}".format(close_code))
         if self.printer:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 channels.web_group_name(self.printer.id),
                 self.channel_name
             )
-            Room.objects.remove(
+            await database_sync_to_async(Room.objects.remove)(
                 channels.web_group_name(self.printer.id),
                 self.channel_name
             )
 
+    def request_status(self):
+        # Limited by connection, so that a page that just opened isn't left waiting on the requests of the others
+        if cache.rate_limit_pass(cache.printer_key_prefix(self.printer.id) + 'status_req.' + self.channel_name, STATUS_UPDATE_MIN_SECS):
+            channels.send_status_to_web(self.printer.id)
+
     @newrelic.agent.background_task()
     @report_error
-    def receive_json(self, data, **kwargs):
+    async def receive_json(self, data, **kwargs):
         if time.time() - self.last_touch > TOUCH_MIN_SECS:
             self.last_touch = time.time()
-            Presence.objects.touch(self.channel_name)
+            await database_sync_to_async(Presence.objects.touch)(self.channel_name)
 
-        if not data and time.time() - self.printer_status_last_sent > STATUS_UPDATE_MIN_SECS:
+        if not data:
             # Empty message from client is a signal for getting status to trigger a re-render in the client
-            channels.send_status_to_web(self.printer.id)
+            await database_sync_to_async(self.request_status)()
 
         if 'passthru' in data:
-            channels.send_msg_to_printer(self.printer.id, data)
+            await channels.async_send_msg_to_printer(self.printer.id, data)
+
+    def serialize_status(self):
+        printer = Printer.with_archived.select_related('current_print', 'printerprediction').get(id=self.printer.id)
+        Printer.prime_cache([printer])
+        return JSONRenderer().render(PrinterSerializer(printer).data).decode()
 
     @newrelic.agent.background_task()
     @close_on_error
-    def printer_status(self, data):
-        serializer = PrinterSerializer(
-            Printer.with_archived.get(id=self.printer.id))
-        self.send_json(serializer.data)
-        self.printer_status_last_sent = time.time()
+    async def printer_status(self, data):
+        if data and 'printer' in data:  # Serialized once for all the consumers of the printer
+            await self.send(text_data=data['printer'])
+            return
+
+        await self.send(text_data=await database_sync_to_async(self.serialize_status)())
 
     @newrelic.agent.background_task()
     @report_error
-    def web_message(self, msg):
-        self.send_json(msg)
+    async def web_message(self, msg):
+        await self.send_json(msg)
 
 
 class SharedWebConsumer(WebConsumer):
@@ -163,31 +199,52 @@ class SharedWebConsumer(WebConsumer):
             share_token=self.scope['url_route']['kwargs']['share_token']
         ).printer
 
+    def join_room(self):
+        super().join_room()
+        Room.objects.add(
+            channels.shared_web_group_name(self.printer.id),
+            self.channel_name
+        )
+
+    async def disconnect(self, close_code):
+        await super().disconnect(close_code)
+        if self.printer:
+            await database_sync_to_async(Room.objects.remove)(
+                channels.shared_web_group_name(self.printer.id),
+                self.channel_name
+            )
+
     @newrelic.agent.background_task()
     @report_error
-    def receive_json(self, data, **kwargs):
+    async def receive_json(self, data, **kwargs):
         # we don't expect frontend sending anything important,
         # this conn is only for status updates from server
         if time.time() - self.last_touch > TOUCH_MIN_SECS:
             self.last_touch = time.time()
-            Presence.objects.touch(self.channel_name)
+            await database_sync_to_async(Presence.objects.touch)(self.channel_name)
+
+    def serialize_status(self):
+        printer = Printer.with_archived.get(id=self.printer.id)
+        Printer.prime_cache([printer])
+        return JSONRenderer().render(PublicPrinterSerializer(printer).data).decode()
 
     @newrelic.agent.background_task()
     @close_on_error
-    def printer_status(self, data):
-        serializer = PublicPrinterSerializer(
-            Printer.with_archived.get(id=self.printer.id)
-        )
-        self.send_json(serializer.data)
+    async def printer_status(self, data):
+        if data and 'public_printer' in data:  # Left out when the push didn't know about this consumer yet
+            await self.send(text_data=data['public_printer'])
+            return
+
+        await self.send(text_data=await database_sync_to_async(self.serialize_status)())
 
     @newrelic.agent.background_task()
     @report_error
-    def web_message(self, msg):
+    async def web_message(self, msg):
         # frontend (should be) interested only in printer_status messages
         pass
 
 
-class OctoPrintConsumer(WebsocketConsumer):
+class OctoPrintConsumer(AsyncWebsocketConsumer):
 
     def get_printer(self):
         headers = dict(self.scope['headers'])
@@ -201,37 +258,42 @@ class OctoPrintConsumer(WebsocketConsumer):
 
         raise Exception('missing auth header')
 
+    def join_room(self):
+        """Returns the remote status to send to OctoPrint as soon as it connects"""
+        Room.objects.add(
+            channels.octo_group_name(self.printer.id),
+            self.channel_name
+        )
+        touch_user_last_active(self.printer.user)
+
+        return {
+            'viewing': channels.num_ws_connections(
+                channels.web_group_name(self.printer.id)) > 0,
+            'should_watch': self.printer.should_watch(),
+        }
+
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def connect(self):
+    async def connect(self):
         self.connected_at = time.time()
         self.printer = None
 
-        self.printer = self.get_printer()
+        self.printer = await database_sync_to_async(self.get_printer)()
 
-        self.accept()
+        await self.accept()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.octo_group_name(self.printer.id),
             self.channel_name
         )
 
         self.last_touch = self.connected_at
 
-        Room.objects.add(
-            channels.octo_group_name(self.printer.id),
-            self.channel_name
-        )
-
-        # Send remote status to OctoPrint as soon as it connects
-        self.printer_message({'remote_status': {
-            'viewing': channels.num_ws_connections(
-                channels.web_group_name(self.printer.id)) > 0,
-            'should_watch': self.printer.should_watch(),
-        }})
+        remote_status = await database_sync_to_async(self.join_room)()
+        await self.printer_message({'remote_status': remote_status})
 
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             channels.octo_group_name(self.printer.id),
             {
                 'type': 'close.duplicates',
@@ -240,35 +302,37 @@ class OctoPrintConsumer(WebsocketConsumer):
             }
         )
 
-        touch_user_last_active(self.printer.user)
-
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn(
             "OctoPrintConsumer: Closed websocket with code: {}".format(close_code))
         if self.printer:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 channels.octo_group_name(self.printer.id),
                 self.channel_name
             )
 
-            Room.objects.remove(
+            await database_sync_to_async(Room.objects.remove)(
                 channels.octo_group_name(self.printer.id),
                 self.channel_name
             )
 
             # disconnect all octoprint tunnels
-            channels.send_message_to_octoprinttunnel(
+            await channels.async_send_message_to_octoprinttunnel(
                 channels.octoprinttunnel_group_name(self.printer.id),
                 {'type': 'octoprint_close', 'ref': 'ALL'},
             )
 
+    def process_status(self, data):
+        self.printer.refresh_from_db()
+        process_octoprint_status(self.printer, data)
+
     @newrelic.agent.background_task()
     @report_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def receive(self, text_data=None, bytes_data=None, **kwargs):
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
         if time.time() - self.last_touch > TOUCH_MIN_SECS:
             self.last_touch = time.time()
-            Presence.objects.touch(self.channel_name)
+            await database_sync_to_async(Presence.objects.touch)(self.channel_name)
 
         if text_data:
             data = json.loads(text_data)
@@ -276,44 +340,43 @@ class OctoPrintConsumer(WebsocketConsumer):
             data = bson.loads(bytes_data)
 
         if 'janus' in data:
-            channels.send_janus_to_web(
+            await channels.async_send_janus_to_web(
                 self.printer.id, data.get('janus'))
         elif 'http.tunnelv2' in data:
-            cache.octoprinttunnel_http_response_set(
+            await sync_to_async(cache.octoprinttunnel_http_response_set, thread_sensitive=False)(
                 data['http.tunnelv2']['ref'],
                 data['http.tunnelv2']
             )
         elif 'ws.tunnel' in data:
-            channels.send_message_to_octoprinttunnel(
+            await channels.async_send_message_to_octoprinttunnel(
                 channels.octoprinttunnel_group_name(self.printer.id),
                 data['ws.tunnel'],
             )
         elif 'passthru' in data:
-            channels.send_message_to_web(self.printer.id, data)
+            await channels.async_send_message_to_web(self.printer.id, data)
         else:
-            self.printer.refresh_from_db()
-            process_octoprint_status(self.printer, data)
+            await database_sync_to_async(self.process_status)(data)
 
     @newrelic.agent.background_task()
     @report_error
-    def printer_message(self, data):
+    async def printer_message(self, data):
         as_binary = data.get('as_binary', False)
         if as_binary:
-            self.send(text_data=None, bytes_data=bson.dumps(data))
+            await self.send(text_data=None, bytes_data=bson.dumps(data))
         else:
-            self.send(text_data=json.dumps(data))
+            await self.send(text_data=json.dumps(data))
 
     @newrelic.agent.background_task()
     @report_error
-    def close_duplicates(self, data):
+    async def close_duplicates(self, data):
         channel_name = data['channel_name']
         connected_at = data['connected_at']
         if self.channel_name != channel_name and self.connected_at <= connected_at:
             LOGGER.warning(f'closing possibly duplicate connection from printer pk:{self.printer.id}')
-            self.close(code=4321)
+            await self.close(code=4321)
 
 
-class JanusWebConsumer(WebsocketConsumer):
+class JanusWebConsumer(AsyncWebsocketConsumer):
 
     def get_printer(self):
         if 'token' in self.scope['url_route']['kwargs']:
@@ -332,34 +395,34 @@ class JanusWebConsumer(WebsocketConsumer):
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=Printer.DoesNotExist, sentry=False) # Printer.DoesNotExist means auth failure and hence is expected
-    def connect(self):
+    async def connect(self):
         self.printer = None
-        self.printer = self.get_printer()
+        self.printer = await database_sync_to_async(self.get_printer)()
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             channels.janus_web_group_name(self.printer.id),
             self.channel_name
         )
 
-        self.accept('janus-protocol')
+        await self.accept('janus-protocol')
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn("JanusWebConsumer: Closed with code: {}".format(close_code))
         if self.printer:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 channels.janus_web_group_name(self.printer.id),
                 self.channel_name
             )
 
     @newrelic.agent.background_task()
     @report_error
-    def receive(self, text_data=None, bytes_data=None):
-        channels.send_msg_to_printer(self.printer.id, {'janus': text_data})
+    async def receive(self, text_data=None, bytes_data=None):
+        await channels.async_send_msg_to_printer(self.printer.id, {'janus': text_data})
 
     @newrelic.agent.background_task()
     @report_error
-    def janus_message(self, msg):
-        self.send(text_data=msg.get('msg'))
+    async def janus_message(self, msg):
+        await self.send(text_data=msg.get('msg'))
 
 
 class JanusSharedWebConsumer(JanusWebConsumer):
@@ -371,7 +434,7 @@ class JanusSharedWebConsumer(JanusWebConsumer):
 
     @newrelic.agent.background_task()
     @report_error
-    def receive(self, text_data=None, bytes_data=None):
+    async def receive(self, text_data=None, bytes_data=None):
         # we are going to disable datachannel for shared printer connections
         # by tampering janus offer/answer messages
 
@@ -389,11 +452,11 @@ class JanusSharedWebConsumer(JanusWebConsumer):
                 )
                 return
 
-        channels.send_msg_to_printer(self.printer.id, {'janus': text_data})
+        await channels.async_send_msg_to_printer(self.printer.id, {'janus': text_data})
 
     @newrelic.agent.background_task()
     @report_error
-    def janus_message(self, message):
+    async def janus_message(self, message):
         # we are going to disable datachannel for shared printer connections
         # by tampering janus offer/answer messages
 
@@ -430,10 +493,10 @@ class JanusSharedWebConsumer(JanusWebConsumer):
 
             msg['jsep']['sdp'] = sdp
 
-        self.send(text_data=json.dumps(msg))
+        await self.send(text_data=json.dumps(msg))
 
 
-class OctoprintTunnelWebConsumer(WebsocketConsumer):
+class OctoprintTunnelWebConsumer(AsyncWebsocketConsumer):
 
     # default 1000 does not trigger retries in octoprint webapp
     OCTO_WS_ERROR_CODE = 3000
@@ -447,28 +510,45 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
             )
         return (None, None)
 
+    def update_usage(self, usage):
+        if usage:
+            cache.octoprinttunnel_update_stats(self.printer.user_id, usage)
+        return self.printer.user.tunnel_usage_over_cap()
+
+    async def sync_usage(self):
+        """
+        Adds up the usage relayed since the last sync and checks the user's cap. Done every TUNNEL_USAGE_SYNC_SECS
+        rather than on every frame, so that relaying a frame doesn't wait on redis.
+        """
+        usage, self.unsynced_usage = self.unsynced_usage, 0
+        self.usage_synced_at = time.time()
+        self.over_cap = await sync_to_async(self.update_usage, thread_sensitive=False)(usage)
+
     @newrelic.agent.background_task()
     @close_on_error
     @close_on_error(exc_class=(Printer.DoesNotExist, TunnelAuthenticationError), sentry=False) # TunnelAuthenticationError: auth error, Printer.DoesNotExist: missing printer/not authorized
-    def connect(self):
+    async def connect(self):
         self.user, self.printer = None, None
         # Exception for un-authenticated or un-authorized access
-        self.user, self.printer = self.get_user_and_printer()
+        self.user, self.printer = await database_sync_to_async(self.get_user_and_printer)()
         if self.printer is None:
-            self.close()
+            await self.close()
             return
 
-        self.accept()
+        await self.accept()
 
         self.path = self.scope['path']
 
         self.ref = str(time.time())
 
-        async_to_sync(self.channel_layer.group_add)(
+        self.unsynced_usage = 0
+        await self.sync_usage()
+
+        await self.channel_layer.group_add(
             channels.octoprinttunnel_group_name(self.printer.id),
             self.channel_name,
         )
-        channels.send_msg_to_printer(
+        await channels.async_send_msg_to_printer(
             self.printer.id,
             {
                 'ws.tunnel': {
@@ -480,19 +560,19 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
                 'as_binary': True,
             })
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         LOGGER.warn(
             f'OctoprintTunnelWebConsumer: Closed websocket with code: {close_code}')
 
         if not self.printer:
             return
 
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             channels.octoprinttunnel_group_name(self.printer.id),
             self.channel_name,
         )
 
-        channels.send_msg_to_printer(
+        await channels.async_send_msg_to_printer(
             self.printer.id,
             {
                 'ws.tunnel': {
@@ -504,13 +584,18 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
                 'as_binary': True,
             })
 
+        await self.sync_usage()
+
     @newrelic.agent.background_task()
     @report_error
-    def receive(self, text_data=None, bytes_data=None, **kwargs):
-        if self.printer.user.tunnel_usage_over_cap():
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if time.time() - self.usage_synced_at > TUNNEL_USAGE_SYNC_SECS:
+            await self.sync_usage()
+
+        if self.over_cap:
             return
 
-        channels.send_msg_to_printer(
+        await channels.async_send_msg_to_printer(
             self.printer.id,
             {
                 'ws.tunnel': {
@@ -524,7 +609,7 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
 
     @newrelic.agent.background_task()
     @report_error
-    def octoprinttunnel_message(self, msg, **kwargs):
+    async def octoprinttunnel_message(self, msg, **kwargs):
         # msg == {'data': {'type': ..., 'data': ..., 'ref': ...}, ...}
         payload = msg['data']
 
@@ -532,12 +617,14 @@ class OctoprintTunnelWebConsumer(WebsocketConsumer):
             return
 
         if payload['type'] == 'octoprint_close':
-            self.close(self.OCTO_WS_ERROR_CODE)
+            await self.close(self.OCTO_WS_ERROR_CODE)
             return
 
         if isinstance(payload['data'], bytes):
-            self.send(bytes_data=payload['data'])
+            await self.send(bytes_data=payload['data'])
         else:
-            self.send(text_data=payload['data'])
+            await self.send(text_data=payload['data'])
 
-        cache.octoprinttunnel_update_stats(self.printer.user_id, len(payload['data']))
+        self.unsynced_usage += len(payload['data'])
+        if time.time() - self.usage_synced_at > TUNNEL_USAGE_SYNC_SECS:
+            await self.sync_usage()
@@ -12,7 +12,6 @@ from rest_framework.throttling import AnonRateThrottle
 from rest_framework import viewsets, mixins
 from rest_framework import status
 from django.conf import settings
-from django.core import serializers
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.exceptions import ImproperlyConfigured
 from django.http import Http404
@@ -22,6 +21,7 @@ import io
 import os
 import logging
 from ipware import get_client_ip
+import newrelic.agent
 from binascii import hexlify
 
 from .utils import report_validationerror
@@ -32,8 +32,9 @@ from .printer_discovery import (
 from .authentication import PrinterAuthentication
 from lib.file_storage import save_file_obj
 from lib import cache
-from lib.image import overlay_detections
-from lib.utils import ml_api_auth_headers
+from lib.image import overlay_detections, frame_fingerprint, frame_diff, detections_bounding_box, detections_to_boxes
+from lib import ml_api
+from lib import prediction_log
 from lib.utils import save_pic, get_rotated_pic_url
 from app.models import Printer, PrinterPrediction, OneTimeVerificationCode, PrinterEvent, GCodeFile
 from notifications.handlers import handler
@@ -100,63 +101,169 @@ class OctoPrintPicView(APIView):
         pic_path = f'raw/{printer.id}/{printer.current_print.id}/{pic_id}.jpg'
         internal_url, external_url = save_file_obj(pic_path, pic, settings.PICS_CONTAINER, long_term_storage=False)
 
-        img_url_updated = self.detect_if_needed(printer, pic, pic_id, internal_url)
+        if settings.TIMELAPSE_SEGMENT_FRAMES or settings.FRAME_ARCHIVE_FRAMES:
+            num_pics = cache.print_timelapse_pics_incr(printer.current_print.id)
+            if settings.TIMELAPSE_SEGMENT_FRAMES and num_pics % settings.TIMELAPSE_SEGMENT_FRAMES == 0:
+                celery_app.send_task('app.tasks.compile_timelapse_segments', args=(printer.current_print.id,))
+            if settings.FRAME_ARCHIVE_FRAMES and num_pics % settings.FRAME_ARCHIVE_FRAMES == 0:
+                celery_app.send_task('app.tasks.archive_print_frames', args=(printer.current_print.id,))
+
+        img_url_updated = self.detect_if_needed(printer, pic, pic_id, internal_url, external_url)
         if not img_url_updated:
             cache.printer_pic_set(printer.id, {'img_url': external_url}, ex=IMG_URL_TTL_SECONDS)
 
         send_status_to_web(printer.id)
         return Response({'result': 'ok'})
 
-    def detect_if_needed(self, printer, pic, pic_id, raw_pic_url):
+    def detect_if_needed(self, printer, pic, pic_id, raw_pic_url, raw_pic_external_url):
         '''
         Return:
-           True: Detection was performed. img_url was updated to the tagged image
-           False: No detection was performed. img_url was not updated
+           True: Detection was performed. img_url was updated to the tagged image, or to the pic along with its detection boxes
+           False: No detection was performed, or it was queued to run asynchronously. img_url was not updated
         '''
 
         if not printer.should_watch() or not printer.actively_printing():
             return False
 
+        if settings.ASYNC_DETECTION:
+            # prediction.updated_at is only updated after the queued detection is done. Hence the gate is kept in redis instead.
+            if not cache.printer_detection_gate_pass(printer.id, settings.MIN_DETECTION_INTERVAL):
+                return False
+
+            celery_app.send_task(
+                'app.tasks.detect_pic',
+                args=(printer.id, printer.current_print.id, pic_id, raw_pic_url, raw_pic_external_url),
+            )
+            return False
+
         prediction, _ = PrinterPrediction.objects.get_or_create(printer=printer)
 
         if time.time() - prediction.updated_at.timestamp() < settings.MIN_DETECTION_INTERVAL:
             return False
 
-        cache.print_num_predictions_incr(printer.current_print.id)
+        pic.file.seek(0)  # Reset file object pointer so that we can load it again
+        run_detection(printer, prediction, pic_id, pic.file.read(), raw_pic_url, raw_pic_external_url)
+        return True
 
-        req = requests.get(settings.ML_API_HOST + '/p/', params={'img': raw_pic_url}, headers=ml_api_auth_headers(), verify=False)
-        req.raise_for_status()
-        detections = req.json()['detections']
 
-        update_prediction_with_detections(prediction, detections)
-        prediction.save()
+def detection_roi(printer, prediction):
+    '''
+    The region of the pics ML API should detect in: the one set for the printer, or else the one learned from
+    its past detections, except for every DETECTION_ROI_FULL_FRAME_EVERY-th pic (never when it's 0). None means the full pic.
+    '''
+    if printer.detection_roi:
+        return printer.detection_roi_box
 
-        if prediction.current_p > settings.THRESHOLD_LOW * 0.2:  # Select predictions high enough for focused feedback
-            cache.print_high_prediction_add(printer.current_print.id, prediction.current_p, pic_id)
+    if not settings.DETECTION_ROI_MIN_SAMPLES:
+        return None
+    if settings.DETECTION_ROI_FULL_FRAME_EVERY and prediction.lifetime_frame_num % settings.DETECTION_ROI_FULL_FRAME_EVERY == 0:
+        return None
 
-        pic.file.seek(0)  # Reset file object pointer so that we can load it again
+    learned, samples = cache.printer_learned_roi_get(printer.id)
+    if samples < settings.DETECTION_ROI_MIN_SAMPLES:
+        return None
+
+    margin = settings.DETECTION_ROI_MARGIN
+    return (max(0.0, learned[0] - margin), max(0.0, learned[1] - margin), min(1.0, learned[2] + margin), min(1.0, learned[3] + margin))
+
+
+def detection_input_size(prediction):
+    # Far from failing. A lower resolution is good enough to tell whether that changes.
+    if settings.LOW_RISK_INPUT_SIZE and prediction.ewm_mean < settings.THRESHOLD_LOW * 0.2:
+        return settings.LOW_RISK_INPUT_SIZE
+    return None
+
+
+def detect_unless_unchanged(print_id, pic_bytes, raw_pic_url, roi=None, input_size=None):
+    '''
+    Returns the detections of the last pic sent to ML API if this pic looks the same, e.g. the webcam is stalled or
+    the scene is static. Otherwise sends this pic to ML API.
+    '''
+    if not settings.FRAME_DIFF_SKIP_THRESHOLD:
+        return ml_api.detect(raw_pic_url, pic_bytes, roi=roi, input_size=input_size)
+
+    fingerprint = frame_fingerprint(pic_bytes)
+    # Compared with the last pic that was sent to ML API rather than the last pic, so that slow changes add up
+    last_fingerprint, last_detections = cache.print_last_detected_frame_get(print_id)
+    if last_fingerprint is not None and frame_diff(fingerprint, last_fingerprint) <= settings.FRAME_DIFF_SKIP_THRESHOLD:
+        newrelic.agent.record_custom_metric('Custom/MLAPI/SkippedUnchangedFrame', 1)
+        return last_detections
+
+    detections = ml_api.detect(raw_pic_url, pic_bytes, roi=roi, input_size=input_size)
+    # Expires so that a pic is sent to ML API once in a while anyway
+    cache.print_last_detected_frame_set(print_id, fingerprint, detections, ex=settings.FRAME_DIFF_MAX_SKIP_SECONDS)
+    return detections
+
+
+def run_detection(printer, prediction, pic_id, pic_bytes, raw_pic_url, raw_pic_external_url=None):
+    cache.print_num_predictions_incr(printer.current_print.id)
+
+    roi = detection_roi(printer, prediction)
+    detections = detect_unless_unchanged(
+        printer.current_print.id, pic_bytes, raw_pic_url, roi=roi, input_size=detection_input_size(prediction))
+
+    pic = Image.open(io.BytesIO(pic_bytes))
+    if roi is None and settings.DETECTION_ROI_MIN_SAMPLES and not printer.detection_roi:
+        detections_to_learn = [d for d in detections if d[1] > VISUALIZATION_THRESH]
+        if detections_to_learn:
+            cache.printer_learned_roi_add(printer.id, detections_bounding_box(detections_to_learn, pic.size))
+
+    # The prediction is updated even if the detections are reused, so that it moves on in time as usual
+    update_prediction_with_detections(prediction, detections)
+    prediction.save()
+
+    if prediction.current_p > settings.THRESHOLD_LOW * 0.2:  # Select predictions high enough for focused feedback
+        cache.print_high_prediction_add(printer.current_print.id, prediction.current_p, pic_id)
+
+    detections_to_visualize = [d for d in detections if d[1] > VISUALIZATION_THRESH]
+
+    def save_tagged_pic():
         tagged_img = io.BytesIO()
-        detections_to_visualize = [d for d in detections if d[1] > VISUALIZATION_THRESH]
-        overlay_detections(Image.open(pic), detections_to_visualize).save(tagged_img, "JPEG")
+        overlay_detections(pic, detections_to_visualize).save(tagged_img, "JPEG")
         tagged_img.seek(0)
 
         pic_path = f'tagged/{printer.id}/{printer.current_print.id}/{pic_id}.jpg'
         _, external_url = save_file_obj(pic_path, tagged_img, settings.PICS_CONTAINER, long_term_storage=False)
+        return external_url
+
+    if settings.TAGGED_PICS_AS_BOXES and raw_pic_external_url:
+        # The pic is only decoded and tagged in case an alert needs it
+        boxes = json.dumps(detections_to_boxes(detections_to_visualize, pic.size))
+        save_file_obj(f'boxes/{printer.id}/{printer.current_print.id}/{pic_id}.json', io.BytesIO(boxes.encode('UTF-8')), settings.PICS_CONTAINER, long_term_storage=False)
+        cache.printer_pic_set(printer.id, {'img_url': raw_pic_external_url, 'boxes': boxes}, ex=IMG_URL_TTL_SECONDS)
+        external_url = None
+    else:
+        external_url = save_tagged_pic()
         cache.printer_pic_set(printer.id, {'img_url': external_url}, ex=IMG_URL_TTL_SECONDS)
 
-        prediction_json = serializers.serialize("json", [prediction, ])
-        p_out = io.BytesIO()
-        p_out.write(prediction_json.encode('UTF-8'))
-        p_out.seek(0)
-        save_file_obj(f'p/{printer.id}/{printer.current_print.id}/{pic_id}.json', p_out, settings.PICS_CONTAINER, long_term_storage=False)
+    append_prediction_row(printer, pic_id, prediction)
 
-        if is_failing(prediction, printer.detective_sensitivity, escalating_factor=settings.ESCALATING_FACTOR):
-            # The prediction is high enough to match the "escalated" level and hence print needs to be paused
-            pause_if_needed(printer, external_url)
-        elif is_failing(prediction, printer.detective_sensitivity, escalating_factor=1):
-            alert_if_needed(printer, external_url)
+    if is_failing(prediction, printer.detective_sensitivity, escalating_factor=settings.ESCALATING_FACTOR):
+        # The prediction is high enough to match the "escalated" level and hence print needs to be paused
+        pause_if_needed(printer, external_url or save_tagged_pic())
+    elif is_failing(prediction, printer.detective_sensitivity, escalating_factor=1):
+        alert_if_needed(printer, external_url or save_tagged_pic())
+
+
+def append_prediction_row(printer, pic_id, prediction):
+    """
+    Appends the prediction to the print's log in redis, and moves the rows there to storage every
+    PREDICTION_LOG_FLUSH_ROWS rows, so that redis only buffers the last few.
+    """
+    print_id = printer.current_print.id
+    log_length = cache.print_prediction_log_append(print_id, prediction_log.pack_row(float(pic_id), prediction))
+    if log_length < settings.PREDICTION_LOG_FLUSH_ROWS * prediction_log.ROW.size:
+        return
+
+    rows = cache.print_prediction_log_take(print_id)
+    if not rows:  # Taken by a concurrent detection
+        return
+    try:
+        save_file_obj(f'plog/{printer.id}/{print_id}/{pic_id}{prediction_log.ROWS_EXTENSION}', io.BytesIO(rows), settings.PICS_CONTAINER, long_term_storage=False)
+    except Exception:
+        LOGGER.exception(f'Failed to save the prediction log of print {print_id}. Keeping it in redis.')
+        cache.print_prediction_log_append(print_id, rows)
 
-        return True
 
 class OctoPrinterView(APIView):
     authentication_classes = (PrinterAuthentication,)
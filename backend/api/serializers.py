@@ -15,6 +15,7 @@ from app.models import (
 )
 
 from notifications.handlers import handler
+from lib.utils import parse_roi
 
 
 def int_with_default(v, default):
@@ -64,10 +65,17 @@ class BasePrinterSerializer(serializers.ModelSerializer):
                   'tools_off_on_pause', 'bed_off_on_pause', 'retract_on_pause',
                   'lift_z_on_pause', 'detective_sensitivity',
                   'min_timelapse_secs_on_finish', 'min_timelapse_secs_on_cancel',
-                  'auth_token', 'archived_at', 'agent_name', 'agent_version',)
+                  'auth_token', 'archived_at', 'agent_name', 'agent_version', 'detection_roi',)
 
         read_only_fields = ('created_at', 'not_watching_reason', 'auth_token', 'archived_at',)
 
+    def validate_detection_roi(self, detection_roi):
+        try:
+            parse_roi(detection_roi)
+        except ValueError:
+            raise serializers.ValidationError('Must be "x1,y1,x2,y2", in fractions of the webcam image width and height')
+        return detection_roi or None
+
 
 class BaseGCodeFileSerializer(serializers.ModelSerializer):
     class Meta:
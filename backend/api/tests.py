@@ -2,13 +2,22 @@ from django.test import TestCase, override_settings
 from unittest.mock import *
 from django.utils import timezone
 from datetime import timedelta
+from django.db import IntegrityError
+from django.utils.dateparse import parse_datetime
 from django.test import Client
 from django.urls import reverse
+from PIL import Image
+from asgiref.sync import async_to_sync
+import io
+import json
+import time
 from safedelete.models import *
 
-from app.models import Printer, Print, User
+from app.models import Printer, Print, User, PrintStatsDay
 from api.octoprint_views import *
 from api.octoprint_messages import process_octoprint_status
+from api.consumers import WebConsumer, OctoprintTunnelWebConsumer, TUNNEL_USAGE_SYNC_SECS
+from lib import cache
 
 
 def init_data():
@@ -384,3 +393,328 @@ class PrintTestCase(TestCase):
         process_octoprint_status(self.printer, status_msg_without_event(100, '1.gcode'))
         celery_app.send_task.assert_has_calls(EVENT_CALLS)
         self.assertEqual(celery_app.send_task.call_count, 1)
+
+
+def jpeg_bytes(color, blob_at=None):
+    img = Image.new('RGB', (640, 480), color)
+    if blob_at:
+        img.paste((255, 255, 255), (blob_at[0], blob_at[1], blob_at[0] + 30, blob_at[1] + 30))
+    out = io.BytesIO()
+    img.save(out, 'JPEG')
+    return out.getvalue()
+
+
+@override_settings(FRAME_DIFF_SKIP_THRESHOLD=4, FRAME_DIFF_MAX_SKIP_SECONDS=300)
+@patch('api.octoprint_views.cache')
+@patch('api.octoprint_views.ml_api')
+class DetectUnlessUnchangedTestCase(TestCase):
+
+    def test_first_frame_is_detected(self, ml_api, cache):
+        cache.print_last_detected_frame_get.return_value = (None, None)
+        ml_api.detect.return_value = [['failure', 0.5, [1, 2, 3, 4]]]
+
+        self.assertEqual(detect_unless_unchanged(1, jpeg_bytes((100, 100, 100)), 'url'), [['failure', 0.5, [1, 2, 3, 4]]])
+        ml_api.detect.assert_called_once()
+        cache.print_last_detected_frame_set.assert_called_once()
+
+    def test_unchanged_frame_reuses_detections(self, ml_api, cache):
+        cache.print_last_detected_frame_get.return_value = (frame_fingerprint(jpeg_bytes((100, 100, 100))), [['failure', 0.5, [1, 2, 3, 4]]])
+
+        self.assertEqual(detect_unless_unchanged(1, jpeg_bytes((101, 100, 100)), 'url'), [['failure', 0.5, [1, 2, 3, 4]]])
+        ml_api.detect.assert_not_called()
+        cache.print_last_detected_frame_set.assert_not_called()
+
+    def test_small_local_change_is_detected(self, ml_api, cache):
+        cache.print_last_detected_frame_get.return_value = (frame_fingerprint(jpeg_bytes((100, 100, 100))), [])
+        ml_api.detect.return_value = [['failure', 0.9, [315, 255, 30, 30]]]
+
+        self.assertEqual(detect_unless_unchanged(1, jpeg_bytes((100, 100, 100), blob_at=(300, 240)), 'url'), [['failure', 0.9, [315, 255, 30, 30]]])
+        ml_api.detect.assert_called_once()
+
+    @override_settings(FRAME_DIFF_SKIP_THRESHOLD=0)
+    def test_disabled(self, ml_api, cache):
+        ml_api.detect.return_value = []
+
+        detect_unless_unchanged(1, jpeg_bytes((100, 100, 100)), 'url')
+        ml_api.detect.assert_called_once()
+        cache.print_last_detected_frame_get.assert_not_called()
+
+
+@override_settings(DETECTION_ROI_MIN_SAMPLES=5, DETECTION_ROI_MARGIN=0.125, DETECTION_ROI_FULL_FRAME_EVERY=10)
+@patch('api.octoprint_views.cache')
+class DetectionRoiTestCase(TestCase):
+
+    def setUp(self):
+        (self.user, self.printer, self.client) = init_data()
+        self.prediction = PrinterPrediction(printer=self.printer, lifetime_frame_num=1)
+
+    def test_printer_roi_takes_precedence(self, cache):
+        self.printer.detection_roi = '0.1,0.2,0.6,0.9'
+
+        self.assertEqual(detection_roi(self.printer, self.prediction), (0.1, 0.2, 0.6, 0.9))
+        cache.printer_learned_roi_get.assert_not_called()
+
+    def test_learned_roi_is_expanded(self, cache):
+        cache.printer_learned_roi_get.return_value = ((0.25, 0.0625, 0.5, 0.5), 5)
+
+        self.assertEqual(detection_roi(self.printer, self.prediction), (0.125, 0.0, 0.625, 0.625))
+
+    def test_not_enough_samples(self, cache):
+        cache.printer_learned_roi_get.return_value = ((0.3, 0.3, 0.5, 0.5), 4)
+
+        self.assertIsNone(detection_roi(self.printer, self.prediction))
+
+    def test_full_frame_once_in_a_while(self, cache):
+        cache.printer_learned_roi_get.return_value = ((0.3, 0.3, 0.5, 0.5), 5)
+        self.prediction.lifetime_frame_num = 20
+
+        self.assertIsNone(detection_roi(self.printer, self.prediction))
+
+    @override_settings(DETECTION_ROI_FULL_FRAME_EVERY=0)
+    def test_never_full_frame(self, cache):
+        cache.printer_learned_roi_get.return_value = ((0.25, 0.0625, 0.5, 0.5), 5)
+        self.prediction.lifetime_frame_num = 20
+
+        self.assertEqual(detection_roi(self.printer, self.prediction), (0.125, 0.0, 0.625, 0.625))
+
+
+@override_settings(TAGGED_PICS_AS_BOXES=True, DETECTION_ROI_MIN_SAMPLES=0)
+@patch('api.octoprint_views.save_file_obj', return_value=('http://internal/tagged.jpg', 'http://external/tagged.jpg'))
+@patch('api.octoprint_views.detect_unless_unchanged')
+@patch('api.octoprint_views.cache')
+class TaggedPicsAsBoxesTestCase(TestCase):
+
+    def setUp(self):
+        (self.user, self.printer, self.client) = init_data()
+        self.prediction = PrinterPrediction.objects.create(printer=self.printer)
+        pic = io.BytesIO()
+        Image.new('RGB', (64, 48)).save(pic, 'JPEG')
+        self.pic_bytes = pic.getvalue()
+
+    def test_boxes_are_saved_instead_of_tagged_pic(self, cache, detect_unless_unchanged, save_file_obj):
+        detect_unless_unchanged.return_value = [('failure', 0.9, (10.0, 20.0, 8.0, 6.0)), ('failure', 0.1, (1.0, 1.0, 1.0, 1.0))]
+        cache.print_prediction_log_append.return_value = prediction_log.ROW.size
+
+        run_detection(self.printer, self.prediction, '1000.5', self.pic_bytes, 'http://internal/raw.jpg', 'http://external/raw.jpg')
+
+        boxes = json.dumps({'size': [64, 48], 'boxes': [[0.9, 10.0, 20.0, 8.0, 6.0]]})
+        cache.printer_pic_set.assert_called_once_with(self.printer.id, {'img_url': 'http://external/raw.jpg', 'boxes': boxes}, ex=IMG_URL_TTL_SECONDS)
+        pic_dir = f'{self.printer.id}/{self.printer.current_print.id}'
+        self.assertEqual([c[0][0] for c in save_file_obj.call_args_list], [f'boxes/{pic_dir}/1000.5.json'])
+
+    @patch('api.octoprint_views.alert_if_needed')
+    @patch('api.octoprint_views.is_failing', side_effect=[False, True])
+    def test_tagged_pic_is_drawn_for_alert(self, is_failing, alert_if_needed, cache, detect_unless_unchanged, save_file_obj):
+        detect_unless_unchanged.return_value = [('failure', 0.9, (10.0, 20.0, 8.0, 6.0))]
+        cache.print_prediction_log_append.return_value = prediction_log.ROW.size
+
+        run_detection(self.printer, self.prediction, '1000.5', self.pic_bytes, 'http://internal/raw.jpg', 'http://external/raw.jpg')
+
+        alert_if_needed.assert_called_once_with(self.printer, 'http://external/tagged.jpg')
+        self.assertIn(f'tagged/{self.printer.id}/{self.printer.current_print.id}/1000.5.jpg', [c[0][0] for c in save_file_obj.call_args_list])
+
+
+@override_settings(PREDICTION_LOG_FLUSH_ROWS=3)
+@patch('api.octoprint_views.save_file_obj')
+@patch('api.octoprint_views.cache')
+class AppendPredictionRowTestCase(TestCase):
+
+    def setUp(self):
+        (self.user, self.printer, self.client) = init_data()
+        self.prediction = PrinterPrediction(printer=self.printer, current_p=0.5)
+        self.rows = b''.join(prediction_log.pack_row(float(i), self.prediction) for i in range(3))
+
+    def test_rows_are_buffered_in_redis(self, cache, save_file_obj):
+        cache.print_prediction_log_append.return_value = 2 * prediction_log.ROW.size
+
+        append_prediction_row(self.printer, '1000.5', self.prediction)
+
+        cache.print_prediction_log_append.assert_called_once_with(self.printer.current_print.id, prediction_log.pack_row(1000.5, self.prediction))
+        cache.print_prediction_log_take.assert_not_called()
+        save_file_obj.assert_not_called()
+
+    def test_full_buffer_is_moved_to_storage(self, cache, save_file_obj):
+        cache.print_prediction_log_append.return_value = len(self.rows)
+        cache.print_prediction_log_take.return_value = self.rows
+
+        append_prediction_row(self.printer, '2.0', self.prediction)
+
+        (path, file_obj, _), _ = save_file_obj.call_args
+        self.assertEqual(path, f'plog/{self.printer.id}/{self.printer.current_print.id}/2.0.rows')
+        self.assertEqual(file_obj.getvalue(), self.rows)
+        self.assertEqual(cache.print_prediction_log_append.call_count, 1)
+
+    def test_rows_are_put_back_if_not_saved(self, cache, save_file_obj):
+        cache.print_prediction_log_append.return_value = len(self.rows)
+        cache.print_prediction_log_take.return_value = self.rows
+        save_file_obj.side_effect = IOError()
+
+        append_prediction_row(self.printer, '2.0', self.prediction)
+
+        cache.print_prediction_log_append.assert_called_with(self.printer.current_print.id, self.rows)
+
+
+class PrintKeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        (self.user, self.printer, self.client) = init_data()
+        for ext_id in range(2, 6):
+            Print.objects.create(user=self.user, printer=self.printer, filename=f'{ext_id}.gcode', started_at=timezone.now(), ext_id=ext_id)
+        self.print_ids = list(Print.objects.order_by('-id').values_list('id', flat=True))
+
+    def test_pages_follow_next_cursor(self):
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get('/api/v1/prints/', {'cursor': cursor, 'limit': 2}).json()
+            ids += [p['id'] for p in response['results']]
+            cursor = response['next_cursor']
+
+        self.assertEqual(ids, self.print_ids)
+
+        response = self.client.get('/api/v1/prints/', {'cursor': self.print_ids[-2], 'limit': 2, 'sorting': 'date_asc'}).json()
+        self.assertEqual([p['id'] for p in response['results']], [self.print_ids[-3], self.print_ids[-4]])
+        self.assertEqual(response['next_cursor'], str(self.print_ids[-4]))
+
+    def test_limit_must_be_positive(self):
+        for limit in (0, -1):
+            response = self.client.get('/api/v1/prints/', {'cursor': '', 'limit': limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('limit', response.json())
+
+    def test_start_is_still_supported(self):
+        response = self.client.get('/api/v1/prints/', {'start': 1, 'limit': 2}).json()
+        self.assertEqual([p['id'] for p in response], self.print_ids[1:3])
+
+
+class PrintStatsTestCase(TestCase):
+
+    def setUp(self):
+        (self.user, self.printer, self.client) = init_data()
+        self.printer.current_print = None
+        self.printer.save()
+        Print.objects.all().delete(force_policy=HARD_DELETE)
+        # 23:30 UTC on 2023-01-02 is already 2023-01-03 in Kolkata
+        for ext_id, started_at in enumerate(['2023-01-02T10:00:00Z', '2023-01-02T23:30:00Z', '2023-01-09T12:00:00Z']):
+            _print = Print.objects.create(user=self.user, printer=self.printer, filename=f'{ext_id}.gcode', started_at=parse_datetime(started_at), ext_id=ext_id)
+            _print.print_time = 100.0 * (ext_id + 1)
+            _print.finished_at = timezone.now()
+            _print.save()
+
+    def stats(self, tz, group_by):
+        return self.client.get('/api/v1/prints/stats/', {'timezone': tz, 'from_date': '2023-01-01', 'to_date': '2023-01-31', 'group_by': group_by}).json()
+
+    def rolled_up(self):
+        return sorted((d.date.isoformat(), d.print_count, d.total_print_time, [q[:2] for q in d.quarter_hours]) for d in PrintStatsDay.objects.all())
+
+    def test_prints_are_rolled_up(self):
+        _print = Print.objects.create(user=self.user, printer=self.printer, filename='3.gcode', started_at=parse_datetime('2023-01-02T23:44:59Z'), ext_id=3)
+        _print.print_time = 50.0
+        _print.finished_at = timezone.now()
+        _print.save()
+        self.assertEqual(self.rolled_up(), [('2023-01-02', 3, 350.0, [[40, 1], [94, 2]]), ('2023-01-09', 1, 300.0, [[48, 1]])])
+
+        Print.objects.get(ext_id=1).delete()
+        self.assertEqual(self.rolled_up(), [('2023-01-02', 2, 150.0, [[40, 1], [94, 1]]), ('2023-01-09', 1, 300.0, [[48, 1]])])
+
+        Print.objects.get(ext_id=2).delete()
+        self.assertEqual(self.rolled_up(), [('2023-01-02', 2, 150.0, [[40, 1], [94, 1]])])
+
+    def test_stats_are_grouped_in_the_timezone(self):
+        stats = self.stats('UTC', 'day')
+        self.assertEqual([g['value'] for g in stats['print_count_groups'] if g['value']], [2, 1])
+        self.assertEqual(stats['longest_print_time'], 300.0)
+
+        stats = self.stats('Asia/Kolkata', 'day')
+        self.assertEqual([(g['key'][:10], g['value']) for g in stats['print_count_groups'] if g['value']], [('2023-01-02', 1), ('2023-01-03', 1), ('2023-01-09', 1)])
+        self.assertEqual(stats['total_print_time'], 600.0)
+
+    def test_stats_are_read_from_the_rollup_in_any_timezone(self):
+        day = PrintStatsDay.objects.get(date='2023-01-02')
+        day.quarter_hours[1][1] = 5
+        day.save()
+
+        with patch('api.viewsets.Print.objects') as prints:
+            stats = self.stats('Asia/Kathmandu', 'day')
+        self.assertEqual(prints.method_calls, [])
+        self.assertEqual([(g['key'][:10], g['value']) for g in stats['print_count_groups'] if g['value']], [('2023-01-02', 1), ('2023-01-03', 5), ('2023-01-09', 1)])
+
+    @patch('app.models.PrintStatsDay.objects.update_or_create', side_effect=[IntegrityError(), (None, False)])
+    def test_refresh_is_retried_after_a_concurrent_one(self, update_or_create):
+        PrintStatsDay.refresh(self.user.id, self.printer.id, parse_datetime('2023-01-09T12:00:00Z'))
+
+        self.assertEqual(update_or_create.call_count, 2)
+
+
+class PrinterCacheSnapshotTestCase(TestCase):
+
+    def setUp(self):
+        (self.user, self.printer, self.client) = init_data()
+        self.other_printer = Printer.objects.create(user=self.user, name='other')
+        cache.printer_status_set(self.printer.id, json.dumps({'state': {'flags': {'printing': True}}}), ex=60)
+        cache.printer_status_set(self.other_printer.id, {'state': json.dumps({'flags': {'printing': False}})}, ex=60)
+        cache.printer_pic_set(self.printer.id, {'img_url': 'http://pic'}, ex=60)
+        cache.printer_settings_set(self.printer.id, {'webcam_flipV': 'True', 'webcam_rotation': '90'}, ex=60)
+
+    def tearDown(self):
+        for printer in (self.printer, self.other_printer):
+            cache.printer_status_delete(printer.id)
+            cache.REDIS.delete(cache.printer_key_prefix(printer.id) + 'pic', cache.printer_key_prefix(printer.id) + 'settings')
+
+    def test_primed_printers_read_the_same(self):
+        printers = list(Printer.objects.filter(id__in=[self.printer.id, self.other_printer.id]))
+        expected = [(p.status, p.pic, p.settings, p.actively_printing()) for p in printers]
+
+        with patch('lib.cache.REDIS.pipeline', wraps=cache.REDIS.pipeline) as pipeline:
+            Printer.prime_cache(printers)
+            self.assertEqual([(p.status, p.pic, p.settings, p.actively_printing()) for p in printers], expected)
+            self.assertEqual(pipeline.call_count, 1)
+
+
+@patch('api.consumers.channels')
+class StatusRequestTestCase(TestCase):
+
+    def consumer(self, printer, channel_name):
+        consumer = WebConsumer({'type': 'websocket'})
+        consumer.printer, consumer.channel_name = printer, channel_name
+        return consumer
+
+    @patch('lib.cache.rate_limit_pass')
+    def test_requests_are_limited_by_connection(self, rate_limit_pass, channels):
+        (_, printer, _) = init_data()
+        passed = set()
+        rate_limit_pass.side_effect = lambda key, interval_secs: key not in passed and not passed.add(key)
+
+        for channel_name in ('web.1', 'web.1', 'web.2'):
+            self.consumer(printer, channel_name).request_status()
+
+        self.assertEqual(channels.send_status_to_web.call_count, 2)
+
+
+class TunnelUsageTestCase(TestCase):
+
+    def tunnel_message(self, consumer, data):
+        async_to_sync(consumer.octoprinttunnel_message)({'data': {'ref': consumer.ref, 'type': 'tunnel_message', 'data': data}})
+
+    @patch('app.models.User.tunnel_usage_over_cap', return_value=False)
+    @patch('lib.cache.octoprinttunnel_update_stats')
+    def test_usage_is_synced_in_batches(self, update_stats, tunnel_usage_over_cap):
+        (user, printer, _) = init_data()
+        consumer = OctoprintTunnelWebConsumer({'type': 'websocket'})
+        consumer.printer, consumer.ref = printer, 'ref'
+        consumer.unsynced_usage, consumer.usage_synced_at, consumer.over_cap = 0, time.time(), False
+        sent = []
+
+        async def send(text_data=None, bytes_data=None):
+            sent.append(text_data or bytes_data)
+        consumer.send = send
+
+        for _ in range(3):
+            self.tunnel_message(consumer, 'abcd')
+        self.assertEqual(sent, ['abcd'] * 3)
+        update_stats.assert_not_called()
+
+        consumer.usage_synced_at -= TUNNEL_USAGE_SYNC_SECS + 1
+        self.tunnel_message(consumer, b'ef')
+        update_stats.assert_called_once_with(user.id, 14)
+        self.assertEqual(consumer.unsynced_usage, 0)
@@ -26,21 +26,22 @@ import pytz
 from datetime import timedelta, datetime
 from django.utils.dateparse import parse_datetime
 from django.db.models.functions import TruncDay
-from django.db.models import Sum, Max, Count, fields, Case, Value, When
 
 
 from .utils import report_validationerror
 from .authentication import CsrfExemptSessionAuthentication
 from app.models import (
     User, Print, Printer, GCodeFile, PrintShotFeedback, PrinterPrediction, MobileDevice, OneTimeVerificationCode,
-    SharedResource, OctoPrintTunnel, calc_normalized_p, NotificationSetting, PrinterEvent, GCodeFolder)
+    SharedResource, OctoPrintTunnel, calc_normalized_p, NotificationSetting, PrinterEvent, GCodeFolder, PrintStatsDay,
+    print_stats_aggregates)
 from .serializers import (
     UserSerializer, GCodeFileSerializer, GCodeFileDeSerializer, PrinterSerializer, PrintSerializer, MobileDeviceSerializer,
     PrintShotFeedbackSerializer, OneTimeVerificationCodeSerializer, SharedResourceSerializer, OctoPrintTunnelSerializer,
     NotificationSettingSerializer, PrinterEventSerializer, GCodeFolderDeSerializer, GCodeFolderSerializer
 )
 from lib.channels import send_status_to_web
-from lib import cache, gcode_metadata
+from lib import cache, gcode_metadata, prediction_log
+from lib.prediction_log import PredictionLog
 from lib.view_helpers import get_printer_or_404
 from config.celery import celery_app
 from lib.file_storage import save_file_obj, delete_file
@@ -61,6 +62,27 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
 
 
+def keyset_page(queryset, cursor, limit, descending=True):
+    """
+    The page of limit rows of the queryset, ordered by id, after the row whose id is cursor ('' for the first page),
+    and the cursor of the page after it, None if there is none. Only the rows of the page are read.
+    """
+    if limit < 1:
+        raise ValidationError({'limit': 'Ensure this value is greater than or equal to 1.'})
+
+    queryset = queryset.order_by('-id' if descending else 'id')
+    if cursor:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            raise ValidationError({'cursor': 'Invalid cursor'})
+        queryset = queryset.filter(id__lt=cursor) if descending else queryset.filter(id__gt=cursor)
+
+    results = list(queryset[:limit + 1])
+    next_cursor = str(results[limit - 1].id) if len(results) > limit else None
+    return results[:limit], next_cursor
+
+
 class UserViewSet(viewsets.GenericViewSet):
     permission_classes = (IsAuthenticated,)
     authentication_classes = (CsrfExemptSessionAuthentication,)
@@ -102,6 +124,18 @@ class PrinterViewSet(
 
         return qs.select_related('current_print', 'printerprediction')
 
+    def list(self, request):
+        printers = list(self.filter_queryset(self.get_queryset()))
+        Printer.prime_cache(printers)
+        serializer = self.get_serializer(printers, many=True)
+        return Response(serializer.data)
+
+    def retrieve(self, request, pk=None):
+        printer = self.get_object()
+        Printer.prime_cache([printer])
+        serializer = self.get_serializer(printer)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def archive(self, request, pk=None):
         printer = get_printer_or_404(pk, request)
@@ -217,14 +251,16 @@ class PrintViewSet(
             ).select_related('printer', 'g_code_file',
             )
 
-        sorting = request.GET.get('sorting', 'date_desc')
-        if sorting == 'date_asc':
-            queryset = queryset.order_by('id')
-        else:
-            queryset = queryset.order_by('-id')
+        descending = request.GET.get('sorting', 'date_desc') != 'date_asc'
+        limit = int(request.GET.get('limit', '12'))
+        if 'cursor' in request.GET:
+            results, next_cursor = keyset_page(queryset, request.GET['cursor'], limit, descending=descending)
+            serializer = self.serializer_class(results, many=True)
+            return Response({'results': serializer.data, 'next_cursor': next_cursor})
 
+        # For the clients that still page with start
+        queryset = queryset.order_by('-id' if descending else 'id')
         start = int(request.GET.get('start', '0'))
-        limit = int(request.GET.get('limit', '12'))
         # The "right" way to do it is `queryset[start:start+limit]`. However, it slows down the query by 100x because of the "offset 12 limit 12" clause. Weird.
         # Maybe related to https://stackoverflow.com/questions/21385555/postgresql-query-very-slow-with-limit-1
         results = list(queryset)[start:start + limit]
@@ -271,14 +307,20 @@ class PrintViewSet(
                 headers={k: v for k, v in resp_headers.items() if v is not None}
             )
 
-        data = r.json()
-
         detective_sensitivity: float = (
             p.printer.detective_sensitivity
             if p.printer is not None else
             Printer._meta.get_field('detective_sensitivity').get_default()
         )
 
+        if r.content.startswith(prediction_log.MAGIC):
+            return Response(
+                PredictionLog.from_bytes(r.content).to_prediction_json(detective_sensitivity),
+                headers={k: v for k, v in resp_headers.items() if v is not None}
+            )
+
+        # Prints compiled before the prediction log
+        data = r.json()
         for raw_pred in data:
             if 'fields' not in raw_pred:
                 # once upon a time in production
@@ -320,44 +362,74 @@ class PrintViewSet(
                 next_year = date_time.year + 1
                 next_period_start = datetime(next_year, 1, 1, tzinfo=date_time.tzinfo)
 
-            return next_period_start.replace(hour=0, minute=0, second=0, microsecond=0)
+            # Localized again, so that the periods after a DST change start at midnight too
+            return tz.localize(next_period_start.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None))
 
+        def rolled_up_days(from_date, end_date):
+            """The stats by day in the timezone, summed up from the rollup by UTC day"""
+            rollup = PrintStatsDay.objects.filter(
+                user=request.user,
+                date__gte=from_date.astimezone(pytz.utc).date(),
+                date__lte=(end_date - timedelta(microseconds=1)).astimezone(pytz.utc).date(),
+            )
+            filter_by_printer_ids = request.GET.getlist('filter_by_printer_ids[]')
+            if filter_by_printer_ids:
+                rollup = rollup.filter(printer_id__in=filter_by_printer_ids)
+
+            days = {}
+            for utc_day in rollup:
+                for date, stats in utc_day.local_days(tz):
+                    day = days.setdefault(date, dict(print_count=0, cancelled_print_count=0, total_print_time=0.0, longest_print_time=None, filament_used=0.0))
+                    day['print_count'] += stats['print_count']
+                    day['cancelled_print_count'] += stats['cancelled_print_count']
+                    day['total_print_time'] += stats['total_print_time']
+                    day['longest_print_time'] = max(day['longest_print_time'] or 0.0, stats['longest_print_time'] or 0.0)
+                    day['filament_used'] += stats['filament_used']
+            return [dict(date=tz.localize(datetime(d.year, d.month, d.day)), **days[d]) for d in sorted(days)]
+
+        def group_into_periods(days, period_starts):
+            """Sums up the days, in the order of their start, into the periods they start in, in one pass"""
+            groups = [dict(key=p.isoformat(), print_count=0, total_print_time=0, filament_used=0, cancelled_print_count=0) for p in period_starts[:-1]]
+            longest_print_time = 0
+            i = 0
+            for day in days:
+                while i < len(groups) and day['date'] >= period_starts[i + 1]:
+                    i += 1
+                if i == len(groups):
+                    break
+                if day['date'] < period_starts[i]:
+                    continue
+
+                group = groups[i]
+                group['print_count'] += day['print_count']
+                group['cancelled_print_count'] += day['cancelled_print_count']
+                group['total_print_time'] += day['total_print_time'] or 0
+                group['filament_used'] += day['filament_used'] or 0
+                longest_print_time = max(longest_print_time, day['longest_print_time'] or 0)
+
+            return groups, longest_print_time
 
         tz = pytz.timezone(request.GET['timezone'])
         from_date = timezone.make_aware(parse_datetime(f'{request.GET["from_date"]}T00:00:00'), timezone=tz)
         to_date = timezone.make_aware(parse_datetime(f'{request.GET["to_date"]}T23:59:59'), timezone=tz)
         group_by = request.GET['group_by'].lower()
-
-        queryset = queryset = self.get_queryset().annotate(
-                date=TruncDay('started_at', tzinfo=tz),
-            ).values('date').annotate(
-                filament_used=Sum('filament_used'),
-                total_print_time=Sum('print_time'),
-                longest_print_time=Max('print_time'),
-                print_count=Count('*'),
-                cancelled_print_count=Sum(Case(When(cancelled_at=None, then=Value(0)), default=Value(1), output_field=fields.IntegerField())),
-            ).order_by('date')
-
-        all_days = queryset.all()
-
-        print_count_groups = []
-        print_time_groups = []
-        filament_used_groups = []
-        cancelled_print_count_groups = []
-
         group_periods = datetime_periods_by_week(from_date, to_date, group_by)
-        for i in range(len(group_periods) - 1):
-            period_start = group_periods[i]
-            period_end = group_periods[i+1]
-
-            group_key = period_start.isoformat()
-
-            all_days_in_current_period = [day for day in all_days if period_start <= day['date'] < period_end]
 
-            print_count_groups.append( dict( key=group_key, value=sum([d['print_count'] for d in all_days_in_current_period]) ) )
-            print_time_groups.append( dict( key=group_key, value=sum([d['total_print_time'] for d in all_days_in_current_period if d['total_print_time'] is not None]) ) )
-            filament_used_groups.append( dict( key=group_key, value=sum([d['filament_used'] for d in all_days_in_current_period if d['filament_used'] is not None]) ) )
-            cancelled_print_count_groups.append( dict( key=group_key, value=sum([d['cancelled_print_count'] for d in all_days_in_current_period]) ) )
+        # The rollup has the prints that are neither deleted nor filtered by their status
+        if request.GET.get('filter', 'none') == 'none' and request.GET.get('feedback_needed', 'none') == 'none' and 'with_deleted' not in request.GET:
+            days = rolled_up_days(from_date, to_date + timedelta(seconds=1))
+        else:
+            days = self.get_queryset().annotate(
+                    date=TruncDay('started_at', tzinfo=tz),
+                ).values('date').annotate(
+                    **print_stats_aggregates()
+                ).order_by('date')
+
+        groups, longest_print_time = group_into_periods(days, group_periods)
+        print_count_groups = [dict(key=g['key'], value=g['print_count']) for g in groups]
+        print_time_groups = [dict(key=g['key'], value=g['total_print_time']) for g in groups]
+        filament_used_groups = [dict(key=g['key'], value=g['filament_used']) for g in groups]
+        cancelled_print_count_groups = [dict(key=g['key'], value=g['cancelled_print_count']) for g in groups]
 
         result = {
             'print_count_groups': print_count_groups,
@@ -367,7 +439,7 @@ class PrintViewSet(
             'total_print_time': sum([g['value'] for g in print_time_groups]),
             'total_filament_used': sum([g['value'] for g in filament_used_groups]),
             'total_cancelled_print_count':  sum([g['value'] for g in cancelled_print_count_groups]),
-            'longest_print_time': max([d['longest_print_time'] or 0 for d in all_days]) if all_days else 0,
+            'longest_print_time': longest_print_time,
         }
         result['average_print_time'] = result['total_print_time'] / result['total_print_count'] if result['total_print_count'] > 0 else 0
         result['total_succeeded_print_count'] = result['total_print_count'] - result['total_cancelled_print_count']
@@ -863,8 +935,14 @@ class PrinterEventViewSet(
                 filter_by_types += [type_filter,]
         queryset = queryset.filter(event_type__in=filter_by_types)
 
-        start = int(request.GET.get('start', '0'))
         limit = int(request.GET.get('limit', '12'))
+        if 'cursor' in request.GET:
+            results, next_cursor = keyset_page(queryset, request.GET['cursor'], limit)
+            serializer = self.serializer_class(results, many=True)
+            return Response({'results': serializer.data, 'next_cursor': next_cursor})
+
+        # For the clients that still page with start
+        start = int(request.GET.get('start', '0'))
         # The "right" way to do it is `queryset[start:start+limit]`. However, it slows down the query by 100x because of the "offset 12 limit 12" clause. Weird.
         # Maybe related to https://stackoverflow.com/questions/21385555/postgresql-query-very-slow-with-limit-1
         results = list(queryset)[start:start + limit]
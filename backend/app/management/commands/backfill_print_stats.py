@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+from itertools import groupby, islice
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Print, PrintStatsDay, print_stats_quarter_hour, rolled_up_print_stats
+
+
+def rolled_up_days(prints):
+    """The prints, in the order of user, printer and start, rolled up by UTC day"""
+    for (user_id, printer_id, date), day_prints in groupby(
+            prints, key=lambda p: (p['user_id'], p['printer_id'], print_stats_quarter_hour(p['started_at'])[0])):
+        yield PrintStatsDay(user_id=user_id, printer_id=printer_id, date=date, **rolled_up_print_stats(day_prints))
+
+
+class Command(BaseCommand):
+    help = 'Roll up the stats of the prints into PrintStatsDay from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, help='Only the prints of this user')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        prints = Print.objects.filter(uploaded_at__isnull=True, started_at__isnull=False)
+        days = PrintStatsDay.objects.all()
+        if options['user_id']:
+            prints = prints.filter(user_id=options['user_id'])
+            days = days.filter(user_id=options['user_id'])
+
+        rolled_up = rolled_up_days(
+            prints.order_by('user_id', 'printer_id', 'started_at').values(
+                'user_id', 'printer_id', 'started_at', 'cancelled_at', 'print_time', 'filament_used').iterator())
+
+        with transaction.atomic():
+            days.delete()
+            while True:
+                batch = list(islice(rolled_up, options['batch_size']))
+                if not batch:
+                    break
+                PrintStatsDay.objects.bulk_create(batch)
+
+        self.stdout.write(f'Rolled up {days.count()} days')
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.27 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0073_auto_20230128_0217'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='printer',
+            name='detection_roi',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
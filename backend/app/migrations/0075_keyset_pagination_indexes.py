@@ -0,0 +1,21 @@
+# Generated by Django 2.2.27 on 2026-10-17 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0074_printer_detection_roi'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='print',
+            index=models.Index(fields=['user', 'id'], name='app_print_user_id_f76796_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='printerevent',
+            index=models.Index(fields=['printer', 'id'], name='app_printer_printer_609b3a_idx'),
+        ),
+    ]
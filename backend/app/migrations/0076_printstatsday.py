@@ -0,0 +1,38 @@
+# Generated by Django 2.2.27 on 2026-10-17 11:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0075_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrintStatsDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('print_count', models.IntegerField(default=0)),
+                ('cancelled_print_count', models.IntegerField(default=0)),
+                ('total_print_time', models.FloatField(default=0.0)),
+                ('longest_print_time', models.FloatField(null=True)),
+                ('filament_used', models.FloatField(default=0.0)),
+                ('quarter_hours', jsonfield.fields.JSONField(default=list)),
+                ('printer', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='app.Printer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'printer', 'date')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='printstatsday',
+            index=models.Index(fields=['user', 'date'], name='app_printst_user_id_c3a983_idx'),
+        ),
+    ]
@@ -10,24 +10,25 @@ from jsonfield import JSONField
 import uuid
 from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
 from django.utils.translation import ugettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
 from safedelete.models import SafeDeleteModel
 from safedelete.managers import SafeDeleteManager
+from safedelete.signals import post_softdelete, post_undelete
 from pushbullet import Pushbullet, errors
 from django.utils.html import mark_safe
 from django.contrib.auth.hashers import make_password
-from django.db.models import F, Q
+from django.db.models import F, Q, Sum, Max, Count, Case, Value, When
 from django.db.models.constraints import UniqueConstraint
 
 
 
 from config.celery import celery_app
 from lib import cache, channels
-from lib.utils import dict_or_none, get_rotated_pic_url
+from lib.utils import dict_or_none, get_rotated_pic_url, parse_roi
 
 LOGGER = logging.getLogger(__name__)
 
@@ -168,6 +169,7 @@ class Printer(SafeDeleteModel):
     detective_sensitivity = models.FloatField(null=False, default=1.0)
     min_timelapse_secs_on_finish = models.IntegerField(null=False, default=60*10)  # Default to 10 minutes. -1: timelapse disabled
     min_timelapse_secs_on_cancel = models.IntegerField(null=False, default=60*5)  # Default to 5 minutes. -1: timelapse disabled
+    detection_roi = models.CharField(max_length=64, null=True, blank=True)  # "x1,y1,x2,y2" in fractions of the webcam image width and height. Blank: full image
     agent_name = models.CharField(max_length=64, null=True, blank=True)
     agent_version = models.CharField(max_length=64, null=True, blank=True)
 
@@ -178,19 +180,37 @@ class Printer(SafeDeleteModel):
     objects = PrinterManager()
     with_archived = SafeDeleteManager()
 
+    @staticmethod
+    def prime_cache(printers):
+        """Reads the status, pic and settings of the printers from redis in one round trip, instead of one or two each"""
+        snapshots = cache.printer_snapshots_get([p.id for p in printers])
+        for printer in printers:
+            printer._cache_snapshot = snapshots[printer.id]
+
     @property
     def status(self):
+        if hasattr(self, '_cache_snapshot'):
+            return dict_or_none(self._cache_snapshot['status'])
         return dict_or_none(cache.printer_status_get(self.id))
 
     @property
     def pic(self):
+        if hasattr(self, '_cache_snapshot'):
+            return dict_or_none(self._cache_snapshot['pic'])
         pic_data = cache.printer_pic_get(self.id)
 
         return dict_or_none(pic_data)
 
+    @property
+    def detection_roi_box(self):
+        return parse_roi(self.detection_roi)
+
     @property
     def settings(self):
-        p_settings = cache.printer_settings_get(self.id)
+        if hasattr(self, '_cache_snapshot'):
+            p_settings = dict(self._cache_snapshot['settings'])
+        else:
+            p_settings = cache.printer_settings_get(self.id)
 
         for key in ('webcam_flipV', 'webcam_flipH', 'webcam_rotate90'): # `webcam_rotate90` for backward compatibility with old plugins
             p_settings[key] = p_settings.get(key, 'False') == 'True'
@@ -240,7 +260,10 @@ class Printer(SafeDeleteModel):
         return None
 
     def actively_printing(self):
-        printer_cur_state = cache.printer_status_get(self.id, 'state')
+        if hasattr(self, '_cache_snapshot'):
+            printer_cur_state = self._cache_snapshot['status'].get('state')
+        else:
+            printer_cur_state = cache.printer_status_get(self.id, 'state')
 
         return printer_cur_state and printer_cur_state.get('flags', {}).get('printing', False)
 
@@ -467,6 +490,9 @@ class Print(SafeDeleteModel):
 
     class Meta:
         unique_together = [['printer', 'ext_id']]
+        indexes = [
+            models.Index(fields=['user', 'id'])  # Keyset pagination of the prints of a user
+        ]
 
     FAILED = 'FAILED'
     NOT_FAILED = 'NOT_FAILED'
@@ -541,8 +567,140 @@ class Print(SafeDeleteModel):
         return self.tagged_video_url or self.uploaded_at
 
 
+def print_stats_aggregates():
+    return dict(
+        filament_used=Sum('filament_used'),
+        total_print_time=Sum('print_time'),
+        longest_print_time=Max('print_time'),
+        print_count=Count('*'),
+        cancelled_print_count=Sum(Case(When(cancelled_at=None, then=Value(0)), default=Value(1), output_field=models.IntegerField())),
+    )
+
+
+def print_stats_quarter_hour(started_at):
+    """The UTC date and the quarter hour of the day, 0 to 95, started_at is in"""
+    started_at = started_at.astimezone(timezone.utc)
+    return started_at.date(), started_at.hour * 4 + started_at.minute // 15
+
+
+def rolled_up_print_stats(prints):
+    """
+    The stats of the prints, given as dicts of started_at, cancelled_at, print_time and filament_used, as the fields
+    of a PrintStatsDay.
+    """
+    quarter_hours = {}
+    for p in prints:
+        _, quarter_hour = print_stats_quarter_hour(p['started_at'])
+        stats = quarter_hours.setdefault(quarter_hour, [quarter_hour, 0, 0, 0.0, None, 0.0])
+        stats[1] += 1
+        stats[2] += 1 if p['cancelled_at'] is not None else 0
+        if p['print_time'] is not None:
+            stats[3] += p['print_time']
+            stats[4] = max(stats[4] or 0.0, p['print_time'])
+        stats[5] += p['filament_used'] or 0.0
+
+    quarter_hours = [quarter_hours[q] for q in sorted(quarter_hours)]
+    longest_print_times = [q[4] for q in quarter_hours if q[4] is not None]
+    return dict(
+        print_count=sum(q[1] for q in quarter_hours),
+        cancelled_print_count=sum(q[2] for q in quarter_hours),
+        total_print_time=sum((q[3] for q in quarter_hours), 0.0),
+        longest_print_time=max(longest_print_times) if longest_print_times else None,
+        filament_used=sum((q[5] for q in quarter_hours), 0.0),
+        quarter_hours=quarter_hours,
+    )
+
+
+class PrintStatsDay(models.Model):
+    """
+    The stats of the prints a user started on a printer in a day (UTC), rolled up for the print stats, in total and
+    by quarter hour. Every timezone is a whole number of quarter hours off UTC, so that a local day of any timezone is
+    the quarter hours of two UTC days, and the rollup of a month is a row per day. The only exceptions are the prints
+    started in the first minute of the day in the few timezones that changed their DST at 00:01.
+    """
+
+    QUARTER_HOUR_FIELDS = ('quarter_hour', 'print_count', 'cancelled_print_count', 'total_print_time', 'longest_print_time', 'filament_used')
+
+    class Meta:
+        unique_together = [['user', 'printer', 'date']]
+        indexes = [
+            models.Index(fields=['user', 'date'])
+        ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=False)
+    printer = models.ForeignKey(Printer, on_delete=models.CASCADE, null=True)
+    date = models.DateField(null=False)
+    print_count = models.IntegerField(null=False, default=0)
+    cancelled_print_count = models.IntegerField(null=False, default=0)
+    total_print_time = models.FloatField(null=False, default=0.0)
+    longest_print_time = models.FloatField(null=True)
+    filament_used = models.FloatField(null=False, default=0.0)
+    # The quarter hours with prints, in order, as lists of QUARTER_HOUR_FIELDS
+    quarter_hours = JSONField(null=False, default=list)
+
+    @classmethod
+    def refresh(cls, user_id, printer_id, started_at):
+        """Rolls up the day of started_at again from its prints"""
+        date, _ = print_stats_quarter_hour(started_at)
+        start = datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+        stats = rolled_up_print_stats(Print.objects.filter(
+            user_id=user_id,
+            printer_id=printer_id,
+            uploaded_at__isnull=True,
+            started_at__gte=start,
+            started_at__lt=start + timedelta(days=1),
+        ).values('started_at', 'cancelled_at', 'print_time', 'filament_used'))
+
+        if not stats['print_count']:
+            cls.objects.filter(user_id=user_id, printer_id=printer_id, date=date).delete()
+            return
+
+        try:
+            cls.objects.update_or_create(user_id=user_id, printer_id=printer_id, date=date, defaults=stats)
+        except IntegrityError:
+            # Created by a concurrent refresh in between, so that it's there to update now
+            cls.objects.update_or_create(user_id=user_id, printer_id=printer_id, date=date, defaults=stats)
+
+    def local_days(self, tz):
+        """The stats of the local days of tz this day has prints in, as (local date, stats dict) pairs"""
+        start = datetime(self.date.year, self.date.month, self.date.day, tzinfo=timezone.utc)
+        if start.astimezone(tz).date() == (start + timedelta(days=1, microseconds=-1)).astimezone(tz).date():
+            return [(start.astimezone(tz).date(), dict(
+                print_count=self.print_count,
+                cancelled_print_count=self.cancelled_print_count,
+                total_print_time=self.total_print_time,
+                longest_print_time=self.longest_print_time,
+                filament_used=self.filament_used,
+            ))]
+
+        return [
+            ((start + timedelta(minutes=15 * quarter_hour[0])).astimezone(tz).date(), dict(zip(self.QUARTER_HOUR_FIELDS[1:], quarter_hour[1:])))
+            for quarter_hour in self.quarter_hours
+        ]
+
+
+# Prints are rolled up when they start, once they have ended, and when they are deleted or undeleted.
+@receiver(post_save, sender=Print)
+def refresh_print_stats(sender, instance, created, **kwargs):
+    if instance.started_at and not instance.uploaded_at and (created or instance.ended_at()):
+        PrintStatsDay.refresh(instance.user_id, instance.printer_id, instance.started_at)
+
+
+@receiver(post_softdelete, sender=Print)
+@receiver(post_undelete, sender=Print)
+@receiver(post_delete, sender=Print)
+def refresh_print_stats_of_deleted(sender, instance, **kwargs):
+    if instance.started_at and not instance.uploaded_at:
+        PrintStatsDay.refresh(instance.user_id, instance.printer_id, instance.started_at)
+
+
 class PrinterEvent(models.Model):
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['printer', 'id'])  # Keyset pagination of the events of a printer
+        ]
+
     STARTED = 'STARTED'
     ENDED = 'ENDED'
     PAUSED = 'PAUSED'
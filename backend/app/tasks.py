@@ -10,7 +10,6 @@ import shutil
 import logging
 from django.utils import timezone
 from django.conf import settings
-from django.core import serializers
 from celery import shared_task
 from celery.decorators import periodic_task
 from datetime import timedelta
@@ -25,18 +24,27 @@ from channels_presence.models import Room
 
 from .models import *
 from .models import Print, PrinterEvent
-from lib.file_storage import list_dir, retrieve_to_file_obj, save_file_obj, delete_dir
-from lib.utils import ml_api_auth_headers, orientation_to_ffmpeg_options, copy_pic, last_pic_of_print
+from lib.file_storage import list_dir, retrieve_to_file_obj, retrieve_many, save_file_obj, save_many, delete_dir
+from lib.utils import orientation_to_ffmpeg_options, save_pic, ordered_imap
+from lib.frame_archive import PrintFrames, RAW, TAGGED, PREDICTION, BOXES, pic_id_of
+from lib.prediction_log import PredictionLog, pack_row, EXTENSION as PREDICTION_LOG_EXTENSION, ROWS_EXTENSION as PREDICTION_ROWS_EXTENSION
 from lib.prediction import update_prediction_with_detections, is_failing, VISUALIZATION_THRESH
-from lib.image import overlay_detections
+from lib.image import overlay_detections, boxes_to_detections
+from lib.video import probe_video, read_frame_batches, VideoWriter
 from lib import cache
+from lib import ml_api
 from lib import site
 from notifications.handlers import handler
 from notifications import notification_types
-from api.octoprint_views import IMG_URL_TTL_SECONDS
+from api.octoprint_views import IMG_URL_TTL_SECONDS, run_detection
+from lib.channels import send_status_to_web
+from lib import channels
 
 LOGGER = logging.getLogger(__name__)
 
+# Pics are encoded into segments, and archived, this long after they are uploaded, once their queued detections are done
+TIMELAPSE_SEGMENT_SETTLE_SECS = 60*5
+
 
 @shared_task
 def process_print_events(event_id):
@@ -77,6 +85,34 @@ def send_notification_for_print_event(_print, print_event, extra_context=None):
         )
 
 
+@shared_task
+def detect_pic(printer_id, print_id, pic_id, raw_pic_url, raw_pic_external_url=None):
+    printer = Printer.objects.select_related('current_print', 'user').get(id=printer_id)
+    if printer.current_print_id != print_id:  # The print has ended while the detection was in the queue
+        return
+
+    # Detections of the same printer must be folded into the prediction one at a time, and in the order of the pics.
+    with cache.printer_detection_lock(printer_id):
+        last_detected_pic_id = cache.printer_last_detected_pic_get(printer_id)
+        if last_detected_pic_id and float(last_detected_pic_id) >= float(pic_id):  # A newer pic has been detected. This one is stale.
+            return
+
+        pic_bytes = PrintFrames(printer_id, print_id).get(float(pic_id), RAW)
+        if not pic_bytes:
+            return
+
+        prediction, _ = PrinterPrediction.objects.get_or_create(printer=printer)
+        run_detection(printer, prediction, pic_id, pic_bytes, raw_pic_url, raw_pic_external_url)
+        cache.printer_last_detected_pic_set(printer_id, pic_id)
+
+    send_status_to_web(printer_id)
+
+
+@shared_task
+def push_held_back_status_to_web(printer_id):
+    channels.push_held_back_status_to_web(printer_id)
+
+
 @shared_task(acks_late=True)
 def compile_timelapse(print_id):
     _print = Print.objects.all_with_deleted().select_related('printer').get(id=print_id)
@@ -88,10 +124,20 @@ def compile_timelapse(print_id):
     ffmpeg_extra_options = orientation_to_ffmpeg_options(_print.printer.settings)
     pic_dir = f'{_print.printer.id}/{_print.id}'
 
-    print_pics = list_dir(f'raw/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
-    print_pics.sort()
-    if print_pics:
-        local_pics = download_files(print_pics, to_dir)
+    if settings.TIMELAPSE_SEGMENT_FRAMES:
+        try:
+            if join_timelapse_segments(_print, to_dir, ffmpeg_extra_options):
+                shutil.rmtree(to_dir, ignore_errors=True)
+                clean_up_print_pics(_print)
+                return
+        except Exception:
+            LOGGER.exception(f'Failed to join the time-lapse segments of print {_print.id}. Compiling it from the pics instead.')
+            shutil.rmtree(to_dir, ignore_errors=True)
+            os.mkdir(to_dir)
+
+    frames = PrintFrames(_print.printer.id, _print.id).extract((RAW, TAGGED, BOXES, PREDICTION), to_dir)
+    local_pics = frames[RAW]
+    if local_pics:
         mp4_filename = '{}.mp4'.format(_print.id)
         output_mp4 = os.path.join(to_dir, mp4_filename)
         cmd = 'ffmpeg -y -r 30 -pattern_type glob -i {}/*.jpg -c:v libx264 -pix_fmt yuv420p {} {}'.format(local_pics[-1].parent, ffmpeg_extra_options, output_mp4)
@@ -104,10 +150,8 @@ def compile_timelapse(print_id):
         _print.save(keep_deleted=True)
 
     # build tagged timelapse
-    print_pics = list_dir(f'tagged/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
-    print_pics.sort()
-    if print_pics:
-        local_pics = download_files(print_pics, to_dir)
+    local_pics = sorted(set(frames[TAGGED] + render_tagged_pics(frames[BOXES], frames[RAW], Path(to_dir, 'tagged', pic_dir))), key=pic_id_of)
+    if local_pics:
         mp4_filename = '{}_tagged.mp4'.format(_print.id)
         output_mp4 = os.path.join(to_dir, mp4_filename)
         cmd = 'ffmpeg -y -r 30 -pattern_type glob -i {}/*.jpg -c:v libx264 -pix_fmt yuv420p -vf pad=ceil(iw/2)*2:ceil(ih/2)*2 {} {}'.format(
@@ -116,28 +160,12 @@ def compile_timelapse(print_id):
         with open(output_mp4, 'rb') as mp4_file:
             _, mp4_file_url = save_file_obj('private/{}'.format(mp4_filename), mp4_file, settings.TIMELAPSE_CONTAINER)
 
-        json_files = list_dir(f'p/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
-        local_jsons = download_files(json_files, to_dir)
-        prediction_json = []
-        num_missing_p_json = 0
-        for pic_path in local_pics:
-            try:
-                with open(str(pic_path).replace('tagged/', 'p/').replace('.jpg', '.json'), 'r') as f:
-                    p_json = json.load(f)
-            except (FileNotFoundError, json.decoder.JSONDecodeError) as e:    # In case there is no corresponding json, the file will be empty and JSONDecodeError will be thrown
-                LOGGER.warn(e)
-                p_json = [{}]
-                num_missing_p_json += 1
-                if num_missing_p_json > 5:
-                    shutil.rmtree(to_dir, ignore_errors=True)
-                    clean_up_print_pics(_print)
-                    raise Exception('Too many missing p_json files.')
-
-            prediction_json += p_json
-        prediction_json_io = io.BytesIO()
-        prediction_json_io.write(json.dumps(prediction_json).encode('UTF-8'))
-        prediction_json_io.seek(0)
-        _, json_url = save_file_obj('private/{}_p.json'.format(_print.id), prediction_json_io, settings.TIMELAPSE_CONTAINER)
+        predictions = print_prediction_log(_print, to_dir, frames[PREDICTION]).select(pic_id_of(p) for p in local_pics)
+        if predictions.num_missing() > 5:
+            shutil.rmtree(to_dir, ignore_errors=True)
+            clean_up_print_pics(_print)
+            raise Exception('Too many missing predictions.')
+        _, json_url = save_file_obj(f'private/{_print.id}_p{PREDICTION_LOG_EXTENSION}', io.BytesIO(predictions.to_bytes()), settings.TIMELAPSE_CONTAINER)
 
         _print.tagged_video_url = mp4_file_url
         _print.prediction_json_url = json_url
@@ -147,6 +175,43 @@ def compile_timelapse(print_id):
     clean_up_print_pics(_print)
 
 
+@shared_task(acks_late=True)
+def compile_timelapse_segments(print_id):
+    _print = Print.objects.all_with_deleted().select_related('printer').get(id=print_id)
+
+    lock = cache.print_timelapse_lock(print_id)
+    if not lock.acquire(blocking=False):  # Already being compiled. The pics left over are for the next run.
+        return
+
+    to_dir = os.path.join(tempfile.gettempdir(), 'tl_segments_' + str(_print.id))
+    try:
+        shutil.rmtree(to_dir, ignore_errors=True)
+        os.mkdir(to_dir)
+        compile_new_timelapse_segments(_print, to_dir, orientation_to_ffmpeg_options(_print.printer.settings), final=False)
+    finally:
+        shutil.rmtree(to_dir, ignore_errors=True)
+        lock.release()
+
+
+@shared_task(acks_late=True)
+def archive_print_frames(print_id):
+    _print = Print.objects.all_with_deleted().select_related('printer').get(id=print_id)
+
+    lock = cache.print_timelapse_lock(print_id)
+    if not lock.acquire(blocking=False):  # The pics left over are for the next run
+        return
+
+    try:
+        until_pic_id = timezone.now().timestamp() - TIMELAPSE_SEGMENT_SETTLE_SECS
+        if settings.TIMELAPSE_SEGMENT_FRAMES:
+            # The segments are compiled from the loose pics. Only the pics they cover can be archived.
+            segments = timelapse_segments(f'{_print.printer.id}/{_print.id}')
+            until_pic_id = min(until_pic_id, float(segments[-1].rsplit('_', 1)[1]) if segments else 0.0)
+        PrintFrames(_print.printer.id, _print.id).pack(until_pic_id, settings.FRAME_ARCHIVE_FRAMES)
+    finally:
+        lock.release()
+
+
 @shared_task(acks_late=True, bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 2}, retry_backoff=True)
 def preprocess_timelapse(self, user_id, video_path, filename):
     tmp_file_path = os.path.join(tempfile.gettempdir(), video_path)
@@ -180,52 +245,57 @@ def detect_timelapse(self, print_id):
     with open(tl_path, 'wb') as file_obj:
         retrieve_to_file_obj(mp4_filepath, file_obj, settings.TIMELAPSE_CONTAINER)
 
-    jpgs_dir = os.path.join(tmp_dir, 'jpgs')
-    shutil.rmtree(jpgs_dir, ignore_errors=True)
-    os.makedirs(jpgs_dir)
-    tagged_jpgs_dir = os.path.join(tmp_dir, 'tagged_jpgs')
-    shutil.rmtree(tagged_jpgs_dir, ignore_errors=True)
-    os.makedirs(tagged_jpgs_dir)
-
-    ffprobe_cmd = subprocess.run(
-        f'ffprobe -v error -count_frames -select_streams v:0 -show_entries stream=nb_read_frames -of default=nokey=1:noprint_wrappers=1 {tl_path}'.split(), stdout=subprocess.PIPE)
-    frame_num = int(ffprobe_cmd.stdout.strip())
+    # Decoded once, straight into memory, detected in batches, tagged and encoded as it goes. No image files on the way.
+    width, height, frame_num = probe_video(tl_path)
     fps = 30*MAX_FRAME_NUM/frame_num if frame_num > MAX_FRAME_NUM else 30
-    subprocess.run(f'ffmpeg -y -i {tl_path} -vf fps={fps} -qscale:v 2 {jpgs_dir}/%5d.jpg'.split())
 
     predictions = []
     last_prediction = PrinterPrediction()
-    jpg_filenames = sorted(os.listdir(jpgs_dir))
-    for jpg_path in jpg_filenames:
-        jpg_abs_path = os.path.join(jpgs_dir, jpg_path)
-        with open(jpg_abs_path, 'rb') as pic:
-            pic_path = f'{_print.user.id}/{_print.id}/{jpg_path}'
-            internal_url, _ = save_file_obj(f'uploaded/{pic_path}', pic, settings.PICS_CONTAINER, long_term_storage=False)
-            req = requests.get(settings.ML_API_HOST + '/p/', params={'img': internal_url}, headers=ml_api_auth_headers(), verify=False)
-            req.raise_for_status()
-            detections = req.json()['detections']
-            update_prediction_with_detections(last_prediction, detections)
-            predictions.append(last_prediction)
-
-            if is_failing(last_prediction, 1, escalating_factor=1):
-                _print.alerted_at = timezone.now()
-
-            last_prediction = copy.deepcopy(last_prediction)
-            detections_to_visualize = [d for d in detections if d[1] > VISUALIZATION_THRESH]
-            overlay_detections(Image.open(jpg_abs_path), detections_to_visualize).save(os.path.join(tagged_jpgs_dir, jpg_path), "JPEG")
-
-    predictions_json = serializers.serialize("json", predictions)
-    _, json_url = save_file_obj(f'private/{_print.id}_p.json', io.BytesIO(str.encode(predictions_json)), settings.TIMELAPSE_CONTAINER)
-
+    last_frame = None
     mp4_filename = f'{_print.id}_tagged.mp4'
     output_mp4 = os.path.join(tmp_dir, mp4_filename)
-    subprocess.run(
-        f'ffmpeg -y -r 30 -pattern_type glob -i {tagged_jpgs_dir}/*.jpg -c:v libx264 -pix_fmt yuv420p -vf pad=ceil(iw/2)*2:ceil(ih/2)*2 {output_mp4}'.split(), check=True)
+
+    def detect_frames(frames):
+        return frames, ml_api.detect_frames(frames)
+
+    def tag_frames(detected):
+        frames, detections = detected
+        tagged_frames = []
+        for frame, frame_detections in zip(frames, detections):
+            detections_to_visualize = [d for d in frame_detections if d[1] > VISUALIZATION_THRESH]
+            # The frame is BGR. Drawn on as if it were RGB, which makes no difference to the green boxes, and encoded as BGR.
+            tagged_frame = overlay_detections(Image.frombuffer('RGB', (width, height), frame, 'raw', 'RGB', 0, 1), detections_to_visualize)
+            tagged_frames.append(tagged_frame.tobytes())
+        return frames, detections, tagged_frames
+
+    # Batches are detected, and tagged, a few at a time in thread pools. Only folding the detections into the prediction
+    # and encoding the tagged frames happen one frame after another, in frame order.
+    concurrency = settings.TIMELAPSE_DETECTION_CONCURRENCY
+    frame_batches = read_frame_batches(tl_path, width, height, fps, settings.TIMELAPSE_DETECTION_BATCH_SIZE)
+    with VideoWriter(output_mp4, width, height, fps=30) as tagged_video:
+        for frames, detections, tagged_frames in ordered_imap(tag_frames, ordered_imap(detect_frames, frame_batches, concurrency), concurrency):
+            for frame_detections, tagged_frame in zip(detections, tagged_frames):
+                update_prediction_with_detections(last_prediction, frame_detections)
+                predictions.append(last_prediction)
+
+                if is_failing(last_prediction, 1, escalating_factor=1):
+                    _print.alerted_at = timezone.now()
+
+                last_prediction = copy.deepcopy(last_prediction)
+                tagged_video.write(tagged_frame)
+            last_frame = frames[-1]
+
+    # Timestamped by frame number, as the frames of an uploaded time-lapse have no pic ids
+    predictions_log = PredictionLog.from_predictions(range(len(predictions)), predictions)
+    _, json_url = save_file_obj(f'private/{_print.id}_p{PREDICTION_LOG_EXTENSION}', io.BytesIO(predictions_log.to_bytes()), settings.TIMELAPSE_CONTAINER)
+
     with open(output_mp4, 'rb') as mp4_file:
         _, mp4_file_url = save_file_obj(f'private/{mp4_filename}', mp4_file, settings.TIMELAPSE_CONTAINER)
 
-    with open(os.path.join(jpgs_dir, jpg_filenames[-1]), 'rb') as poster_file:
-        _, poster_file_url = save_file_obj(f'private/{_print.id}_poster.jpg', poster_file, settings.TIMELAPSE_CONTAINER)
+    poster_file = io.BytesIO()
+    Image.fromarray(last_frame[:, :, ::-1]).save(poster_file, 'JPEG', quality=95)
+    poster_file.seek(0)
+    _, poster_file_url = save_file_obj(f'private/{_print.id}_poster.jpg', poster_file, settings.TIMELAPSE_CONTAINER)
 
     _print.tagged_video_url = mp4_file_url
     _print.prediction_json_url = json_url
@@ -234,7 +304,6 @@ def detect_timelapse(self, print_id):
 
     shutil.rmtree(tmp_dir, ignore_errors=True)
     send_timelapse_detection_done_email(_print)
-    delete_dir(f'uploaded/{_print.user.id}/{_print.id}/', settings.PICS_CONTAINER, long_term_storage=False)
 
 
 # Websocket connection count house upkeep jobs
@@ -253,16 +322,174 @@ def prune_channel_rooms():
 
 
 def download_files(filenames, to_dir, container=settings.PICS_CONTAINER):
-    output_files = []
-    for filename in filenames:
-        output_path = Path(os.path.join(to_dir, filename))
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, 'wb') as file_obj:
-            retrieve_to_file_obj(filename, file_obj, container, long_term_storage=False)
+    return [Path(p) for p in retrieve_many(filenames, to_dir, container, long_term_storage=False)]
+
+
+def print_prediction_log(_print, to_dir, local_p_jsons=()):
+    """
+    The predictions of the print's pics, from its prediction log, and from the p jsons of the pics detected before
+    there was one. The chunks of the log are downloaded to to_dir.
+    """
+    # Redis first, so that the rows moved to storage in between are read twice rather than not at all
+    buffered_rows = cache.print_prediction_log_get(_print.id)
+    chunks = list_dir(f'plog/{_print.printer.id}/{_print.id}/', settings.PICS_CONTAINER, long_term_storage=False)
+    rows = [p.read_bytes() for p in download_files([c for c in chunks if c.endswith(PREDICTION_ROWS_EXTENSION)], to_dir)]
+    for json_path in local_p_jsons:
+        try:
+            with open(json_path, 'r') as f:
+                rows.append(pack_row(pic_id_of(json_path), PrinterPrediction(**json.load(f)[0]['fields'])))
+        except (IndexError, KeyError, json.decoder.JSONDecodeError) as e:
+            LOGGER.warn(e)
+    return PredictionLog.from_rows(b''.join(rows) + buffered_rows)
+
+
+def render_tagged_pics(local_boxes, local_raw_pics, tagged_dir):
+    """Draws the boxes on their raw pics, into the tagged pics in tagged_dir. Returns the paths of the tagged pics."""
+    raw_pics = {p.stem: p for p in local_raw_pics}
+    tagged_pics = []
+    for boxes_path in local_boxes:
+        raw_pic = raw_pics.get(boxes_path.stem)
+        if raw_pic is None:
+            continue
+        with open(boxes_path, 'r') as f:
+            detections = boxes_to_detections(json.load(f))
+
+        tagged_pic = Path(tagged_dir, raw_pic.name)
+        tagged_pic.parent.mkdir(parents=True, exist_ok=True)
+        overlay_detections(Image.open(raw_pic).convert('RGB'), detections).save(tagged_pic, "JPEG")
+        tagged_pics.append(tagged_pic)
+
+    return tagged_pics
+
+
+def timelapse_segments(pic_dir):
+    """
+    The segments of the time-lapse compiled so far, in order, as the paths of their files without the extension.
+    A segment is named after its sequence number and the id of the last raw pic in it. Its raw video is written last,
+    so that it only counts once all its files are there.
+    """
+    segment_files = list_dir(f'segments/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
+    return sorted(f[:-len('.raw.mp4')] for f in segment_files if f.endswith('.raw.mp4'))
+
+
+def compile_new_timelapse_segments(_print, to_dir, ffmpeg_extra_options, final):
+    """
+    Encodes the pics that no segment covers yet into new segments of TIMELAPSE_SEGMENT_FRAMES raw pics each, with the
+    tagged pics and the predictions of the same time span. Unless it's final, only full segments of pics older than
+    TIMELAPSE_SEGMENT_SETTLE_SECS are encoded, so that the queued detections of those pics are done.
+    Returns all the segments of the print.
+    """
+    pic_dir = f'{_print.printer.id}/{_print.id}'
+    segments = timelapse_segments(pic_dir)
+    last_pic_id = float(segments[-1].rsplit('_', 1)[1]) if segments else 0.0
+
+    new_pics = sorted(p for p in list_dir(f'raw/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False) if pic_id_of(p) > last_pic_id)
+    if not final:
+        settled_at = timezone.now().timestamp() - TIMELAPSE_SEGMENT_SETTLE_SECS
+        new_pics = [p for p in new_pics if pic_id_of(p) < settled_at]
+        new_pics = new_pics[:len(new_pics) - len(new_pics) % settings.TIMELAPSE_SEGMENT_FRAMES]
+    if not new_pics:
+        return segments
+
+    tagged_pics = sorted(p for p in list_dir(f'tagged/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False) if pic_id_of(p) > last_pic_id)
+    boxes = sorted(p for p in list_dir(f'boxes/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False) if pic_id_of(p) > last_pic_id)
+    p_jsons = sorted(p for p in list_dir(f'p/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False) if pic_id_of(p) > last_pic_id)
+    predictions = print_prediction_log(_print, to_dir, download_files(p_jsons, to_dir))
+    for i in range(0, len(new_pics), settings.TIMELAPSE_SEGMENT_FRAMES):
+        segment_pics = new_pics[i:i + settings.TIMELAPSE_SEGMENT_FRAMES]
+        segment_last_pic_id = pic_id_of(segment_pics[-1])
+        segment = f'segments/{pic_dir}/{len(segments) + 1:05}_{Path(segment_pics[-1]).stem}'
+        segment_dir = os.path.join(to_dir, segment)
+
+        local_raw_pics = download_files(segment_pics, segment_dir)
+        segment_tagged_pics = [p for p in tagged_pics if last_pic_id < pic_id_of(p) <= segment_last_pic_id]
+        segment_boxes = [p for p in boxes if last_pic_id < pic_id_of(p) <= segment_last_pic_id]
+        if segment_tagged_pics or segment_boxes:
+            tagged_dir = Path(segment_dir, 'tagged', pic_dir)
+            local_pics = download_files(segment_tagged_pics, segment_dir) + render_tagged_pics(download_files(segment_boxes, segment_dir), local_raw_pics, tagged_dir)
+            tagged_mp4 = segment_dir + '.tagged.mp4'
+            cmd = 'ffmpeg -y -r 30 -pattern_type glob -i {}/*.jpg -c:v libx264 -pix_fmt yuv420p -vf pad=ceil(iw/2)*2:ceil(ih/2)*2 {} {}'.format(
+                tagged_dir, ffmpeg_extra_options, tagged_mp4)
+            subprocess.run(cmd.split(), check=True)
+
+            segment_predictions = predictions.select(pic_id_of(p) for p in sorted(set(local_pics), key=pic_id_of))
+            with open(tagged_mp4, 'rb') as segment_file:
+                save_many([
+                    (segment + '.tagged.mp4', segment_file),
+                    (segment + PREDICTION_LOG_EXTENSION, io.BytesIO(segment_predictions.to_bytes())),
+                ], settings.PICS_CONTAINER, long_term_storage=False)
+
+        raw_mp4 = segment_dir + '.raw.mp4'
+        cmd = 'ffmpeg -y -r 30 -pattern_type glob -i {}/*.jpg -c:v libx264 -pix_fmt yuv420p {} {}'.format(local_raw_pics[-1].parent, ffmpeg_extra_options, raw_mp4)
+        subprocess.run(cmd.split(), check=True)
+        with open(raw_mp4, 'rb') as segment_file:
+            save_file_obj(segment + '.raw.mp4', segment_file, settings.PICS_CONTAINER, long_term_storage=False)
+
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        segments.append(segment)
+        last_pic_id = segment_last_pic_id
+
+    return segments
+
+
+def concat_videos(video_paths, output_path, to_dir):
+    list_path = os.path.join(to_dir, 'concat.txt')
+    with open(list_path, 'w') as f:
+        f.writelines(f"file '{p}'\n" for p in video_paths)
+    subprocess.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', output_path], check=True)
+
+
+def join_timelapse_segments(_print, to_dir, ffmpeg_extra_options):
+    """
+    Encodes the pics left since the last segment, and joins the segments into the time-lapse videos and the prediction
+    json without encoding them again. Returns False if the print has no segments to join.
+    """
+    lock = cache.print_timelapse_lock(_print.id)
+    lock.acquire()  # Waits for the segments being compiled to be done
+    try:
+        segments = compile_new_timelapse_segments(_print, to_dir, ffmpeg_extra_options, final=True)
+    finally:
+        lock.release()
+    if not segments:
+        return False
 
-        output_files += [output_path]
+    pic_dir = f'{_print.printer.id}/{_print.id}'
+    segment_files = set(list_dir(f'segments/{pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False))
+
+    raw_segment_files = download_files([s + '.raw.mp4' for s in segments], to_dir)
+    mp4_filename = '{}.mp4'.format(_print.id)
+    output_mp4 = os.path.join(to_dir, mp4_filename)
+    concat_videos(raw_segment_files, output_mp4, to_dir)
+    with open(output_mp4, 'rb') as mp4_file:
+        _, mp4_file_url = save_file_obj('private/{}'.format(mp4_filename), mp4_file, settings.TIMELAPSE_CONTAINER)
+    _print.video_url = mp4_file_url
+    _print.save(keep_deleted=True)
+
+    tagged_segments = [s for s in segments if s + '.tagged.mp4' in segment_files]
+    if not tagged_segments:
+        return True
+
+    segment_predictions = []
+    for log_path in download_files([s + PREDICTION_LOG_EXTENSION for s in tagged_segments], to_dir):
+        with open(log_path, 'rb') as f:
+            segment_predictions.append(PredictionLog.from_bytes(f.read()))
+    predictions = PredictionLog.concat(segment_predictions)
+    if predictions.num_missing() > 5:
+        raise Exception('Too many missing predictions.')
+
+    tagged_segment_files = download_files([s + '.tagged.mp4' for s in tagged_segments], to_dir)
+    mp4_filename = '{}_tagged.mp4'.format(_print.id)
+    output_mp4 = os.path.join(to_dir, mp4_filename)
+    concat_videos(tagged_segment_files, output_mp4, to_dir)
+    with open(output_mp4, 'rb') as mp4_file:
+        _, mp4_file_url = save_file_obj('private/{}'.format(mp4_filename), mp4_file, settings.TIMELAPSE_CONTAINER)
 
-    return output_files
+    _, json_url = save_file_obj(f'private/{_print.id}_p{PREDICTION_LOG_EXTENSION}', io.BytesIO(predictions.to_bytes()), settings.TIMELAPSE_CONTAINER)
+
+    _print.tagged_video_url = mp4_file_url
+    _print.prediction_json_url = json_url
+    _print.save(keep_deleted=True)
+    return True
 
 
 def clean_up_print_pics(_print):
@@ -270,18 +497,25 @@ def clean_up_print_pics(_print):
     delete_dir('raw/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
     delete_dir('tagged/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
     delete_dir('p/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
+    delete_dir('boxes/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
+    delete_dir('segments/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
+    delete_dir('archive/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
+    delete_dir('plog/{}/'.format(pic_dir), settings.PICS_CONTAINER, long_term_storage=False)
+    cache.print_timelapse_pics_delete(_print.id)
+    cache.print_prediction_log_delete(_print.id)
 
 
 def will_record_timelapse(_print):
-    last_pic = last_pic_of_print(_print, 'raw')
+    frames = PrintFrames(_print.printer.id, _print.id)
+    last_pic_id = frames.last_pic_id()
 
-    if not last_pic: # This print does not have any raw pics
+    if not last_pic_id: # This print does not have any raw pics
         return False
 
     # Save the unrotated snapshot so that it is still viewable even after the print is done.
-    unrotated_jpg_url = copy_pic(
-                            last_pic,
+    unrotated_jpg_url = save_pic(
                             f'snapshots/{_print.printer.id}/latest_unrotated.jpg',
+                            io.BytesIO(frames.get(last_pic_id, RAW)),
                             rotated=False,
                             to_long_term_storage=False
                         )
@@ -335,10 +569,14 @@ def select_print_shots_for_feedback(_print):
 
         return sorted(selected_timestamps)
 
+    frames = PrintFrames(_print.printer.id, _print.id)
     for ts in highest_7_predictions(cache.print_highest_predictions_get(_print.id)):
-        rotated_jpg_url = copy_pic(
-                            f'raw/{_print.printer.id}/{_print.id}/{ts}.jpg',
+        pic_bytes = frames.get(ts, RAW)
+        if not pic_bytes:
+            continue
+        rotated_jpg_url = save_pic(
                             f'ff_printshots/{_print.user.id}/{_print.id}/{ts}.jpg',
+                            io.BytesIO(pic_bytes),
                             rotated=True,
                             printer_settings=_print.printer.settings,
                             to_long_term_storage=False
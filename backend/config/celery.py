@@ -17,6 +17,8 @@ celery_app.conf.task_routes = {
     'app_ent.tasks.setup_free_trial': {'queue': 'realtime'},
     'notifications.tasks.send_printer_notifications': {'queue': 'realtime'},
     'notifications.tasks.send_failure_alerts': {'queue': 'realtime'},
+    'app.tasks.detect_pic': {'queue': 'detection'},
+    'app.tasks.push_held_back_status_to_web': {'queue': 'realtime'},
 }
 
 # Using a string here means the worker doesn't have to serialize
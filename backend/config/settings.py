@@ -411,13 +411,46 @@ INTERNAL_MEDIA_HOST = os.environ.get('INTERNAL_MEDIA_HOST')
 PICS_CONTAINER = 'tsd-pics'
 TIMELAPSE_CONTAINER = 'tsd-timelapses'
 GCODE_CONTAINER = 'tsd-gcodes'
+FILE_STORAGE_MAX_WORKERS = int(os.environ.get('FILE_STORAGE_MAX_WORKERS', 16))  # Max number of files retrieved, saved or deleted at a time by the bulk file storage operations
 
 BUCKET_PREFIX = os.environ.get('BUCKET_PREFIX')
 ML_API_HOST = os.environ.get('ML_API_HOST')
 ML_API_TOKEN = os.environ.get('ML_API_TOKEN')
+ML_API_POST_PIC = get_bool('ML_API_POST_PIC', False)  # Post the pic bytes to ML API instead of letting it fetch the pic from its url
+ML_API_POOL_SIZE = int(os.environ.get('ML_API_POOL_SIZE', 10))  # Max number of keep-alive connections to ML API per process
+ML_API_CONNECT_TIMEOUT = float(os.environ.get('ML_API_CONNECT_TIMEOUT', 5))
+ML_API_READ_TIMEOUT = float(os.environ.get('ML_API_READ_TIMEOUT', 30))
+ML_API_MAX_TRIES = int(os.environ.get('ML_API_MAX_TRIES', 3))  # Connection errors, timeouts and 5xx responses are retried with exponential backoff
+TIMELAPSE_DETECTION_BATCH_SIZE = int(os.environ.get('TIMELAPSE_DETECTION_BATCH_SIZE', 8))  # Number of frames of an uploaded time-lapse sent to ML API in one request
+TIMELAPSE_DETECTION_CONCURRENCY = int(os.environ.get('TIMELAPSE_DETECTION_CONCURRENCY', 4))  # Number of those requests in flight at a time, and of threads tagging the frames
+# Encode the time-lapse of a print into segments of this many pics while it's printing, so that only the last pics are left to encode, and the segments to join, when it ends. 0 means encode it all when the print ends.
+TIMELAPSE_SEGMENT_FRAMES = int(os.environ.get('TIMELAPSE_SEGMENT_FRAMES', 0))
+# Pack the pics of a print, with their tagged pics and predictions, into archive files of this many pics each while it's printing, instead of keeping them as separate files. 0 means don't.
+FRAME_ARCHIVE_FRAMES = int(os.environ.get('FRAME_ARCHIVE_FRAMES', 0))
 
 PIC_POST_LIMIT_PER_MINUTE = int(os.environ.get('PIC_POST_LIMIT_PER_MINUTE', 0)) # 0 means no limits
+# Status updates of a printer in between are coalesced into one push to its web consumers. The push at the end of
+# the interval is a task in the realtime celery queue, so it's late by as long as the worker's slots are taken, e.g.
+# by time-lapses compiled by a worker that consumes the celery queue too. Run a worker of its own for the realtime
+# queue to keep it on time.
+PRINTER_STATUS_PUSH_MIN_SECS = float(os.environ.get('PRINTER_STATUS_PUSH_MIN_SECS', 0.5))
 MIN_DETECTION_INTERVAL = 10 # 10s as the default interval between detections. Recommended not to change as the hyper parameters are tuned based on interval = 10s.
+ASYNC_DETECTION = get_bool('ASYNC_DETECTION', False)  # Run failure detection in the "detection" celery queue instead of in the pic upload request
+# Store the detection boxes of a pic, drawn by the apps over the pic, instead of a tagged copy of the pic. Tagged pics are then only drawn for alerts and time-lapses.
+TAGGED_PICS_AS_BOXES = get_bool('TAGGED_PICS_AS_BOXES', False)
+# Reuse the detections of the last pic sent to ML API when the scene hasn't changed since, i.e. no cell of the 32x24 grayscale thumbnails differs by more than this many gray levels. 0 means always detect.
+# Off by default, as a small early failure may not change a coarse thumbnail by much. Set it to e.g. 4 (FRAME_DIFF_SKIP_THRESHOLD=4 in .env) to save ML API calls while the scene is still.
+FRAME_DIFF_SKIP_THRESHOLD = int(os.environ.get('FRAME_DIFF_SKIP_THRESHOLD', 0))
+# The predictions of a print are buffered in redis and saved to storage every this many pics. The rows of at most this many - 1 pics are lost if redis is.
+PREDICTION_LOG_FLUSH_ROWS = int(os.environ.get('PREDICTION_LOG_FLUSH_ROWS', 5))
+FRAME_DIFF_MAX_SKIP_SECONDS = int(os.environ.get('FRAME_DIFF_MAX_SKIP_SECONDS', 60 * 5))  # Pics are sent to ML API at least this often, even if the scene stays the same
+# Crop pics to the region of the printer's past detections once it's been learned from this many pics with detections. 0 means never crop to a learned region.
+# A printer's detection_roi, when set, is used instead.
+DETECTION_ROI_MIN_SAMPLES = int(os.environ.get('DETECTION_ROI_MIN_SAMPLES', 0))
+DETECTION_ROI_MARGIN = float(os.environ.get('DETECTION_ROI_MARGIN', 0.2))  # Fraction of the pic width and height added to each side of the learned region
+DETECTION_ROI_FULL_FRAME_EVERY = int(os.environ.get('DETECTION_ROI_FULL_FRAME_EVERY', 10))  # Every Nth pic is detected in full anyway, to keep learning and to catch failures outside of the region. 0 means never
+# Net input size (a multiple of 32) for pics of prints that are far from failing. 0 means the model's default. Only ONNX models exported with a dynamic input size support it.
+LOW_RISK_INPUT_SIZE = int(os.environ.get('LOW_RISK_INPUT_SIZE', 0))
 
 # Hyper parameters for prediction model
 # Definitely not failing if ewm mean is below this level. =(0.4 - 0.02): 0.4 - optimal THRESHOLD_LOW in hyper params grid search; 0.02 - average of rolling_mean_short
@@ -94,11 +94,15 @@ def printer_status_delete(printer_id):
 
 
 def printer_pic_set(printer_id, mapping, ex=None):
+    # Replaces the previous pic as a whole, so that e.g. the detection boxes of a pic don't stay on the next one
     cleaned_mapping = {k: v for k, v in mapping.items() if v is not None}
     prefix = printer_key_prefix(printer_id) + 'pic'
-    REDIS.hmset(prefix, cleaned_mapping)
-    if ex:
-        REDIS.expire(prefix, ex)
+    with REDIS.pipeline() as pipe:
+        pipe.delete(prefix)
+        pipe.hmset(prefix, cleaned_mapping)
+        if ex:
+            pipe.expire(prefix, ex)
+        pipe.execute()
 
 
 def printer_pic_get(printer_id, key=None):
@@ -125,6 +129,91 @@ def printer_settings_get(printer_id, key=None):
         return REDIS.hgetall(prefix)
 
 
+def printer_snapshots_get(printer_ids):
+    """
+    The status, pic and settings of the printers, as printer_status_get, printer_pic_get and printer_settings_get return
+    them, in one round trip: {printer_id: {'status': ..., 'pic': ..., 'settings': ...}}
+    """
+    with REDIS.pipeline(transaction=False) as pipe:
+        for printer_id in printer_ids:
+            prefix = printer_key_prefix(printer_id)
+            pipe.get(prefix + 'status_str')
+            pipe.hgetall(prefix + 'status')  # TODO: retire with the status hash
+            pipe.hgetall(prefix + 'pic')
+            pipe.hgetall(prefix + 'settings')
+        results = pipe.execute()
+
+    snapshots = {}
+    for i, printer_id in enumerate(printer_ids):
+        status_str, status_data, pic, settings = results[i * 4:i * 4 + 4]
+        if status_str:
+            status = json.loads(status_str)
+        else:
+            status = {k: json.loads(v) for k, v in status_data.items()}
+        snapshots[printer_id] = {'status': status, 'pic': pic, 'settings': settings}
+    return snapshots
+
+
+def rate_limit_pass(key, interval_secs):
+    # Only the first caller within interval_secs passes, across processes
+    return bool(REDIS.set(key, '1', nx=True, px=max(int(interval_secs * 1000), 1)))
+
+
+def rate_limit_restart(key, interval_secs):
+    # No caller passes within interval_secs from now
+    REDIS.set(key, '1', px=max(int(interval_secs * 1000), 1))
+
+
+def printer_detection_gate_pass(printer_id, interval_secs):
+    return rate_limit_pass(printer_key_prefix(printer_id) + 'detect_gate', interval_secs)
+
+
+def printer_detection_lock(printer_id, timeout_secs=120):
+    return REDIS.lock(printer_key_prefix(printer_id) + 'detect_lock', timeout=timeout_secs)
+
+
+def printer_last_detected_pic_set(printer_id, pic_id):
+    REDIS.set(printer_key_prefix(printer_id) + 'detected_pic', pic_id, ex=60*60*24)
+
+
+def printer_last_detected_pic_get(printer_id):
+    return REDIS.get(printer_key_prefix(printer_id) + 'detected_pic')
+
+
+def print_last_detected_frame_set(print_id, fingerprint, detections, ex):
+    key = print_key_prefix(print_id) + 'detected_frame'
+    with BREDIS.pipeline() as pipe:
+        pipe.hmset(key, {'fingerprint': fingerprint, 'detections': json.dumps(detections)})
+        pipe.expire(key, ex)
+        pipe.execute()
+
+
+def print_last_detected_frame_get(print_id):
+    frame = BREDIS.hgetall(print_key_prefix(print_id) + 'detected_frame')
+    if not frame:
+        return None, None
+    return frame[b'fingerprint'], json.loads(frame[b'detections'])
+
+
+def printer_learned_roi_add(printer_id, box):
+    """Grows the printer's learned detection region to include box (x1, y1, x2, y2)"""
+    key = printer_key_prefix(printer_id) + 'learned_roi'
+    learned, samples = printer_learned_roi_get(printer_id)
+    if learned:
+        box = (min(learned[0], box[0]), min(learned[1], box[1]), max(learned[2], box[2]), max(learned[3], box[3]))
+    with REDIS.pipeline() as pipe:
+        pipe.hmset(key, {'box': ','.join(map(str, box)), 'samples': samples + 1})
+        pipe.expire(key, 60*60*24*30)
+        pipe.execute()
+
+
+def printer_learned_roi_get(printer_id):
+    roi = REDIS.hgetall(printer_key_prefix(printer_id) + 'learned_roi')
+    if not roi:
+        return None, 0
+    return tuple(float(v) for v in roi['box'].split(',')), int(roi['samples'])
+
+
 def print_num_predictions_incr(print_id):
     key = f'{print_key_prefix(print_id)}:pred'
     with REDIS.pipeline() as pipe:
@@ -144,6 +233,55 @@ def print_num_predictions_delete(print_id):
     return REDIS.delete(key)
 
 
+def print_timelapse_pics_incr(print_id):
+    key = f'{print_key_prefix(print_id)}tl_pics'
+    with REDIS.pipeline() as pipe:
+        pipe.incr(key)
+        # Assuming it'll be processed in 30 days.
+        pipe.expire(key, 60*60*24*30)
+        (cnt, _) = pipe.execute()
+
+    return cnt
+
+
+def print_timelapse_pics_delete(print_id):
+    return REDIS.delete(f'{print_key_prefix(print_id)}tl_pics')
+
+
+def print_prediction_log_append(print_id, rows):
+    key = f'{print_key_prefix(print_id)}plog'
+    with BREDIS.pipeline() as pipe:
+        pipe.append(key, rows)
+        # Assuming it'll be processed in 30 days.
+        pipe.expire(key, 60*60*24*30)
+        (length, _) = pipe.execute()
+
+    return length
+
+
+def print_prediction_log_take(print_id):
+    """Gets and deletes the rows at once, so that each row is taken only once"""
+    key = f'{print_key_prefix(print_id)}plog'
+    with BREDIS.pipeline() as pipe:
+        pipe.get(key)
+        pipe.delete(key)
+        (rows, _) = pipe.execute()
+
+    return rows or b''
+
+
+def print_prediction_log_get(print_id):
+    return BREDIS.get(f'{print_key_prefix(print_id)}plog') or b''
+
+
+def print_prediction_log_delete(print_id):
+    return BREDIS.delete(f'{print_key_prefix(print_id)}plog')
+
+
+def print_timelapse_lock(print_id, timeout_secs=60*30):
+    return REDIS.lock(print_key_prefix(print_id) + 'tl_lock', timeout=timeout_secs)
+
+
 def print_high_prediction_add(print_id, prediction, timestamp, maxsize=180):
 
     key = f'{print_key_prefix(print_id)}:hp'
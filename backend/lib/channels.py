@@ -1,6 +1,7 @@
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 import json
+from django.conf import settings
 from channels_presence.models import Room
 from django.dispatch import receiver
 from channels_presence.signals import presence_changed
@@ -13,6 +14,10 @@ def octo_group_name(printer_id):
 def web_group_name(printer_id):
     return 'p_web.{}'.format(printer_id)
 
+def shared_web_group_name(printer_id):
+    # Only a presence room, to count the viewers of the shared printer. They get their messages through web_group_name.
+    return 'p_shared_web.{}'.format(printer_id)
+
 def janus_web_group_name(printer_id):
     return 'janus_web.{}'.format(printer_id)
 
@@ -21,36 +26,83 @@ def octoprinttunnel_group_name(printer_id):
     return 'octoprinttunnel.{}'.format(printer_id)
 
 
-def send_msg_to_printer(printer_id, msg_dict):
+# The async_ functions are for the async consumers, which relay messages without leaving the event loop. The others
+# are their sync versions, for everything else.
+
+async def async_send_msg_to_printer(printer_id, msg_dict):
     msg_dict.update({
         'type': 'printer.message',  # mapped to -> printer_message in consumer
     })
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         octo_group_name(printer_id),
         msg_dict,
     )
 
-def send_message_to_web(printer_id, msg_dict):
+def send_msg_to_printer(printer_id, msg_dict):
+    async_to_sync(async_send_msg_to_printer)(printer_id, msg_dict)
+
+async def async_send_message_to_web(printer_id, msg_dict):
     msg_dict.update({'type': 'web.message'})    # mapped to -> web_message in consumer
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         web_group_name(printer_id),
         msg_dict,
     )
 
+def send_message_to_web(printer_id, msg_dict):
+    async_to_sync(async_send_message_to_web)(printer_id, msg_dict)
+
 def send_status_to_web(printer_id):
+    """
+    Pushes the printer's status to its web consumers at most once every PRINTER_STATUS_PUSH_MIN_SECS. The updates held
+    back in between are carried by a single push at the end of the interval.
+    """
+    if cache.rate_limit_pass(cache.printer_key_prefix(printer_id) + 'status_push', settings.PRINTER_STATUS_PUSH_MIN_SECS):
+        push_status_to_web(printer_id)
+    elif cache.rate_limit_pass(cache.printer_key_prefix(printer_id) + 'status_push_trailing', settings.PRINTER_STATUS_PUSH_MIN_SECS):
+        from config.celery import celery_app
+        celery_app.send_task('app.tasks.push_held_back_status_to_web', args=[printer_id], countdown=settings.PRINTER_STATUS_PUSH_MIN_SECS)
+
+
+def push_held_back_status_to_web(printer_id):
+    # Starts a new interval, so that a steady stream of updates is pushed once per interval
+    cache.rate_limit_restart(cache.printer_key_prefix(printer_id) + 'status_push', settings.PRINTER_STATUS_PUSH_MIN_SECS)
+    push_status_to_web(printer_id)
+
+
+def push_status_to_web(printer_id):
+    """Serializes the printer's status once, for all its web consumers. Nothing is done if nobody is watching."""
+    # Imported here as app.models imports this module
+    from rest_framework.renderers import JSONRenderer
+    from app.models import Printer
+    from api.serializers import PrinterSerializer, PublicPrinterSerializer
+
+    if num_ws_connections(web_group_name(printer_id)) <= 0:
+        return
+
+    try:
+        printer = Printer.with_archived.select_related('current_print', 'printerprediction').get(id=printer_id)
+    except Printer.DoesNotExist:
+        return
+    Printer.prime_cache([printer])
+
+    msg_dict = {
+        'type': 'printer.status',         # mapped to -> printer_status in consumer
+        'printer': JSONRenderer().render(PrinterSerializer(printer).data).decode(),
+    }
+    if num_ws_connections(shared_web_group_name(printer_id)) > 0:
+        msg_dict['public_printer'] = JSONRenderer().render(PublicPrinterSerializer(printer).data).decode()
+
     layer = get_channel_layer()
     async_to_sync(layer.group_send)(
         web_group_name(printer_id),
-        {
-            'type': 'printer.status',         # mapped to -> printer_status in consumer
-        }
+        msg_dict,
     )
 
-def send_janus_to_web(printer_id, msg):
+async def async_send_janus_to_web(printer_id, msg):
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         janus_web_group_name(printer_id),
         {
             'type': 'janus.message',         # mapped to -> janus_message in consumer
@@ -58,19 +110,25 @@ def send_janus_to_web(printer_id, msg):
         }
     )
 
+def send_janus_to_web(printer_id, msg):
+    async_to_sync(async_send_janus_to_web)(printer_id, msg)
 
-def send_message_to_octoprinttunnel(group_name, data):
+
+async def async_send_message_to_octoprinttunnel(group_name, data):
     msg_dict = {
         # mapped to -> octoprinttunnel_message in consumer
         'type': 'octoprinttunnel.message',
         'data': data
     }
     layer = get_channel_layer()
-    async_to_sync(layer.group_send)(
+    await layer.group_send(
         group_name,
         msg_dict,
     )
 
+def send_message_to_octoprinttunnel(group_name, data):
+    async_to_sync(async_send_message_to_octoprinttunnel)(group_name, data)
+
 
 @receiver(presence_changed)
 def broadcast_ws_connection_change(sender, room, **kwargs):
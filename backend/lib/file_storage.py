@@ -2,21 +2,25 @@ from datetime import datetime, timedelta
 from django.conf import settings
 import base64
 from six.moves.urllib.parse import urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
 
 import importlib
+import os
 
 lt_file_storage = importlib.import_module(getattr(settings, 'LT_FILE_STORAGE_MODULE', 'lib.fs_file_storage'))
 st_file_storage = importlib.import_module(getattr(settings, 'ST_FILE_STORAGE_MODULE', 'lib.fs_file_storage'))
 
-def save_file_obj(dest_path, file_obj, container, long_term_storage=True):
+def content_type_of(dest_path):
     content_type='application/octet-stream'
     if dest_path.endswith('.jpg'):
         content_type='image/jpeg'
     if dest_path.endswith('.mp4'):
         content_type='video/mp4'
+    return content_type
 
+def save_file_obj(dest_path, file_obj, container, long_term_storage=True):
     file_storage = lt_file_storage if long_term_storage else st_file_storage
-    return file_storage.save_file_obj(dest_path, file_obj, container, content_type)
+    return file_storage.save_file_obj(dest_path, file_obj, container, content_type_of(dest_path))
 
 def list_dir(dir_path, container, long_term_storage=True):
     file_storage = lt_file_storage if long_term_storage else st_file_storage
@@ -34,3 +38,53 @@ def delete_dir(dir_path, container, long_term_storage=True):
 def delete_file(file_path, container, long_term_storage=True):
     file_storage = lt_file_storage if long_term_storage else st_file_storage
     return file_storage.delete_file(file_path, container)
+
+# The bulk operations below use the storage module's own retrieve_many, save_many or delete_many when it has one,
+# e.g. a native batch API of the cloud storage. Otherwise they run the single file operations in a thread pool of
+# up to FILE_STORAGE_MAX_WORKERS threads.
+
+def map_in_threads(fn, items):
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(items), settings.FILE_STORAGE_MAX_WORKERS)) as executor:
+        return list(executor.map(fn, items))
+
+# Retrieves the files into to_dir, each at the same path relative to it as in the container.
+# Returns the local paths, in the same order. Like with retrieve_to_file_obj, the ones that do not exist end up empty.
+def retrieve_many(src_paths, to_dir, container, long_term_storage=True):
+    file_storage = lt_file_storage if long_term_storage else st_file_storage
+    if hasattr(file_storage, 'retrieve_many'):
+        return file_storage.retrieve_many(src_paths, to_dir, container)
+
+    def retrieve(src_path):
+        local_path = os.path.join(to_dir, src_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as file_obj:
+            file_storage.retrieve_to_file_obj(src_path, file_obj, container)
+        return local_path
+
+    return map_in_threads(retrieve, src_paths)
+
+# Saves (dest_path, file_obj) pairs. Returns their (internal_url, external_url), in the same order.
+def save_many(dest_paths_and_file_objs, container, long_term_storage=True):
+    file_storage = lt_file_storage if long_term_storage else st_file_storage
+    files = [(dest_path, file_obj, content_type_of(dest_path)) for dest_path, file_obj in dest_paths_and_file_objs]
+    if hasattr(file_storage, 'save_many'):
+        return file_storage.save_many(files, container)
+
+    return map_in_threads(lambda f: file_storage.save_file_obj(f[0], f[1], container, f[2]), files)
+
+# Note: silently ignore the files that do not exist
+def delete_many(file_paths, container, long_term_storage=True):
+    file_storage = lt_file_storage if long_term_storage else st_file_storage
+    if hasattr(file_storage, 'delete_many'):
+        return file_storage.delete_many(file_paths, container)
+
+    def delete(file_path):
+        try:
+            file_storage.delete_file(file_path, container)
+        except FileNotFoundError:
+            pass
+
+    map_in_threads(delete, file_paths)
@@ -0,0 +1,227 @@
+import bisect
+import io
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from lib.file_storage import list_dir, retrieve_to_file_obj, retrieve_many, save_file_obj, delete_many
+
+# The frames of a print are uploaded and detected as loose files: raw/{printer}/{print}/{pic_id}.jpg,
+# tagged/.../{pic_id}.jpg (or boxes/.../{pic_id}.json with TAGGED_PICS_AS_BOXES) and, for the pics detected before the
+# prediction log, p/.../{pic_id}.json. Once settled, they are packed into the archive of the print,
+# archive/{printer}/{print}/, an append-only series of chunks of FRAME_ARCHIVE_FRAMES raw frames each, and deleted.
+#
+# A chunk is a single file of:
+#   file header: magic, version
+#   records, in the order of the pics: pic id, kind, payload length, payload
+#   index, sorted by pic id and kind: pic id, kind, payload offset, payload length
+#   trailer: index offset, number of index entries, magic
+# so that it can be read sequentially, record after record, or randomly, by pic id, through its index.
+#
+# A chunk is named after its sequence number and the id of its last raw frame. It holds the tagged frames, boxes and
+# prediction records since the last raw frame of the chunk before it.
+
+RAW, TAGGED, PREDICTION, BOXES = range(4)
+KIND_DIRS = {RAW: ('raw', '.jpg'), TAGGED: ('tagged', '.jpg'), PREDICTION: ('p', '.json'), BOXES: ('boxes', '.json')}
+
+MAGIC = b'TLFA'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sB')
+RECORD_HEADER = struct.Struct('<dBI')  # pic id, kind, payload length
+INDEX_ENTRY = struct.Struct('<dBQI')  # pic id, kind, payload offset, payload length
+TRAILER = struct.Struct('<QI4s')  # index offset, number of index entries, magic
+
+CHUNK_EXTENSION = '.frames'
+
+IndexEntry = Tuple[float, int, int, int]
+
+
+class FrameArchiveError(Exception):
+    pass
+
+
+def pic_id_of(pic_path: str) -> float:
+    return float(Path(pic_path).stem)
+
+
+class ChunkWriter:
+
+    def __init__(self, file_obj: BinaryIO):
+        self.file_obj = file_obj
+        self.index: List[IndexEntry] = []
+        self.offset = 0
+        self._write(FILE_HEADER.pack(MAGIC, VERSION))
+
+    def _write(self, data: bytes) -> None:
+        self.file_obj.write(data)
+        self.offset += len(data)
+
+    def add(self, pic_id: float, kind: int, payload: bytes) -> None:
+        self._write(RECORD_HEADER.pack(pic_id, kind, len(payload)))
+        self.index.append((pic_id, kind, self.offset, len(payload)))
+        self._write(payload)
+
+    def close(self) -> None:
+        index_offset = self.offset
+        for entry in sorted(self.index):
+            self._write(INDEX_ENTRY.pack(*entry))
+        self._write(TRAILER.pack(index_offset, len(self.index), MAGIC))
+
+
+def read_trailer(file_obj: BinaryIO) -> Tuple[int, int]:
+    file_obj.seek(0)
+    magic, version = FILE_HEADER.unpack(file_obj.read(FILE_HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise FrameArchiveError(f'Not a version {VERSION} frame archive chunk')
+
+    file_obj.seek(-TRAILER.size, os.SEEK_END)
+    index_offset, entry_num, magic = TRAILER.unpack(file_obj.read(TRAILER.size))
+    if magic != MAGIC:
+        raise FrameArchiveError('Truncated frame archive chunk')
+    return index_offset, entry_num
+
+
+def read_index(file_obj: BinaryIO) -> List[IndexEntry]:
+    index_offset, entry_num = read_trailer(file_obj)
+    file_obj.seek(index_offset)
+    return list(INDEX_ENTRY.iter_unpack(file_obj.read(entry_num * INDEX_ENTRY.size)))
+
+
+def read_record(file_obj: BinaryIO, index: List[IndexEntry], pic_id: float, kind: int) -> Optional[bytes]:
+    i = bisect.bisect_left(index, (pic_id, kind))
+    if i == len(index) or index[i][:2] != (pic_id, kind):
+        return None
+    _, _, offset, length = index[i]
+    file_obj.seek(offset)
+    return file_obj.read(length)
+
+
+def iter_records(file_obj: BinaryIO, kinds: Iterable[int] = KIND_DIRS.keys()) -> Iterator[Tuple[float, int, bytes]]:
+    """Reads the records of the kinds, in the order they were added. The payloads of the other kinds are skipped over."""
+    kinds = set(kinds)
+    index_offset, _ = read_trailer(file_obj)
+    file_obj.seek(FILE_HEADER.size)
+    while file_obj.tell() < index_offset:
+        pic_id, kind, length = RECORD_HEADER.unpack(file_obj.read(RECORD_HEADER.size))
+        if kind in kinds:
+            yield pic_id, kind, file_obj.read(length)
+        else:
+            file_obj.seek(length, os.SEEK_CUR)
+
+
+class PrintFrames:
+    """The frames of a print, archived or still loose"""
+
+    def __init__(self, printer_id, print_id):
+        self.pic_dir = f'{printer_id}/{print_id}'
+
+    def loose_path(self, pic_id: float, kind: int) -> str:
+        kind_dir, extension = KIND_DIRS[kind]
+        return f'{kind_dir}/{self.pic_dir}/{pic_id}{extension}'
+
+    def loose_pics(self, kind: int) -> List[str]:
+        kind_dir, _ = KIND_DIRS[kind]
+        return sorted(list_dir(f'{kind_dir}/{self.pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False), key=pic_id_of)
+
+    def chunks(self) -> List[Tuple[float, str]]:
+        """(id of the last raw frame, path) of the archived chunks, in order"""
+        chunk_paths = list_dir(f'archive/{self.pic_dir}/', settings.PICS_CONTAINER, long_term_storage=False)
+        return sorted(
+            (float(Path(p).stem.rsplit('_', 1)[1]), p) for p in chunk_paths if p.endswith(CHUNK_EXTENSION))
+
+    def _retrieve_chunk(self, chunk_path: str) -> BinaryIO:
+        chunk_file = tempfile.TemporaryFile()
+        retrieve_to_file_obj(chunk_path, chunk_file, settings.PICS_CONTAINER, long_term_storage=False)
+        return chunk_file
+
+    def last_pic_id(self) -> Optional[float]:
+        """Id of the last raw frame"""
+        loose_pics = self.loose_pics(RAW)
+        if loose_pics:
+            return pic_id_of(loose_pics[-1])
+        chunks = self.chunks()
+        return chunks[-1][0] if chunks else None
+
+    def get(self, pic_id: float, kind: int = RAW) -> Optional[bytes]:
+        """A frame by its pic id. Looked up in the archive if it's no longer loose."""
+        pic_bytes = io.BytesIO()
+        retrieve_to_file_obj(self.loose_path(pic_id, kind), pic_bytes, settings.PICS_CONTAINER, long_term_storage=False)
+        if pic_bytes.getvalue():
+            return pic_bytes.getvalue()
+
+        chunks = self.chunks()
+        i = bisect.bisect_left(chunks, (pic_id,))
+        if i == len(chunks):
+            return None
+        with self._retrieve_chunk(chunks[i][1]) as chunk_file:
+            return read_record(chunk_file, read_index(chunk_file), pic_id, kind)
+
+    def extract(self, kinds: Iterable[int], to_dir: str) -> Dict[int, List[Path]]:
+        """
+        Writes all the frames of the kinds, archived and loose, to to_dir, at the paths of their loose files, e.g.
+        to_dir/raw/{printer}/{print}/{pic_id}.jpg. Returns their local paths by kind, in the order of the pics.
+        """
+        extracted = {kind: [] for kind in kinds}
+        archived_until = 0.0
+        for archived_until, chunk_path in self.chunks():
+            with self._retrieve_chunk(chunk_path) as chunk_file:
+                for pic_id, kind, payload in iter_records(chunk_file, kinds):
+                    local_path = Path(to_dir, self.loose_path(pic_id, kind))
+                    local_path.parent.mkdir(parents=True, exist_ok=True)
+                    local_path.write_bytes(payload)
+                    extracted[kind].append(local_path)
+
+        for kind in kinds:
+            # Loose files of archived frames are left over from an interrupted packing
+            loose_pics = [p for p in self.loose_pics(kind) if pic_id_of(p) > archived_until]
+            extracted[kind] += [Path(p) for p in retrieve_many(loose_pics, to_dir, settings.PICS_CONTAINER, long_term_storage=False)]
+
+        return extracted
+
+    def pack(self, until_pic_id: float, frames_per_chunk: int) -> int:
+        """
+        Packs the loose frames up to until_pic_id into new chunks of frames_per_chunk raw frames, and deletes their
+        loose files. The frames that don't make up a full chunk are left loose, and so is the last raw frame, which may
+        still be shown as the printer's latest pic. Returns the number of raw frames packed.
+        """
+        chunks = self.chunks()
+        archived_until = chunks[-1][0] if chunks else 0.0
+        loose_pics = {kind: self.loose_pics(kind) for kind in KIND_DIRS}
+        delete_many(
+            [p for kind_pics in loose_pics.values() for p in kind_pics if pic_id_of(p) <= archived_until],
+            settings.PICS_CONTAINER, long_term_storage=False)
+
+        raw_pics = [p for p in loose_pics[RAW][:-1] if archived_until < pic_id_of(p) <= until_pic_id]
+        raw_pics = raw_pics[:len(raw_pics) - len(raw_pics) % frames_per_chunk]
+        to_dir = tempfile.mkdtemp(prefix='frames_')
+        try:
+            for i in range(0, len(raw_pics), frames_per_chunk):
+                chunk_until = pic_id_of(raw_pics[i + frames_per_chunk - 1])
+                chunk_pics = sorted(
+                    ((pic_id_of(p), kind, p) for kind, kind_pics in loose_pics.items() for p in kind_pics
+                     if archived_until < pic_id_of(p) <= chunk_until),
+                    key=lambda pic: pic[:2])
+                local_paths = retrieve_many([p for _, _, p in chunk_pics], to_dir, settings.PICS_CONTAINER, long_term_storage=False)
+
+                chunk_path = f'archive/{self.pic_dir}/{len(chunks) + 1:05}_{chunk_until}{CHUNK_EXTENSION}'
+                with tempfile.TemporaryFile() as chunk_file:
+                    writer = ChunkWriter(chunk_file)
+                    for (pic_id, kind, _), local_path in zip(chunk_pics, local_paths):
+                        with open(local_path, 'rb') as f:
+                            writer.add(pic_id, kind, f.read())
+                    writer.close()
+                    chunk_file.seek(0)
+                    save_file_obj(chunk_path, chunk_file, settings.PICS_CONTAINER, long_term_storage=False)
+
+                delete_many([p for _, _, p in chunk_pics], settings.PICS_CONTAINER, long_term_storage=False)
+                chunks.append((chunk_until, chunk_path))
+                archived_until = chunk_until
+        finally:
+            shutil.rmtree(to_dir, ignore_errors=True)
+
+        return len(raw_pics)
@@ -18,6 +18,8 @@ def save_file_obj(dest_path, file_obj, container, content_type):
 
 def list_dir(dir_path, container):
     fqp = path.join(settings.MEDIA_ROOT, container, dir_path)
+    if not path.isdir(fqp):
+        return []
     return [ path.join(path.normpath(dir_path), f) for f in os.listdir(fqp) ]
 
 def retrieve_to_file_obj(src_path, file_obj, container):
@@ -34,3 +36,11 @@ def delete_dir(dir_path, container):
 def delete_file(file_path, container):
     fqp = path.join(settings.MEDIA_ROOT, container, file_path)
     os.remove(fqp)
+
+def delete_many(file_paths, container):
+    # Local files are deleted faster one after another than in a thread pool
+    for file_path in file_paths:
+        try:
+            delete_file(file_path, container)
+        except FileNotFoundError:
+            pass
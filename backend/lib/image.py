@@ -1,4 +1,8 @@
-from PIL import ImageDraw
+import io
+import numpy as np
+from PIL import Image, ImageDraw
+
+FINGERPRINT_SIZE = (32, 24)
 
 def overlay_detections(img, detections):
     draw = ImageDraw.Draw(img)
@@ -8,3 +12,45 @@ def overlay_detections(img, detections):
         points = (x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)
         draw.line(points, fill=(0,255,0,255), width=3)
     return img
+
+
+def detections_to_boxes(detections, img_size):
+    """The boxes of the detections, compact enough to be stored, or sent to the apps to be drawn, instead of a tagged pic"""
+    return {
+        'size': list(img_size),
+        'boxes': [[round(float(d[1]), 3)] + [round(float(v), 1) for v in d[2]] for d in detections],  # confidence, xc, yc, w, h
+    }
+
+
+def boxes_to_detections(boxes):
+    return [('failure', box[0], tuple(box[1:])) for box in boxes['boxes']]
+
+
+def frame_fingerprint(pic_bytes):
+    """A tiny grayscale thumbnail of the pic, good enough to tell whether the scene has changed"""
+    img = Image.open(io.BytesIO(pic_bytes))
+    # Lets the JPEG decoder scale down as it decodes, which is a lot cheaper than decoding the full size pic
+    img.draft('L', (FINGERPRINT_SIZE[0] * 4, FINGERPRINT_SIZE[1] * 4))
+    return img.convert('L').resize(FINGERPRINT_SIZE, Image.BOX).tobytes()
+
+
+def frame_diff(fingerprint1, fingerprint2):
+    """
+    The largest difference in gray level (0 - 255) between the same cell of two fingerprints. Taking the largest
+    rather than the mean difference keeps a small, local change (e.g., a blob of spaghetti) from being averaged away.
+    """
+    if len(fingerprint1) != len(fingerprint2):
+        return 255
+    a = np.frombuffer(fingerprint1, dtype=np.uint8).astype(np.int16)
+    b = np.frombuffer(fingerprint2, dtype=np.uint8).astype(np.int16)
+    return int(np.abs(a - b).max())
+
+
+def detections_bounding_box(detections, img_size):
+    """The box around all the detections, as (x1, y1, x2, y2) in fractions of the pic width and height"""
+    img_w, img_h = img_size
+    x1 = min(d[2][0] - d[2][2] / 2 for d in detections) / img_w
+    y1 = min(d[2][1] - d[2][3] / 2 for d in detections) / img_h
+    x2 = max(d[2][0] + d[2][2] / 2 for d in detections) / img_w
+    y2 = max(d[2][1] + d[2][3] / 2 for d in detections) / img_h
+    return max(0.0, x1), max(0.0, y1), min(1.0, x2), min(1.0, y2)
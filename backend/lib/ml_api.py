@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import backoff
+import newrelic.agent
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+LOGGER = logging.getLogger(__name__)
+
+# One session per process, so that connections to ML API are kept alive and reused across detections.
+# It is created lazily so that processes forked by celery/gunicorn don't share sockets with their parent.
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session  # pylint: disable=W0603
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.ML_API_POOL_SIZE, pool_block=False)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.verify = False
+                _session = session
+    return _session
+
+
+def auth_headers():
+    return {"Authorization": "Bearer {}".format(settings.ML_API_TOKEN)} if settings.ML_API_TOKEN else {}
+
+
+def _is_client_error(e):
+    return isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code < 500
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (requests.ConnectionError, requests.Timeout, requests.HTTPError),
+    max_tries=lambda: settings.ML_API_MAX_TRIES,
+    giveup=_is_client_error,
+)
+def _request(method, path, **kwargs):
+    started_at = time.time()
+    resp = get_session().request(
+        method,
+        settings.ML_API_HOST + path,
+        timeout=(settings.ML_API_CONNECT_TIMEOUT, settings.ML_API_READ_TIMEOUT),
+        **kwargs)
+    resp.raise_for_status()
+
+    latency = time.time() - started_at
+    newrelic.agent.record_custom_metric(f'Custom/MLAPI/{method}{path}', latency)
+    LOGGER.debug(f'ML API {method} {path} took {latency:.3f}s')
+    return resp
+
+
+def detect(pic_url: Optional[str], pic_bytes: Optional[bytes] = None,
+           roi: Optional[Tuple[float, float, float, float]] = None, input_size: Optional[int] = None) -> List:
+    # roi (x1, y1, x2, y2 in fractions of the pic width and height) makes ML API detect in that region only.
+    # The detections are in full pic coordinates either way.
+    params = {}
+    if roi:
+        params['roi'] = ','.join(f'{v:.4f}' for v in roi)
+    if input_size:
+        params['input_size'] = input_size
+
+    # When ML_API_POST_PIC is on, the pic is sent in the request so that ML API doesn't have to fetch it from pic_url.
+    if settings.ML_API_POST_PIC and pic_bytes is not None:
+        headers = auth_headers()
+        headers['Content-Type'] = 'image/jpeg'
+        resp = _request('POST', '/p/', data=pic_bytes, params=params, headers=headers)
+    else:
+        params['img'] = pic_url
+        resp = _request('GET', '/p/', params=params, headers=auth_headers())
+    return resp.json()['detections']
+
+
+def detect_batch(pics_bytes: List[bytes]) -> List[List]:
+    files = [(f'pic{i}', (f'{i}.jpg', pic_bytes, 'image/jpeg')) for i, pic_bytes in enumerate(pics_bytes)]
+    resp = _request('POST', '/p/batch/', files=files, headers=auth_headers())
+    return resp.json()['detections']
+
+
+def detect_frames(frames: np.ndarray) -> List[List]:
+    # frames: [n, height, width, 3] BGR array. Sent raw, which saves encoding them as JPEGs here and decoding them in ML API.
+    frame_num, height, width, _ = frames.shape
+    headers = auth_headers()
+    headers['Content-Type'] = 'application/octet-stream'
+    resp = _request('POST', '/p/batch/', data=np.ascontiguousarray(frames).tobytes(), params={'shape': f'{frame_num},{height},{width}'}, headers=headers)
+    detections = resp.json()['detections']
+    if len(detections) != frame_num:
+        raise ValueError(f'ML API returned detections for {len(detections)} frames instead of {frame_num}')
+    return detections
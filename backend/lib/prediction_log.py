@@ -0,0 +1,129 @@
+import struct
+from typing import Iterable, List
+
+import numpy as np
+from django.conf import settings
+
+# The predictions of a print, one row per detected pic, kept column by column as fixed-width float64 arrays instead
+# of a Django-serialized PrinterPrediction per pic.
+#
+# While printing, each detection appends a row, in the order of COLUMNS, to the print's log in redis. Every
+# PREDICTION_LOG_FLUSH_ROWS rows, the rows buffered in redis are moved as they are to a chunk in storage,
+# plog/{printer}/{print}/{pic_id}.rows, named after the pic that filled the buffer. When the time-lapse is compiled, the rows of its tagged pics are written to private/{print_id}_p.plog as:
+#   header: magic, version, number of rows
+#   columns, in the order of COLUMNS: number of rows float64 each
+# so that the prediction chart is computed on whole columns at once.
+
+COLUMNS = ('timestamp', 'current_frame_num', 'lifetime_frame_num', 'current_p', 'ewm_mean', 'rolling_mean_short', 'rolling_mean_long')
+TIMESTAMP = COLUMNS.index('timestamp')  # The pic id of the detected pic
+
+MAGIC = b'TLPL'
+VERSION = 1
+HEADER = struct.Struct('<4sBI')  # magic, version, number of rows
+ROW = struct.Struct(f'<{len(COLUMNS)}d')
+
+EXTENSION = '.plog'
+ROWS_EXTENSION = '.rows'
+
+
+class PredictionLogError(Exception):
+    pass
+
+
+def pack_row(timestamp: float, prediction) -> bytes:
+    """The row of a PrinterPrediction, as appended to the log in redis"""
+    return ROW.pack(timestamp, *(getattr(prediction, c) for c in COLUMNS[1:]))
+
+
+def _scale(values, old_min, old_max, new_min, new_max):
+    return np.clip((values - old_min) * (new_max - new_min) / (old_max - old_min) + new_min, new_min, new_max)
+
+
+class PredictionLog:
+
+    def __init__(self, columns: np.ndarray):
+        self.columns = columns  # [len(COLUMNS), number of rows]
+
+    def __len__(self) -> int:
+        return self.columns.shape[1]
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[COLUMNS.index(column)]
+
+    @classmethod
+    def from_rows(cls, rows: bytes) -> 'PredictionLog':
+        """
+        The log of rows appended one after another, in the order of their timestamps. A pic detected more than once
+        keeps its last row.
+        """
+        row_num = len(rows) // ROW.size
+        columns = np.frombuffer(rows, dtype='<f8', count=row_num * len(COLUMNS)).reshape(row_num, len(COLUMNS)).T
+        order = np.argsort(columns[TIMESTAMP], kind='stable')
+        timestamps = columns[TIMESTAMP][order]
+        last_of_timestamp = np.append(timestamps[1:] != timestamps[:-1], True) if row_num else np.zeros(0, dtype=bool)
+        return cls(columns[:, order[last_of_timestamp]])
+
+    @classmethod
+    def from_predictions(cls, timestamps: Iterable[float], predictions: Iterable) -> 'PredictionLog':
+        return cls.from_rows(b''.join(pack_row(t, p) for t, p in zip(timestamps, predictions)))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'PredictionLog':
+        if len(data) < HEADER.size:
+            raise PredictionLogError('Truncated prediction log')
+        magic, version, row_num = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise PredictionLogError(f'Not a version {VERSION} prediction log')
+        if len(data) != HEADER.size + row_num * ROW.size:
+            raise PredictionLogError('Truncated prediction log')
+        return cls(np.frombuffer(data, dtype='<f8', offset=HEADER.size).reshape(len(COLUMNS), row_num))
+
+    @classmethod
+    def concat(cls, logs: List['PredictionLog']) -> 'PredictionLog':
+        return cls(np.concatenate([log.columns for log in logs], axis=1) if logs else np.zeros((len(COLUMNS), 0)))
+
+    def to_bytes(self) -> bytes:
+        return HEADER.pack(MAGIC, VERSION, len(self)) + np.ascontiguousarray(self.columns, dtype='<f8').tobytes()
+
+    def select(self, timestamps: Iterable[float]) -> 'PredictionLog':
+        """The rows of the timestamps, in their order. The rows of timestamps not in the log are NaN."""
+        timestamps = np.asarray(list(timestamps), dtype='<f8')
+        logged = self.columns[TIMESTAMP]
+        i = np.minimum(np.searchsorted(logged, timestamps), max(len(self) - 1, 0))
+        found = logged[i] == timestamps if len(self) else np.zeros(len(timestamps), dtype=bool)
+
+        columns = np.full((len(COLUMNS), len(timestamps)), np.nan)
+        columns[:, found] = self.columns[:, i[found]]
+        columns[TIMESTAMP] = timestamps
+        return PredictionLog(columns)
+
+    def num_missing(self) -> int:
+        return int(np.isnan(self['current_p']).sum())
+
+    def normalized_p(self, detective_sensitivity: float) -> np.ndarray:
+        """app.models.calc_normalized_p of every row at once. NaN for the missing rows."""
+        thresh_warning = np.clip(
+            (self['rolling_mean_short'] - self['rolling_mean_long']) * settings.ROLLING_MEAN_SHORT_MULTIPLE,
+            settings.THRESHOLD_LOW, settings.THRESHOLD_HIGH)
+        thresh_failure = thresh_warning * settings.ESCALATING_FACTOR
+
+        p = (self['ewm_mean'] - self['rolling_mean_long']) * detective_sensitivity
+
+        return np.select(
+            [p > thresh_failure, p > thresh_warning],
+            [_scale(p, thresh_failure, thresh_failure * 1.5, 2.0 / 3.0, 1.0),
+             _scale(p, thresh_warning, thresh_failure, 1.0 / 3.0, 2.0 / 3.0)],
+            _scale(p, 0, thresh_warning, 0, 1.0 / 3.0))
+
+    def to_prediction_json(self, detective_sensitivity: float) -> List[dict]:
+        """The rows in the shape of the Django-serialized predictions that the prediction json used to be made of"""
+        prediction_json = []
+        rows = zip(self.normalized_p(detective_sensitivity).tolist(), *(self[c].tolist() for c in COLUMNS[1:]))
+        for normalized_p, current_frame_num, lifetime_frame_num, *values in rows:
+            if normalized_p != normalized_p:  # NaN, the pic was not detected
+                prediction_json.append({'fields': {'normalized_p': 0.0}})
+                continue
+            fields = dict(zip(COLUMNS[3:], values), current_frame_num=int(current_frame_num), lifetime_frame_num=int(lifetime_frame_num))
+            fields['normalized_p'] = normalized_p
+            prediction_json.append({'fields': fields})
+        return prediction_json
@@ -1,9 +1,21 @@
-from django.test import TransactionTestCase
-from unittest.mock import patch
+from django.test import TransactionTestCase, SimpleTestCase, override_settings
+from unittest.mock import patch, MagicMock
+import requests
+import numpy as np
+import time
+import io
+import os
+import tempfile
 
 
-from app.models import User, HeaterTracker, Printer, Print
+from app.models import User, HeaterTracker, Printer, Print, PrinterPrediction, calc_normalized_p
 from .heater_trackers import process_heater_temps
+from . import ml_api
+from .utils import ordered_imap
+from . import file_storage
+from . import channels
+from .frame_archive import ChunkWriter, PrintFrames, RAW, TAGGED, PREDICTION, iter_records, read_index, read_record
+from .prediction_log import PredictionLog, PredictionLogError, pack_row
 
 
 class HeaterTrackerTestCase(TransactionTestCase):
@@ -225,3 +237,279 @@ class HeaterTrackerTestCase(TransactionTestCase):
 
         self.assertEqual(print.PrintHeaterTarget_set.first().name, 'h0')
         self.assertEqual(print.PrintHeaterTarget_set.first().target, 60.0)
+
+
+@override_settings(ML_API_HOST='http://ml_api:3333', ML_API_TOKEN=None, ML_API_MAX_TRIES=3)
+@patch('lib.ml_api.get_session')
+class MLAPIClientTestCase(SimpleTestCase):
+
+    def resp(self, status_code=200, detections=None):
+        resp = MagicMock(status_code=status_code)
+        resp.json.return_value = {'detections': detections or []}
+        if status_code >= 400:
+            resp.raise_for_status.side_effect = requests.HTTPError(response=resp)
+        return resp
+
+    @override_settings(ML_API_POST_PIC=False)
+    def test_detect_by_url(self, get_session):
+        get_session.return_value.request.return_value = self.resp(detections=[['failure', 0.5, [1, 2, 3, 4]]])
+
+        self.assertEqual(ml_api.detect('http://pic.jpg', b'jpg'), [['failure', 0.5, [1, 2, 3, 4]]])
+        args, kwargs = get_session.return_value.request.call_args
+        self.assertEqual(args, ('GET', 'http://ml_api:3333/p/'))
+        self.assertEqual(kwargs['params'], {'img': 'http://pic.jpg'})
+
+    @override_settings(ML_API_POST_PIC=True)
+    def test_detect_by_posting_pic(self, get_session):
+        get_session.return_value.request.return_value = self.resp()
+
+        ml_api.detect('http://pic.jpg', b'jpg')
+        args, kwargs = get_session.return_value.request.call_args
+        self.assertEqual(args, ('POST', 'http://ml_api:3333/p/'))
+        self.assertEqual(kwargs['data'], b'jpg')
+
+    def test_detect_frames(self, get_session):
+        get_session.return_value.request.return_value = self.resp(detections=[[], [['failure', 0.5, [1, 2, 3, 4]]]])
+        frames = np.zeros((2, 4, 6, 3), dtype=np.uint8)
+
+        self.assertEqual(ml_api.detect_frames(frames), [[], [['failure', 0.5, [1, 2, 3, 4]]]])
+        args, kwargs = get_session.return_value.request.call_args
+        self.assertEqual(args, ('POST', 'http://ml_api:3333/p/batch/'))
+        self.assertEqual(kwargs['params'], {'shape': '2,4,6'})
+        self.assertEqual(kwargs['headers']['Content-Type'], 'application/octet-stream')
+        self.assertEqual(len(kwargs['data']), 2 * 4 * 6 * 3)
+
+    def test_detect_frames_with_missing_results(self, get_session):
+        get_session.return_value.request.return_value = self.resp(detections=[[]])
+
+        with self.assertRaises(ValueError):
+            ml_api.detect_frames(np.zeros((2, 4, 6, 3), dtype=np.uint8))
+
+    @patch('time.sleep')
+    def test_retry_on_connection_error_and_server_error(self, sleep, get_session):
+        get_session.return_value.request.side_effect = [requests.ConnectionError(), self.resp(status_code=503), self.resp()]
+
+        self.assertEqual(ml_api.detect('http://pic.jpg'), [])
+        self.assertEqual(get_session.return_value.request.call_count, 3)
+
+    @patch('time.sleep')
+    def test_no_retry_on_client_error(self, sleep, get_session):
+        get_session.return_value.request.return_value = self.resp(status_code=401)
+
+        with self.assertRaises(requests.HTTPError):
+            ml_api.detect('http://pic.jpg')
+        self.assertEqual(get_session.return_value.request.call_count, 1)
+
+
+class OrderedImapTestCase(SimpleTestCase):
+
+    def test_results_in_order(self):
+        def slow_for_small(i):
+            time.sleep(0.01 * (5 - i % 5))
+            return i * 2
+
+        self.assertEqual(list(ordered_imap(slow_for_small, range(20), 4)), [i * 2 for i in range(20)])
+
+    def test_takes_items_ahead_boundedly(self):
+        taken = []
+
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+
+        for n, _ in enumerate(ordered_imap(lambda i: i, items(), 2)):
+            self.assertLessEqual(len(taken) - n, 4)
+
+    def test_error_is_raised_in_order(self):
+        def fail_on_3(i):
+            if i == 3:
+                raise ValueError()
+            return i
+
+        results = []
+        with self.assertRaises(ValueError):
+            for r in ordered_imap(fail_on_3, range(10), 2):
+                results.append(r)
+        self.assertEqual(results, [0, 1, 2])
+
+
+class MediaRootTestCase(SimpleTestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name, INTERNAL_MEDIA_HOST='http://internal')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        build_full_url = patch('lib.site.build_full_url', side_effect=lambda uri: 'http://external' + uri)
+        build_full_url.start()
+        self.addCleanup(build_full_url.stop)
+
+
+class BulkFileStorageTestCase(MediaRootTestCase):
+
+    def test_save_and_retrieve_many(self):
+        urls = file_storage.save_many(
+            [(f'raw/1/2/{i}.jpg', io.BytesIO(str(i).encode())) for i in range(20)], 'pics', long_term_storage=False)
+        self.assertEqual([internal for internal, _ in urls], [f'http://internal/media/pics/raw/1/2/{i}.jpg' for i in range(20)])
+
+        with tempfile.TemporaryDirectory() as to_dir:
+            local_paths = file_storage.retrieve_many(
+                [f'raw/1/2/{i}.jpg' for i in range(20)] + ['raw/1/2/missing.jpg'], to_dir, 'pics', long_term_storage=False)
+            self.assertEqual(local_paths[0], os.path.join(to_dir, 'raw/1/2/0.jpg'))
+            contents = []
+            for local_path in local_paths:
+                with open(local_path, 'rb') as f:
+                    contents.append(f.read())
+        self.assertEqual(contents, [str(i).encode() for i in range(20)] + [b''])
+
+    def test_delete_many(self):
+        file_storage.save_many([(f'p/1/2/{i}.json', io.BytesIO(b'[]')) for i in range(3)], 'pics', long_term_storage=False)
+
+        file_storage.delete_many(['p/1/2/0.json', 'p/1/2/2.json', 'p/1/2/missing.json'], 'pics', long_term_storage=False)
+
+        self.assertEqual(file_storage.list_dir('p/1/2/', 'pics', long_term_storage=False), ['p/1/2/1.json'])
+
+    @patch('lib.file_storage.st_file_storage')
+    def test_native_bulk_operation_is_preferred(self, st_file_storage):
+        file_storage.delete_many(['a.jpg', 'b.jpg'], 'pics', long_term_storage=False)
+
+        st_file_storage.delete_many.assert_called_once_with(['a.jpg', 'b.jpg'], 'pics')
+        st_file_storage.delete_file.assert_not_called()
+
+
+class FrameArchiveTestCase(MediaRootTestCase):
+
+    def save_frame(self, pic_id, tagged=True):
+        file_storage.save_file_obj(f'raw/1/2/{pic_id}.jpg', io.BytesIO(f'raw {pic_id}'.encode()), 'tsd-pics', long_term_storage=False)
+        if tagged:
+            file_storage.save_file_obj(f'tagged/1/2/{pic_id}.jpg', io.BytesIO(f'tagged {pic_id}'.encode()), 'tsd-pics', long_term_storage=False)
+            file_storage.save_file_obj(f'p/1/2/{pic_id}.json', io.BytesIO(f'[{pic_id}]'.encode()), 'tsd-pics', long_term_storage=False)
+
+    def test_chunk_reads(self):
+        chunk_file = io.BytesIO()
+        writer = ChunkWriter(chunk_file)
+        writer.add(2.5, RAW, b'raw 2.5')
+        writer.add(1.5, TAGGED, b'tagged 1.5')
+        writer.add(2.5, PREDICTION, b'')
+        writer.close()
+
+        self.assertEqual(list(iter_records(chunk_file)), [(2.5, RAW, b'raw 2.5'), (1.5, TAGGED, b'tagged 1.5'), (2.5, PREDICTION, b'')])
+        self.assertEqual(list(iter_records(chunk_file, [TAGGED])), [(1.5, TAGGED, b'tagged 1.5')])
+        index = read_index(chunk_file)
+        self.assertEqual(read_record(chunk_file, index, 1.5, TAGGED), b'tagged 1.5')
+        self.assertIsNone(read_record(chunk_file, index, 1.5, RAW))
+
+    @override_settings(PICS_CONTAINER='tsd-pics')
+    def test_packed_frames_are_read_back(self):
+        pic_ids = [1000.0 + i + 0.25 for i in range(11)]
+        for i, pic_id in enumerate(pic_ids):
+            self.save_frame(pic_id, tagged=i % 3 != 0)
+        frames = PrintFrames(1, 2)
+
+        self.assertEqual(frames.pack(until_pic_id=pic_ids[-1], frames_per_chunk=4), 8)
+
+        self.assertEqual([pic_id for pic_id, _ in frames.chunks()], [pic_ids[3], pic_ids[7]])
+        self.assertEqual(len(frames.loose_pics(RAW)), 3)
+        self.assertEqual(frames.get(pic_ids[5], TAGGED), f'tagged {pic_ids[5]}'.encode())
+        self.assertEqual(frames.get(pic_ids[9], RAW), f'raw {pic_ids[9]}'.encode())
+        self.assertIsNone(frames.get(pic_ids[6], TAGGED))
+        self.assertEqual(frames.last_pic_id(), pic_ids[-1])
+
+        with tempfile.TemporaryDirectory() as to_dir:
+            extracted = frames.extract((RAW, PREDICTION), to_dir)
+            self.assertEqual([float(p.stem) for p in extracted[RAW]], pic_ids)
+            self.assertEqual([float(p.stem) for p in extracted[PREDICTION]], [pic_id for i, pic_id in enumerate(pic_ids) if i % 3 != 0])
+            self.assertEqual(extracted[RAW][2].read_bytes(), f'raw {pic_ids[2]}'.encode())
+
+    @override_settings(PICS_CONTAINER='tsd-pics')
+    def test_last_pic_is_left_loose(self):
+        for i in range(4):
+            self.save_frame(1000.0 + i)
+
+        self.assertEqual(PrintFrames(1, 2).pack(until_pic_id=2000.0, frames_per_chunk=2), 2)
+        self.assertEqual(PrintFrames(1, 2).loose_pics(RAW), ['raw/1/2/1002.0.jpg', 'raw/1/2/1003.0.jpg'])
+
+
+class PredictionLogTestCase(SimpleTestCase):
+
+    def prediction(self, i):
+        return PrinterPrediction(
+            current_frame_num=i, lifetime_frame_num=100 + i, current_p=i / 10.0, ewm_mean=i / 20.0,
+            rolling_mean_short=i / 40.0, rolling_mean_long=(10 - i) / 80.0)
+
+    def test_rows_are_sorted_and_deduped(self):
+        rows = pack_row(3.5, self.prediction(3)) + pack_row(1.5, self.prediction(1)) + pack_row(3.5, self.prediction(4))
+        log = PredictionLog.from_rows(rows)
+
+        self.assertEqual(log['timestamp'].tolist(), [1.5, 3.5])
+        self.assertEqual(log['current_frame_num'].tolist(), [1, 4])
+
+    def test_select_and_round_trip(self):
+        log = PredictionLog.from_predictions([1.5, 2.5, 3.5], [self.prediction(i) for i in range(3)])
+        selected = PredictionLog.from_bytes(log.select([3.5, 0.5, 1.5]).to_bytes())
+
+        self.assertEqual(selected['timestamp'].tolist(), [3.5, 0.5, 1.5])
+        self.assertEqual(selected['current_p'][[0, 2]].tolist(), [0.2, 0.0])
+        self.assertEqual(selected.num_missing(), 1)
+        self.assertEqual(selected.to_prediction_json(1.0)[1], {'fields': {'normalized_p': 0.0}})
+        with self.assertRaises(PredictionLogError):
+            PredictionLog.from_bytes(log.to_bytes()[:-1])
+
+    def test_normalized_p_matches_calc_normalized_p(self):
+        predictions = [self.prediction(i) for i in range(11)]
+        log = PredictionLog.from_predictions(range(11), predictions)
+
+        for detective_sensitivity in (0.8, 1.0, 3.0):
+            prediction_json = log.to_prediction_json(detective_sensitivity)
+            for pred, normalized_p, raw_pred in zip(predictions, log.normalized_p(detective_sensitivity), prediction_json):
+                self.assertAlmostEqual(normalized_p, calc_normalized_p(detective_sensitivity, pred))
+                self.assertEqual(raw_pred['fields']['lifetime_frame_num'], pred.lifetime_frame_num)
+
+
+class StatusPushTestCase(SimpleTestCase):
+
+    @override_settings(PRINTER_STATUS_PUSH_MIN_SECS=0.5)
+    @patch('config.celery.celery_app')
+    @patch('lib.channels.push_status_to_web')
+    @patch('lib.cache.rate_limit_pass')
+    def test_updates_are_coalesced(self, rate_limit_pass, push_status_to_web, celery_app):
+        passed = set()
+        rate_limit_pass.side_effect = lambda key, interval_secs: key not in passed and not passed.add(key)
+
+        for _ in range(5):
+            channels.send_status_to_web(1)
+
+        push_status_to_web.assert_called_once_with(1)
+        celery_app.send_task.assert_called_once_with('app.tasks.push_held_back_status_to_web', args=[1], countdown=0.5)
+
+
+class StatusPushPayloadTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="a@test")
+        self.printer = Printer.objects.create(user=self.user)
+
+    @patch('lib.channels.get_channel_layer')
+    @patch('lib.channels.num_ws_connections')
+    def test_payload_is_only_serialized_for_viewers(self, num_ws_connections, get_channel_layer):
+        sent = []
+
+        async def group_send(group_name, msg_dict):
+            sent.append(msg_dict)
+        get_channel_layer.return_value.group_send = group_send
+
+        connections = {channels.web_group_name(self.printer.id): 0, channels.shared_web_group_name(self.printer.id): 0}
+        num_ws_connections.side_effect = connections.get
+
+        channels.push_status_to_web(self.printer.id)
+        self.assertEqual(sent, [])
+
+        connections[channels.web_group_name(self.printer.id)] = 1
+        channels.push_status_to_web(self.printer.id)
+        self.assertEqual(set(sent[-1].keys()), {'type', 'printer'})
+
+        connections[channels.shared_web_group_name(self.printer.id)] = 1
+        channels.push_status_to_web(self.printer.id)
+        self.assertEqual(set(sent[-1].keys()), {'type', 'printer', 'public_printer'})
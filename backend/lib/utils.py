@@ -7,6 +7,8 @@ import io
 import re
 import shutil
 from operator import itemgetter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from django.utils import timezone
 import pytz
 from datetime import timedelta
@@ -14,13 +16,47 @@ from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 import backoff
 
-from lib.file_storage import list_dir, retrieve_to_file_obj, save_file_obj
+from lib.file_storage import retrieve_to_file_obj, save_file_obj
 
 # Return dict if not empty, otherwise None.
 def dict_or_none(dict_value):
     return dict_value if dict_value else None
 
 
+def parse_roi(roi_str):
+    """
+    "x1,y1,x2,y2", in fractions of the image width and height, to a tuple. None if blank.
+    Raises ValueError if it's not a non-empty region within the image.
+    """
+    if not roi_str:
+        return None
+    roi = tuple(float(v) for v in roi_str.split(','))
+    if len(roi) != 4 or not (0 <= roi[0] < roi[2] <= 1 and 0 <= roi[1] < roi[3] <= 1):
+        raise ValueError(f'Invalid region of interest: {roi_str}')
+    return roi
+
+
+def ordered_imap(fn, iterable, max_workers):
+    """
+    Like map(fn, iterable), with fn running on up to max_workers items at a time in a thread pool, while the results
+    are still yielded in the order of the items. At most 2 x max_workers items are taken ahead of the one being waited for,
+    so that a slow consumer doesn't make the results pile up.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        try:
+            for item in iterable:
+                in_flight.append(executor.submit(fn, item))
+                if len(in_flight) >= max_workers * 2:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # When the consumer gives up, e.g. on an error, the items not started yet are dropped
+            for future in in_flight:
+                future.cancel()
+
+
 def set_as_str_if_present(target_dict, source_dict, key, target_key=None):
     if key in source_dict:
         if not target_key:
@@ -28,10 +64,6 @@ def set_as_str_if_present(target_dict, source_dict, key, target_key=None):
         target_dict[target_key] = json.dumps(source_dict.get(key))
 
 
-def ml_api_auth_headers():
-    return {"Authorization": "Bearer {}".format(settings.ML_API_TOKEN)} if settings.ML_API_TOKEN else {}
-
-
 def orientation_to_ffmpeg_options(printer_settings):
     options = '-vf pad=ceil(iw/2)*2:ceil(ih/2)*2'
 
@@ -70,14 +102,6 @@ def shortform_localtime(seconds_from_now, tz):
 
 ## util functions for pictures
 
-def last_pic_of_print(_print, path_prefix):
-    print_pics = list_dir(f'{path_prefix}/{_print.printer.id}/{_print.id}/', settings.PICS_CONTAINER, long_term_storage=False)
-    if not print_pics:
-        return None
-    print_pics.sort()
-    return print_pics[-1]
-
-
 def copy_pic(input_path, dest_jpg_path, rotated=False, printer_settings=None, to_container=settings.PICS_CONTAINER, to_long_term_storage=True):
     if not input_path:
         return None
@@ -0,0 +1,84 @@
+import json
+import subprocess
+from typing import Iterator, Tuple
+
+import numpy as np
+
+
+def probe_video(video_path: str) -> Tuple[int, int, int]:
+    """
+    Width, height and number of frames of the first video stream. The number of frames comes from the container, or
+    else from its duration, rather than from ffprobe's -count_frames, which decodes the whole video to count them.
+    """
+    ffprobe_cmd = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=width,height,nb_frames,avg_frame_rate,duration:format=duration', '-of', 'json', video_path],
+        stdout=subprocess.PIPE, check=True)
+    probed = json.loads(ffprobe_cmd.stdout)
+    stream = probed['streams'][0]
+
+    frame_num = int(stream.get('nb_frames', 0) or 0)
+    if not frame_num:
+        num, den = stream['avg_frame_rate'].split('/')
+        duration = stream.get('duration') or probed.get('format', {}).get('duration')
+        frame_num = int(float(duration) * int(num) / max(int(den), 1))
+
+    return int(stream['width']), int(stream['height']), frame_num
+
+
+def read_frame_batches(video_path: str, width: int, height: int, fps: float, batch_size: int) -> Iterator[np.ndarray]:
+    """
+    Decodes the video once, resampled to fps, and yields its frames as [n <= batch_size, height, width, 3] BGR arrays,
+    straight from ffmpeg's output without going through image files. The arrays are read-only.
+    """
+    frame_size = width * height * 3
+    decoder = subprocess.Popen(
+        ['ffmpeg', '-v', 'error', '-i', video_path, '-vf', f'fps={fps},scale={width}:{height}', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'],
+        stdout=subprocess.PIPE)
+    try:
+        while True:
+            buf = decoder.stdout.read(frame_size * batch_size)
+            frame_num = len(buf) // frame_size
+            if frame_num == 0:
+                break
+            yield np.frombuffer(buf, dtype=np.uint8, count=frame_num * frame_size).reshape(frame_num, height, width, 3)
+    finally:
+        # Also stops ffmpeg if the batches are not read to the end
+        decoder.stdout.close()
+        returncode = decoder.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, decoder.args)
+
+
+class VideoWriter:
+    """Encodes raw BGR frames of width x height into an H.264 mp4 as they are written, through ffmpeg's stdin"""
+
+    def __init__(self, video_path: str, width: int, height: int, fps: float = 30):
+        self.encoder = subprocess.Popen(
+            ['ffmpeg', '-y', '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+             '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', video_path],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame) -> None:
+        self.encoder.stdin.write(frame)
+
+    def close(self) -> None:
+        self.encoder.stdin.close()
+        returncode = self.encoder.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.encoder.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.encoder.kill()
+            try:
+                self.encoder.stdin.close()
+            except OSError:  # Unflushed frames can't be written anymore
+                pass
+            self.encoder.wait()
+            return
+        self.close()
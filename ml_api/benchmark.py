@@ -0,0 +1,187 @@
+#!python3
+# Runs a fixed corpus of images/videos through every available backend, at each batch size and thread count, and
+# reports latency percentiles, throughput, peak RSS, startup and warm-up time, and how well the detections agree with
+# the reference backend (the first one), as JSON.
+#
+# Every configuration runs in a process of its own, so that its startup time and peak RSS are not skewed by the others.
+#
+#   python benchmark.py path/to/snapshots/ path/to/timelapse.mp4 --batch-sizes 1,4,8 --threads 1,4 --output bench.json
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from lib.geometry import Detection, compare_detections, best_ious
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model')
+
+BACKENDS = {
+    'darknet': 'model-weights.darknet',
+    'onnx': 'model-weights.onnx',
+    'onnx-int8': 'model-weights.int8.onnx',
+    'onnx-fp16': 'model-weights.fp16.onnx',
+}
+
+
+def comma_separated_ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def percentiles_ms(secs):
+    p50, p95, p99 = np.percentile(secs, [50, 95, 99]) * 1000
+    return dict(p50=round(p50, 2), p95=round(p95, 2), p99=round(p99, 2), mean=round(np.mean(secs) * 1000, 2))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def run_config(opt):
+    """Runs in a process of its own. The thread and batch size env vars are set by the parent before the nets are imported."""
+    from lib.detection_model import load_net, detect_batch
+    from compare_models import iter_frames
+
+    frames = list(itertools.islice((image for _, image in iter_frames(opt.inputs)), opt.max_frames))
+    frames_rss_mb = peak_rss_mb()
+
+    started_at = time.perf_counter()
+    net = load_net("model/model.cfg", "model/model.meta", weights_path=opt.weights, use_gpu=opt.gpu)
+    startup_secs = time.perf_counter() - started_at
+
+    batches = [frames[i:i + opt.batch_size] for i in range(0, len(frames), opt.batch_size)]
+    started_at = time.perf_counter()
+    detect_batch(net, batches[0], thresh=opt.det_threshold, nms=opt.nms_threshold)
+    warmup_secs = time.perf_counter() - started_at
+
+    detections = []
+    batch_secs = []
+    for _ in range(opt.repeat):
+        detections = []
+        for batch in batches:
+            started_at = time.perf_counter()
+            detections += detect_batch(net, batch, thresh=opt.det_threshold, nms=opt.nms_threshold)
+            batch_secs.append(time.perf_counter() - started_at)
+
+    return dict(
+        startup_secs=round(startup_secs, 3),
+        warmup_secs=round(warmup_secs, 3),
+        batch_latency_ms=percentiles_ms(batch_secs),
+        image_latency_ms=percentiles_ms([secs / len(batch) for secs, batch in zip(batch_secs, batches * opt.repeat)]),
+        throughput_fps=round(len(frames) * opt.repeat / sum(batch_secs), 2),
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        frames_rss_mb=round(frames_rss_mb, 1),
+        frames=len(frames),
+        detections=[[(name, float(conf), tuple(float(v) for v in box)) for name, conf, box in d] for d in detections],
+    )
+
+
+def spawn_config(opt, backend, weights, batch_size, threads):
+    env = dict(
+        os.environ,
+        ML_API_ORT_INTRA_OP_THREADS=str(threads),
+        OMP_NUM_THREADS=str(threads),  # darknet CPU
+        ML_API_MAX_BATCH_SIZE=str(batch_size),  # the batch size darknet nets are loaded with
+    )
+    with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+        args = [
+            sys.executable, os.path.realpath(__file__), *opt.inputs,
+            '--run-config', result_file.name, '--weights', weights, '--batch-size', str(batch_size),
+            '--max-frames', str(opt.max_frames), '--repeat', str(opt.repeat),
+            '--det-threshold', str(opt.det_threshold), '--nms-threshold', str(opt.nms_threshold),
+        ] + (['--gpu'] if opt.gpu else [])
+        # The nets print a lot while they load. Keep it out of the JSON report on stdout.
+        proc = subprocess.run(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.realpath(__file__)))
+        config = dict(backend=backend, weights=weights, batch_size=batch_size, threads=threads)
+        if proc.returncode != 0:
+            output = proc.stdout.decode(errors='replace').strip().splitlines()
+            return dict(config, error=output[-1] if output else f'Exited with {proc.returncode}')
+        with open(result_file.name) as f:
+            return dict(config, **json.load(f))
+
+
+def agreement(reference, result, iou_threshold):
+    expected = [Detection.from_tuple_list(d) for d in reference['detections']]
+    actual = [Detection.from_tuple_list(d) for d in result['detections']]
+    ious = [iou for e, a in zip(expected, actual) for iou in best_ious(e, a) + best_ious(a, e)]
+    return dict(
+        agreement=round(sum(compare_detections(e, a, iou_threshold) for e, a in zip(expected, actual)) / len(expected), 4),
+        mean_iou=round(float(np.mean(ious)), 4) if ious else 1.0,
+    )
+
+
+def environment():
+    env = dict(python=platform.python_version(), platform=platform.platform(), processor=platform.processor(), cpus=os.cpu_count())
+    try:
+        import onnxruntime
+        env['onnxruntime'] = onnxruntime.__version__
+    except ImportError:
+        pass
+    return env
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", type=str, nargs='+', help="Image files, video files, or directories of them")
+    parser.add_argument("--backends", type=str, default=','.join(BACKENDS.keys()),
+                        help=f"Comma separated, the first one being the reference. Those without weights in {MODEL_DIR} are skipped")
+    parser.add_argument("--batch-sizes", type=comma_separated_ints, default=[1], help="Comma separated batch sizes")
+    parser.add_argument("--threads", type=comma_separated_ints, default=[os.cpu_count() or 1], help="Comma separated CPU thread counts")
+    parser.add_argument("--gpu", action='store_true', help="Run the nets on GPU instead of CPU")
+    parser.add_argument("--max-frames", type=int, default=200, help="Max number of frames of the corpus to use")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of timed passes over the corpus")
+    parser.add_argument("--det-threshold", type=float, default=0.25, help="Detection threshold")
+    parser.add_argument("--nms-threshold", type=float, default=0.4, help="NMS threshold")
+    parser.add_argument("--iou-threshold", type=float, default=0.4, help="IoU for two detections to be considered the same")
+    parser.add_argument("--save-detections", action='store_true', help="Include the detections of every frame in the report")
+    parser.add_argument("--output", type=str, help="Write the report to this file instead of stdout")
+    parser.add_argument("--run-config", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--weights", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--batch-size", type=int, help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+
+    if opt.run_config:
+        result = run_config(opt)
+        with open(opt.run_config, 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    results = []
+    for backend in opt.backends.split(','):
+        weights = os.path.join(MODEL_DIR, BACKENDS[backend])
+        if not os.path.exists(weights):
+            print(f'Skipping {backend}: {weights} not found', file=sys.stderr)
+            continue
+        for batch_size in opt.batch_sizes:
+            for threads in opt.threads:
+                print(f'Running {backend} batch_size={batch_size} threads={threads}', file=sys.stderr)
+                results.append(spawn_config(opt, backend, weights, batch_size, threads))
+
+    succeeded = [r for r in results if 'error' not in r]
+    if not succeeded:
+        sys.exit('No backend could be run')
+
+    reference = succeeded[0]
+    for result in succeeded:
+        result.update(agreement(reference, result, opt.iou_threshold))
+    if not opt.save_detections:
+        for result in succeeded:
+            del result['detections']
+
+    report = dict(
+        environment=environment(),
+        corpus=dict(inputs=opt.inputs, frames=reference['frames'], repeat=opt.repeat),
+        reference=dict(backend=reference['backend'], batch_size=reference['batch_size'], threads=reference['threads']),
+        results=results,
+    )
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
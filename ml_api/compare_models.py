@@ -0,0 +1,101 @@
+#!python3
+# Runs a set of reference images/videos through two models, e.g. the full precision model and its quantized variant,
+# and reports how well their detections agree and how much faster the candidate is.
+# Exits with 1 if the candidate agrees with the reference on less than --min-agreement of the frames.
+#
+#   python compare_models.py model/model-weights.onnx model/model-weights.int8.onnx path/to/snapshots/ path/to/timelapse.mp4
+import argparse
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+from detect import KNOWN_IMAGE_EXTENSIONS, KNOWN_VIDEO_EXTENSIONS
+from lib.detection_model import load_net, detect
+from lib.geometry import Detection, compare_detections, best_ious
+
+
+def iter_frames(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            yield from iter_frames(sorted(os.path.join(p, f) for f in os.listdir(p)))
+            continue
+
+        extension = os.path.splitext(p)[1]
+        if extension in KNOWN_IMAGE_EXTENSIONS:
+            image = cv2.imread(p)
+            if image is not None:
+                yield p, image
+        elif extension in KNOWN_VIDEO_EXTENSIONS:
+            cap = cv2.VideoCapture(p)
+            frame_number = 0
+            reading_success, image = cap.read()
+            while reading_success:
+                yield f'{p}#{frame_number:04}', image
+                frame_number += 1
+                reading_success, image = cap.read()
+
+
+def timed_detect(net, image, opt):
+    started_at = time.perf_counter()
+    detections = detect(net, image, thresh=opt.det_threshold, nms=opt.nms_threshold)
+    return Detection.from_tuple_list(detections), time.perf_counter() - started_at
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("reference", type=str, help="Reference model weights file")
+    parser.add_argument("candidate", type=str, help="Candidate model weights file")
+    parser.add_argument("inputs", type=str, nargs='+', help="Image files, video files, or directories of them")
+    parser.add_argument("--det-threshold", type=float, default=0.25, help="Detection threshold")
+    parser.add_argument("--nms-threshold", type=float, default=0.4, help="NMS threshold")
+    parser.add_argument("--iou-threshold", type=float, default=0.4, help="IoU for two detections to be considered the same")
+    parser.add_argument("--min-agreement", type=float, default=0.98, help="Min fraction of frames where the detections must agree")
+    parser.add_argument("--print", action='store_true', help="Print the frames where the detections differ")
+    opt = parser.parse_args()
+
+    reference = load_net("model/model.cfg", "model/model.meta", weights_path=opt.reference)
+    candidate = load_net("model/model.cfg", "model/model.meta", weights_path=opt.candidate)
+
+    frames = agreed = 0
+    ious = []
+    reference_secs = []
+    candidate_secs = []
+    for frame_name, image in iter_frames(opt.inputs):
+        if frames == 0:
+            # The first runs initialize the nets. Keep them out of the timings.
+            detect(reference, image)
+            detect(candidate, image)
+
+        # Whichever model runs first on a frame pays for the cold caches. Take turns.
+        if frames % 2 == 0:
+            expected, secs = timed_detect(reference, image, opt)
+            reference_secs.append(secs)
+            actual, secs = timed_detect(candidate, image, opt)
+            candidate_secs.append(secs)
+        else:
+            actual, secs = timed_detect(candidate, image, opt)
+            candidate_secs.append(secs)
+            expected, secs = timed_detect(reference, image, opt)
+            reference_secs.append(secs)
+
+        frames += 1
+        ious += best_ious(expected, actual) + best_ious(actual, expected)
+        if compare_detections(expected, actual, opt.iou_threshold):
+            agreed += 1
+        elif opt.print:
+            print(f'{frame_name}: {len(expected)} reference detections, {len(actual)} candidate detections')
+
+    if frames == 0:
+        sys.exit('No images or videos found in the inputs')
+
+    agreement = agreed / frames
+    print(f'Frames: {frames}')
+    print(f'Agreement: {agreement:.2%} of frames with the same detections (IoU >= {opt.iou_threshold})')
+    print(f'Mean IoU of every detection with its best match: {np.mean(ious) if ious else 1.0:.3f}')
+    print(f'Reference: {np.mean(reference_secs) * 1000:.1f} ms/frame')
+    print(f'Candidate: {np.mean(candidate_secs) * 1000:.1f} ms/frame')
+    print(f'Speedup: {np.mean(reference_secs) / np.mean(candidate_secs):.2f}x')
+
+    sys.exit(0 if agreement >= opt.min_agreement else 1)
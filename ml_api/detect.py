@@ -18,18 +18,14 @@ if __name__ == "__main__":
     parser.add_argument("--det-threshold", type=float, default=0.25, help="Detection threshold")
     parser.add_argument("--nms-threshold", type=float, default=0.4, help="NMS threshold")
     parser.add_argument("--preheat", action='store_true', help="Make a dry run of NN for initlalization")
-    parser.add_argument("--cpu", action='store_true', help="Force use CPU")
+    parser.add_argument("--cpu", action='store_true', help="Force use CPU. Only with --weights")
     parser.add_argument("--save-detections-to", type=str, help="Save detections into this file")
     parser.add_argument("--compare-detections-with", type=str, help="Load detections from this file and compare with result")
     parser.add_argument("--render-to", type=str, help="Save detections into this file or directory")
     parser.add_argument("--print", action='store_true', help="Print detections")
     opt = parser.parse_args()
 
-    net_main_1 = load_net("model/model.cfg", "model/model.meta", weights_path=opt.weights)
-
-    # force use CPU, only implemented for ONNX
-    if opt.cpu and onnx_ready and isinstance(net_main_1, OnnxNet):
-        net_main_1.force_cpu()
+    net_main_1 = load_net("model/model.cfg", "model/model.meta", weights_path=opt.weights, use_gpu=False if opt.cpu and opt.weights else None)
 
     filename = os.path.basename(opt.image)
     filename, extension = os.path.splitext(filename)
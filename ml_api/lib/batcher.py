@@ -0,0 +1,72 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+def next_batch(q, max_batch_size: int, max_wait_secs: float) -> List[Any]:
+    """
+    Blocks until the first item arrives on `q`, then takes more until there are `max_batch_size` items,
+    or `max_wait_secs` passed. Works with both queue.Queue and multiprocessing.Queue.
+    """
+    batch = [q.get()]
+    deadline = time.monotonic() + max_wait_secs
+    while len(batch) < max_batch_size:
+        timeout = deadline - time.monotonic()
+        try:
+            if timeout > 0:
+                batch.append(q.get(timeout=timeout))
+            else:
+                batch.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+class MicroBatcher:
+    """
+    Groups items submitted concurrently from many request threads into batches, and hands them
+    to `process_batch` on a single worker thread. The worker thread is the only one that touches the net.
+
+    A batch is closed when it reaches `max_batch_size` items, or `max_wait_ms` after its first item arrived.
+    With max_wait_ms = 0 the batcher never waits: it takes whatever queued up while the previous batch was running.
+
+    If `process_batch` raises on a batch, its items are retried one at a time, so that only the items that still raise fail.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait_ms: float = 0.0):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_secs = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [(item, future) for (item, future) in next_batch(self._queue, self.max_batch_size, self.max_wait_secs) if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                results = self.process_batch([item for (item, _) in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # Don't let one bad item fail the unrelated requests batched with it
+                for (item, future) in batch:
+                    try:
+                        future.set_result(self.process_batch([item])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -4,8 +4,11 @@ import random
 import os
 import cv2
 import platform
+import numpy as np
 from typing import List, Tuple
 
+from lib.preprocess import Preprocessor
+
 # C-structures from Darknet lib
 
 class BOX(Structure):
@@ -41,12 +44,17 @@ class METADATA(Structure):
     _fields_ = [("classes", c_int),
                 ("names", POINTER(c_char_p))]
 
+
+class DETNUMPAIR(Structure):
+    _fields_ = [("num", c_int),
+                ("dets", POINTER(DETECTION))]
+
 class YoloNet:
     """Darknet-based detector implementation"""
     net: c_void_p
     meta: METADATA
 
-    def __init__(self, weight_path: str, meta_path: str, config_path: str, asked_to_use_gpu: bool):
+    def __init__(self, weight_path: str, meta_path: str, config_path: str, asked_to_use_gpu: bool, max_batch_size: int = 1):
         if not os.path.exists(config_path):
             raise ValueError("Invalid config path `"+os.path.abspath(config_path)+"`")
         if not os.path.exists(weight_path):
@@ -59,66 +67,74 @@ class YoloNet:
         if asked_to_use_gpu and not using_gpu:
             raise Exception('I respectfully decline to load the net as I am asked to use GPU but the loaded darknet module does NOT have GPU support')
 
-        self.net = load_net_custom(config_path.encode("ascii"), weight_path.encode("ascii"), 0, 1)  # batch size = 1
+        self.max_batch_size = max(1, max_batch_size)
+        self.net = load_net_custom(config_path.encode("ascii"), weight_path.encode("ascii"), 0, self.max_batch_size)
+        self.batch_size = self.max_batch_size
         self.meta = load_meta(meta_path.encode("ascii"))
+        self.preprocess = Preprocessor(network_width(self.net), network_height(self.net), self.max_batch_size)
 
     def detect(self, meta, image, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
-        #pylint: disable= C0321
-        custom_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        im, arr = array_to_image(custom_image)             # you should comment line below: free_image(im)
-        if debug:
-            print("Loaded image")
-        num = c_int(0)
-        if debug:
-            print("Assigned num")
-        pnum = pointer(num)
-        if debug:
-            print("Assigned pnum")
-        predict_image(self.net, im)
-        if debug:
-            print("did prediction")
-        dets = get_network_boxes(self.net, custom_image.shape[1], custom_image.shape[0], thresh, hier_thresh, None, 0, pnum, 0)  # OpenCV
-        if debug:
-            print("Got dets")
-        num = pnum[0]
+        return self.detect_batch(meta, [image], alt_names, thresh, hier_thresh, nms, debug)[0]
+
+    def detect_batch(self, meta, images, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False, input_size=None) -> List[List[Tuple[str, float, Tuple[float, float, float, float]]]]:
+        # The input size is fixed by model.cfg, hence input_size is ignored
+        names = alt_names if alt_names is not None else [meta.names[i] for i in range(meta.classes)]
+        results = []
+        for start in range(0, len(images), self.max_batch_size):
+            results += self._detect_chunk(meta, images[start:start + self.max_batch_size], names, thresh, hier_thresh, nms, debug)
+        return results
+
+    def _detect_chunk(self, meta, images, names, thresh, hier_thresh, nms, debug):
+        self.preprocess(images)
+        if set_batch_network and self.batch_size != len(images):
+            # Can only go down to fewer images than the net was loaded with, as its buffers are sized for max_batch_size
+            set_batch_network(self.net, len(images))
+            self.batch_size = len(images)
+        # Without set_batch_network the net always runs on max_batch_size images. The leftover ones are simply not read.
+        im = IMAGE(self.preprocess.input_w, self.preprocess.input_h, 3, self.preprocess.buffer.ctypes.data_as(POINTER(c_float)))
+        # Boxes relative to the net input, so that each image can be scaled to its own size
+        batch_dets = predict_batch(self.net, im, self.batch_size, self.preprocess.input_w, self.preprocess.input_h, thresh, hier_thresh, None, 1, 0)
         if debug:
-            print("got zeroth index of pnum")
-        if nms:
-            do_nms_sort(dets, num, meta.classes, nms)
-        if debug:
-            print("did sort")
-        res = []
-        if debug:
-            print("about to range")
-        for j in range(num):
-            if debug:
-                print("Ranging on "+str(j)+" of "+str(num))
-            if debug:
-                print("Classes: "+str(meta), meta.classes, meta.names)
-            for i in range(meta.classes):
-                if debug:
-                    print("Class-ranging on "+str(i)+" of "+str(meta.classes)+"= "+str(dets[j].prob[i]))
-                if dets[j].prob[i] > 0:
-                    b = dets[j].bbox
-                    if alt_names is None:
-                        nameTag = meta.names[i]
-                    else:
-                        nameTag = alt_names[i]
-                    if debug:
-                        print("Got bbox", b)
-                        print(nameTag)
-                        print(dets[j].prob[i])
-                        print((b.x, b.y, b.w, b.h))
-                    res.append((nameTag, dets[j].prob[i], (b.x, b.y, b.w, b.h)))
-        if debug:
-            print("did range")
-        res = sorted(res, key=lambda x: -x[1])
-        if debug:
-            print("did sort")
-        free_detections(dets, num)
-        if debug:
-            print("freed detections")
-        return res
+            print(f"did prediction on {len(images)} images")
+        try:
+            results = []
+            for i, image in enumerate(images):
+                dets, num = batch_dets[i].dets, batch_dets[i].num
+                if nms:
+                    do_nms_sort(dets, num, meta.classes, nms)
+                results.append(detections_to_tuples(dets, num, meta.classes, names, image.shape[1], image.shape[0]))
+            return results
+        finally:
+            free_batch_detections(batch_dets, self.batch_size)
+
+
+# The fields of DETECTION that are read, at their offsets in the C struct, so that an array of DETECTIONs can be viewed as a numpy array
+DETECTION_DTYPE = np.dtype(dict(
+    names=['bbox', 'prob'],
+    formats=[(np.float32, 4), np.uintp],
+    offsets=[DETECTION.bbox.offset, DETECTION.prob.offset],
+    itemsize=sizeof(DETECTION)))
+
+
+def detections_to_tuples(dets, num, classes, names, width, height) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
+    """(name, prob, (x, y, w, h)) of every class with prob > 0 in every detection, highest prob first. Boxes are scaled from relative to width x height."""
+    if num == 0:
+        return []
+
+    dets_array = np.frombuffer((c_char * (num * sizeof(DETECTION))).from_address(addressof(dets.contents)), dtype=DETECTION_DTYPE)
+    # Every detection has its probs in a C array of its own, hence they are read one detection at a time
+    prob_ptrs = dets_array['prob'].tolist()
+    if classes == 1:
+        probs = np.fromiter((c_float.from_address(p).value for p in prob_ptrs), dtype=np.float32, count=num).reshape(num, 1)
+    else:
+        prob_type = c_float * classes
+        probs = np.array([prob_type.from_address(p)[:] for p in prob_ptrs], dtype=np.float32)
+
+    det_idx, class_idx = np.nonzero(probs > 0)
+    confs = probs[det_idx, class_idx]
+    boxes = dets_array['bbox'][det_idx] * np.array([width, height, width, height], dtype=np.float32)
+    order = np.argsort(-confs, kind='stable')
+    return [(names[c], p, tuple(box)) for c, p, box in zip(class_idx[order].tolist(), confs[order].tolist(), boxes[order].tolist())]
 
 # Loads darknet shared library. May fail if some dependencies like OpenCV not installed
 # libdarknet_gpu.so needs Cuda + Cudnn and other libraries in path, which may not exist
@@ -145,8 +161,10 @@ except Exception as e:
 print('\n')
 
 if lib:
+    network_width = lib.network_width
     lib.network_width.argtypes = [c_void_p]
     lib.network_width.restype = c_int
+    network_height = lib.network_height
     lib.network_height.argtypes = [c_void_p]
     lib.network_height.restype = c_int
 
@@ -214,6 +232,18 @@ if lib:
     rgbgr_image = lib.rgbgr_image
     rgbgr_image.argtypes = [IMAGE]
 
+    predict_batch = lib.network_predict_batch
+    predict_batch.argtypes = [c_void_p, IMAGE, c_int, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, c_int]
+    predict_batch.restype = POINTER(DETNUMPAIR)
+
+    free_batch_detections = lib.free_batch_detections
+    free_batch_detections.argtypes = [POINTER(DETNUMPAIR), c_int]
+
+    # Not exported by every darknet build
+    set_batch_network = getattr(lib, 'set_batch_network', None)
+    if set_batch_network:
+        set_batch_network.argtypes = [c_void_p, c_int]
+
     predict_image = lib.network_predict_image
     predict_image.argtypes = [c_void_p, IMAGE]
     predict_image.restype = POINTER(c_float)
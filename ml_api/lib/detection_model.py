@@ -4,6 +4,7 @@
 from enum import Enum
 from lib.meta import Meta
 from os import path
+import os
 
 alt_names = None
 
@@ -22,7 +23,31 @@ except Exception as e:
     onnx_ready = False
 
 
-def load_net(config_path, meta_path, weights_path=None):
+def onnx_session_profile():
+    """
+    ONNX Runtime session tuning, from env vars:
+
+    ML_API_ORT_INTRA_OP_THREADS: threads used within an operator. Defaults to the number of CPUs this process may run on,
+        so that a worker pinned to a few cores (`taskset`, docker `cpuset`) doesn't start one thread per core of the host.
+    ML_API_ORT_INTER_OP_THREADS: threads used across operators. Only used in parallel execution mode. 0 = ONNX Runtime default.
+    ML_API_ORT_EXECUTION_MODE: sequential | parallel
+    ML_API_ORT_GRAPH_OPTIMIZATION: disable | basic | extended | all
+    ML_API_ORT_CPU_MEM_ARENA: True | False. Turning it off lowers memory footprint at the cost of allocation speed.
+    ML_API_ORT_OPTIMIZED_MODEL_DIR: where to save the optimized model so that later starts skip graph optimization. Not saved if empty.
+    """
+    default_intra_op_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else 0
+    return dict(
+        intra_op_threads=int(os.environ.get('ML_API_ORT_INTRA_OP_THREADS', default_intra_op_threads)),
+        inter_op_threads=int(os.environ.get('ML_API_ORT_INTER_OP_THREADS', 0)),
+        execution_mode=os.environ.get('ML_API_ORT_EXECUTION_MODE', 'sequential'),
+        graph_optimization=os.environ.get('ML_API_ORT_GRAPH_OPTIMIZATION', 'all'),
+        cpu_mem_arena=os.environ.get('ML_API_ORT_CPU_MEM_ARENA', 'True') == 'True',
+        optimized_model_dir=os.environ.get('ML_API_ORT_OPTIMIZED_MODEL_DIR') or None,
+    )
+
+
+def load_net(config_path, meta_path, weights_path=None, use_gpu=None):
+    """use_gpu: only with weights_path. True or False to load the net on that device only, None to try GPU first, then CPU"""
 
     def try_loading_net(net_config_priority):
         for net_config in net_config_priority:
@@ -35,12 +60,13 @@ def load_net(config_path, meta_path, weights_path=None):
                 if weights.endswith(".onnx"):
                     if not onnx_ready:
                         raise Exception('Not loading ONNX net due to previous import failure. Check earlier log for errors.')
-                    net_main = OnnxNet(weights, meta_path, use_gpu)
+                    net_main = OnnxNet(weights, meta_path, use_gpu, **onnx_session_profile())
 
                 elif weights.endswith(".darknet"):
                     if not darknet_ready:
                         raise Exception('Not loading darknet net due to previous import failure. Check earlier log for errors.')
-                    net_main = YoloNet(weights, meta_path, config_path, use_gpu)
+                    # Loaded for as many images as ml_api batches together. Fewer images per batch are fine.
+                    net_main = YoloNet(weights, meta_path, config_path, use_gpu, max_batch_size=int(os.environ.get('ML_API_MAX_BATCH_SIZE', 8)))
 
                 else:
                     raise Exception(f'Can not recognize net from weights file surfix: {weights}')
@@ -55,14 +81,20 @@ def load_net(config_path, meta_path, weights_path=None):
     global alt_names  # pylint: disable=W0603
 
     model_dir = path.join(path.dirname(path.realpath(__file__)), '..', 'model')
+    # Quantized variants (made with quantize.py) are only there when they have been checked against
+    # the full precision model with compare_models.py. FP16 pays off on GPU, INT8 on CPU.
     net_config_priority = [
             dict(weights_path=path.join(model_dir, 'model-weights.darknet'), use_gpu=True),
+            dict(weights_path=path.join(model_dir, 'model-weights.fp16.onnx'), use_gpu=True),
             dict(weights_path=path.join(model_dir, 'model-weights.onnx'), use_gpu=True),
+            dict(weights_path=path.join(model_dir, 'model-weights.int8.onnx'), use_gpu=False),
             dict(weights_path=path.join(model_dir, 'model-weights.onnx'), use_gpu=False),
             dict(weights_path=path.join(model_dir, 'model-weights.darknet'), use_gpu=False),
         ]
     if weights_path is not None:
         net_config_priority = [ dict(weights_path=weights_path, use_gpu=True), dict(weights_path=weights_path, use_gpu=False) ]
+        if use_gpu is not None:
+            net_config_priority = [ dict(weights_path=weights_path, use_gpu=use_gpu) ]
 
     net_main = try_loading_net(net_config_priority)
 
@@ -80,3 +112,29 @@ def load_net(config_path, meta_path, weights_path=None):
 def detect(net, image, thresh=.5, hier_thresh=.5, nms=.45, debug=False):
     return net.detect(net.meta, image, alt_names, thresh, hier_thresh, nms, debug)
 
+def detect_batch(net, images, thresh=.5, hier_thresh=.5, nms=.45, debug=False, input_size=None):
+    """input_size: run the net at input_size x input_size instead of its default size, if the net allows it"""
+    return net.detect_batch(net.meta, images, alt_names, thresh, hier_thresh, nms, debug, input_size)
+
+
+def crop_to_roi(image, roi):
+    """
+    Crops the image to the region of interest (x1, y1, x2, y2), given in fractions of the image width and height.
+    Returns the crop (a view, not a copy) and its (left, top) offset in the image.
+    """
+    if not roi:
+        return image, (0, 0)
+    h, w = image.shape[:2]
+    x1, y1, x2, y2 = [min(max(v, 0.0), 1.0) for v in roi]
+    left, top, right, bottom = int(x1 * w), int(y1 * h), int(round(x2 * w)), int(round(y2 * h))
+    if right - left < 2 or bottom - top < 2:
+        return image, (0, 0)
+    return image[top:bottom, left:right], (left, top)
+
+
+def to_full_frame(detections, offset):
+    """Maps detections on a crop back to the coordinates of the full image"""
+    left, top = offset
+    if not left and not top:
+        return detections
+    return [(name, conf, (xc + left, yc + top, w, h)) for name, conf, (xc, yc, w, h) in detections]
@@ -47,8 +47,9 @@ class Box:
         o_t = min(at, bt)
         o_b = max(ab, bb)
 
-        i_w = i_r - i_l
-        i_h = i_b - i_t
+        # Boxes apart on both axes would otherwise get a positive product of two negative overlaps
+        i_w = max(0.0, i_r - i_l)
+        i_h = max(0.0, i_b - i_t)
         o_w = o_r - o_l
         o_h = o_b - o_t
 
@@ -109,3 +110,8 @@ def compare_detections(l1: List[Detection], l2: List[Detection], threshold: floa
 
     return True
 
+
+
+def best_ious(l1: List[Detection], l2: List[Detection]) -> List[float]:
+    """For every detection in l1, the IoU of the detection in l2 that matches it best. 0 if none does"""
+    return [max((a.box.calc_iou(b.box) for b in l2), default=0.0) for a in l1]
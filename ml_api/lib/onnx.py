@@ -1,49 +1,189 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import onnxruntime
 import numpy as np
-import cv2
+import hashlib
 import os
+import platform
 
 from lib.meta import Meta
+from lib.preprocess import Preprocessor
+
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def session_options(intra_op_threads: int = 0, inter_op_threads: int = 0, execution_mode: str = 'sequential',
+                    graph_optimization: str = 'all', cpu_mem_arena: bool = True) -> onnxruntime.SessionOptions:
+    """Thread counts of 0 let ONNX Runtime decide"""
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = EXECUTION_MODES[execution_mode]
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization]
+    options.enable_cpu_mem_arena = cpu_mem_arena
+    return options
+
+
+def cpu_signature() -> str:
+    """A short hash of the CPU architecture and its instruction set extensions"""
+    flags = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line.split(':', 1)[1].strip() for line in f if line.startswith(('flags', 'Features'))), flags)
+    except OSError:
+        pass
+    return hashlib.sha1(f'{platform.machine()} {flags}'.encode()).hexdigest()[:8]
+
+
+def optimized_model_path(onnx_path: str, cache_dir: str, provider: str, graph_optimization: str) -> str:
+    # Optimized graphs depend on the execution provider and on the ONNX Runtime version, and go stale when the model file changes.
+    # At level all they may also be specific to the CPU they were made on (e.g. NCHWc layouts), and the cache dir may be
+    # shared by, or baked into an image for, different machines.
+    stat = os.stat(onnx_path)
+    name, _ = os.path.splitext(os.path.basename(onnx_path))
+    return os.path.join(
+        cache_dir,
+        f'{name}.{provider}.{graph_optimization}.cpu-{cpu_signature()}.ort-{onnxruntime.__version__}.{stat.st_size}-{int(stat.st_mtime)}.onnx')
+
+
+def create_session(onnx_path: str, providers: List[str], optimized_model_dir: Optional[str] = None, **profile) -> onnxruntime.InferenceSession:
+    """
+    Creates the inference session with the tuning `profile` (see `session_options`).
+
+    When `optimized_model_dir` is given, the graph optimized by ONNX Runtime is saved there, and loaded without
+    re-optimizing it the next time the same model is loaded with the same provider and optimization level, on the same
+    kind of CPU.
+    """
+    # ONNX Runtime falls back to CPU when a provider isn't built in. Do the same up front so the cache is keyed by the provider in use.
+    providers = [p for p in providers if p in onnxruntime.get_available_providers()] or ['CPUExecutionProvider']
+
+    if not optimized_model_dir or profile.get('graph_optimization', 'all') == 'disable':
+        return onnxruntime.InferenceSession(onnx_path, sess_options=session_options(**profile), providers=providers)
+
+    cached_path = optimized_model_path(onnx_path, optimized_model_dir, providers[0], profile.get('graph_optimization', 'all'))
+    if os.path.exists(cached_path):
+        try:
+            session = onnxruntime.InferenceSession(
+                cached_path, sess_options=session_options(**dict(profile, graph_optimization='disable')), providers=providers)
+            print(f'Loaded optimized model from {cached_path}')
+            return session
+        except Exception as e:
+            print(f'Failed to load optimized model from {cached_path}. Optimizing it again - {e}')
+
+    options = session_options(**profile)
+    # Several ml_api processes may start at the same time. Each writes its own file and the last one wins.
+    tmp_path = f'{cached_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(optimized_model_dir, exist_ok=True)
+        options.optimized_model_filepath = tmp_path
+        session = onnxruntime.InferenceSession(onnx_path, sess_options=options, providers=providers)
+        if session.get_providers()[0] == providers[0]:
+            os.replace(tmp_path, cached_path)
+            print(f'Saved optimized model to {cached_path}')
+        else:
+            # ONNX Runtime silently fell back to another provider. Don't cache a graph optimized for it under this provider's name.
+            os.remove(tmp_path)
+        return session
+    except Exception as e:
+        print(f'Failed to save optimized model to {cached_path} - {e}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return onnxruntime.InferenceSession(onnx_path, sess_options=session_options(**profile), providers=providers)
+
+
+DEFAULT_INPUT_SIZE = 416  # For models exported with dynamic height and width
+
 
 class OnnxNet:
     session: onnxruntime.InferenceSession
     meta: Meta
 
-    def __init__(self, onnx_path: str, meta_path: str, use_gpu: bool):
+    def __init__(self, onnx_path: str, meta_path: str, use_gpu: bool, optimized_model_dir: Optional[str] = None, **profile):
+        # Fail instead of silently running on CPU, so that load_net moves on to the models meant for CPU
+        if use_gpu and 'CUDAExecutionProvider' not in onnxruntime.get_available_providers():
+            raise Exception('CUDAExecutionProvider is not available')
         providers = ['CUDAExecutionProvider'] if use_gpu else ['CPUExecutionProvider']
-        self.session = onnxruntime.InferenceSession(onnx_path, providers=providers)
+        self.session = create_session(onnx_path, providers, optimized_model_dir, **profile)
         self.meta = Meta(meta_path)
 
-    def detect(self, meta, image, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
-        input_h = self.session.get_inputs()[0].shape[2]
-        input_w = self.session.get_inputs()[0].shape[3]
-        width = image.shape[1]
-        height = image.shape[0]
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Models exported with a fixed batch dimension can only take that many images per run
+        batch_dim = model_input.shape[0]
+        self.max_batch_size = batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
+        # Only models exported with dynamic height and width can run at an input size other than the default one
+        input_h, input_w = model_input.shape[2:4]
+        self.resizable = not (isinstance(input_h, int) and isinstance(input_w, int))
+        self.default_input_size = (DEFAULT_INPUT_SIZE, DEFAULT_INPUT_SIZE) if self.resizable else (input_w, input_h)
+        self.preprocessors = {}
+
+    def preprocessor(self, input_size: Optional[int]) -> Preprocessor:
+        if input_size and self.resizable:
+            # The net downsamples by 32
+            input_size = (max(32, input_size // 32 * 32),) * 2
+        else:
+            input_size = self.default_input_size
+        if input_size not in self.preprocessors:
+            self.preprocessors[input_size] = Preprocessor(*input_size, self.max_batch_size or 1)
+        return self.preprocessors[input_size]
+
+    def detect(self, meta, image, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False, input_size=None) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
+        return self.detect_batch(meta, [image], alt_names, thresh, hier_thresh, nms, debug, input_size)[0]
+
+    def detect_batch(self, meta, images, alt_names, thresh=.5, hier_thresh=.5, nms=.45, debug=False, input_size=None) -> List[List[Tuple[str, float, Tuple[float, float, float, float]]]]:
+        preprocess = self.preprocessor(input_size)
+        max_batch_size = self.max_batch_size or len(images)
+        detections = []
+        for start in range(0, len(images), max_batch_size):
+            chunk = images[start:start + max_batch_size]
+
+            outputs = self.session.run(None, {self.input_name: preprocess(chunk)})
+
+            # Images in a batch may come in different sizes, hence the boxes are scaled per image
+            widths = [image.shape[1] for image in chunk]
+            heights = [image.shape[0] for image in chunk]
+            detections += [
+                detections_as_tuples(dets, meta.names)
+                for dets in post_processing(outputs, widths, heights, thresh, nms)
+            ]
 
-        # Input
-        resized = cv2.resize(image, (input_w, input_h), interpolation=cv2.INTER_LINEAR)
-        img_in = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
-        img_in = np.transpose(img_in, (2, 0, 1)).astype(np.float32)
-        img_in = np.expand_dims(img_in, axis=0)
-        img_in /= 255.0
+        return detections
 
-        input_name = self.session.get_inputs()[0].name
-        outputs = self.session.run(None, {input_name: img_in})
 
-        detections = post_processing(outputs, width, height, thresh, nms, meta.names)
-        return detections[0]
+Detections = Tuple[np.ndarray, np.ndarray, np.ndarray]
 
 
-def nms_cpu(boxes, confs, nms_thresh=0.5, min_mode=False):
-    # print(boxes.shape)
+def detections_as_tuples(detections: Detections, names: List[str]) -> List[Tuple[str, float, Tuple[float, float, float, float]]]:
+    """Converts (boxes, confs, class_ids) arrays of one image into the tuples returned by the detection API"""
+    boxes, confs, class_ids = detections
+    return [
+        (names[class_id], conf, tuple(box))
+        for box, conf, class_id in zip(boxes.tolist(), confs.tolist(), class_ids.tolist())
+    ]
+
+
+MATRIX_NMS_MAX_BOXES = 256  # Above this number of boxes in a group, the one-box-at-a-time NMS is faster than the overlap matrices
+
+
+def nms_cpu(boxes, confs, nms_thresh=0.5):
+    """Greedy NMS of one group of boxes. Returns the indices of kept boxes, ordered by confidence desc."""
     x1 = boxes[:, 0]
     y1 = boxes[:, 1]
     x2 = boxes[:, 2]
     y2 = boxes[:, 3]
 
     areas = (x2 - x1) * (y2 - y1)
-    order = confs.argsort()[::-1]
+    order = np.argsort(-confs, kind='stable')
 
     keep = []
     while order.size > 0:
@@ -52,26 +192,80 @@ def nms_cpu(boxes, confs, nms_thresh=0.5, min_mode=False):
 
         keep.append(idx_self)
 
-        xx1 = np.maximum(x1[idx_self], x1[idx_other])
-        yy1 = np.maximum(y1[idx_self], y1[idx_other])
-        xx2 = np.minimum(x2[idx_self], x2[idx_other])
-        yy2 = np.minimum(y2[idx_self], y2[idx_other])
-
-        w = np.maximum(0.0, xx2 - xx1)
-        h = np.maximum(0.0, yy2 - yy1)
+        w = np.maximum(0.0, np.minimum(x2[idx_self], x2[idx_other]) - np.maximum(x1[idx_self], x1[idx_other]))
+        h = np.maximum(0.0, np.minimum(y2[idx_self], y2[idx_other]) - np.maximum(y1[idx_self], y1[idx_other]))
         inter = w * h
+        over = inter / (areas[idx_self] + areas[idx_other] - inter)
+
+        order = idx_other[over <= nms_thresh]
+
+    return np.array(keep, dtype=np.int64)
 
-        if min_mode:
-            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
-        else:
-            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
 
-        inds = np.where(over <= nms_thresh)[0]
-        order = order[inds + 1]
+def batched_nms(boxes: np.ndarray, confs: np.ndarray, groups: np.ndarray, nms_thresh: float) -> np.ndarray:
+    """
+    Greedy NMS within each group (e.g. image and class) of boxes, for all groups at once.
+    Returns a mask of the kept boxes.
 
-    return np.array(keep)
+    The boxes are laid out as [num_groups, max_group_size] padded arrays, ordered by confidence desc in each group,
+    so that all the overlaps are computed in one go as [num_groups, max_group_size, max_group_size] matrices.
+    """
+    n = boxes.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=bool)
 
-def post_processing(output, width, height, conf_thresh, nms_thresh, names):
+    order = np.lexsort((-confs, groups))
+    _, group_idx, group_sizes = np.unique(groups[order], return_inverse=True, return_counts=True)
+    group_idx = group_idx.reshape(-1)
+    num_groups, max_group_size = group_sizes.shape[0], group_sizes.max()
+
+    keep_mask = np.zeros(n, dtype=bool)
+    if max_group_size > MATRIX_NMS_MAX_BOXES:
+        for g in np.unique(groups):
+            in_group = np.nonzero(groups == g)[0]
+            keep_mask[in_group[nms_cpu(boxes[in_group], confs[in_group], nms_thresh)]] = True
+        return keep_mask
+
+    # Position of each box in the padded layout
+    rank = np.arange(n) - np.repeat(np.cumsum(group_sizes) - group_sizes, group_sizes)
+    padded = np.zeros((num_groups, max_group_size, 4), dtype=boxes.dtype)
+    padded[group_idx, rank] = boxes[order]
+    valid = np.zeros((num_groups, max_group_size), dtype=bool)
+    valid[group_idx, rank] = True
+
+    x1, y1, x2, y2 = padded[..., 0], padded[..., 1], padded[..., 2], padded[..., 3]
+    areas = (x2 - x1) * (y2 - y1)
+    w = np.maximum(0.0, np.minimum(x2[:, :, None], x2[:, None, :]) - np.maximum(x1[:, :, None], x1[:, None, :]))
+    h = np.maximum(0.0, np.minimum(y2[:, :, None], y2[:, None, :]) - np.maximum(y1[:, :, None], y1[:, None, :]))
+    inter = w * h
+    with np.errstate(divide='ignore', invalid='ignore'):
+        over = inter / (areas[:, :, None] + areas[:, None, :] - inter)
+
+    # overlapping[g, j, i]: box j has higher confidence than box i, and suppresses it if j is kept.
+    overlapping = np.triu(~(over <= nms_thresh), k=1) & valid[:, :, None]
+
+    # Box i is kept iff no kept box before it overlaps it. Starting from "all kept", each iteration fixes
+    # at least one more box in order, so it converges to the same result as the one-box-at-a-time greedy NMS.
+    # In practice it takes a handful of iterations.
+    overlapping = overlapping.astype(np.float32)
+    keep = valid.astype(np.float32)
+    while True:
+        next_keep = ((np.matmul(keep[:, None, :], overlapping)[:, 0, :] == 0) & valid).astype(np.float32)
+        if np.array_equal(next_keep, keep):
+            break
+        keep = next_keep
+
+    keep_mask[order] = keep[group_idx, rank].astype(bool)
+    return keep_mask
+
+
+def post_processing(output, width, height, conf_thresh, nms_thresh) -> List[Detections]:
+    """
+    output: [boxes [batch, num, 1, 4] as normalized (x1, y1, x2, y2), confs [batch, num, num_classes]]
+    width, height: image size. Either a number for all images in the batch, or a sequence with one per image.
+    Returns (boxes [k, 4] as (xc, yc, w, h) scaled to the image size, confs [k], class_ids [k]) for each image in the batch,
+    ordered by class, then by confidence desc.
+    """
     box_array = output[0]
     confs = output[1]
 
@@ -79,6 +273,7 @@ def post_processing(output, width, height, conf_thresh, nms_thresh, names):
         box_array = box_array.cpu().detach().numpy()
         confs = confs.cpu().detach().numpy()
 
+    batch_size = box_array.shape[0]
     num_classes = confs.shape[2]
 
     # [batch, num, 4]
@@ -88,45 +283,26 @@ def post_processing(output, width, height, conf_thresh, nms_thresh, names):
     max_conf = np.max(confs, axis=2)
     max_id = np.argmax(confs, axis=2)
 
-    box_x1x1x2y2_to_xcycwh_scaled = lambda b: \
-        (
-            float(0.5 * width * (b[0] + b[2])),
-            float(0.5 * height * (b[1] + b[3])),
-            float(width * (b[2] - b[0])),
-            float(width * (b[3] - b[1]))
-         )
-    dets_batch = []
-    for i in range(box_array.shape[0]):
-
-        argwhere = max_conf[i] > conf_thresh
-        l_box_array = box_array[i, argwhere, :]
-        l_max_conf = max_conf[i, argwhere]
-        l_max_id = max_id[i, argwhere]
-
-        bboxes = []
-        # nms for each class
-        for j in range(num_classes):
-
-            cls_argwhere = l_max_id == j
-            ll_box_array = l_box_array[cls_argwhere, :]
-            ll_max_conf = l_max_conf[cls_argwhere]
-            ll_max_id = l_max_id[cls_argwhere]
-
-            keep = nms_cpu(ll_box_array, ll_max_conf, nms_thresh)
-
-            if (keep.size > 0):
-                ll_box_array = ll_box_array[keep, :]
-                ll_max_conf = ll_max_conf[keep]
-                ll_max_id = ll_max_id[keep]
-
-                for k in range(ll_box_array.shape[0]):
-                    bboxes.append([ll_box_array[k, 0], ll_box_array[k, 1], ll_box_array[k, 2], ll_box_array[k, 3], ll_max_conf[k], ll_max_conf[k], ll_max_id[k]])
-
-        detections = [(names[b[6]], float(b[4]), box_x1x1x2y2_to_xcycwh_scaled((b[0], b[1], b[2], b[3]))) for b in bboxes]
-        dets_batch.append(detections)
-
-
-    return dets_batch
-
-
-
+    # Candidates above the threshold across the batch: [n]
+    batch_idx, box_idx = np.nonzero(max_conf > conf_thresh)
+    boxes = box_array[batch_idx, box_idx]
+    det_confs = max_conf[batch_idx, box_idx]
+    class_ids = max_id[batch_idx, box_idx]
+
+    # One NMS for all images and classes. Then order by image, class, and confidence desc
+    groups = batch_idx * num_classes + class_ids
+    kept = np.nonzero(batched_nms(boxes, det_confs, groups, nms_thresh))[0]
+    kept = kept[np.lexsort((-det_confs[kept], groups[kept]))]
+    batch_idx, boxes, det_confs, class_ids = batch_idx[kept], boxes[kept], det_confs[kept], class_ids[kept]
+
+    widths = np.broadcast_to(np.asarray(width, dtype=np.float32), (batch_size,))[batch_idx]
+    heights = np.broadcast_to(np.asarray(height, dtype=np.float32), (batch_size,))[batch_idx]
+    scaled = np.stack([
+        0.5 * widths * (boxes[:, 0] + boxes[:, 2]),
+        0.5 * heights * (boxes[:, 1] + boxes[:, 3]),
+        widths * (boxes[:, 2] - boxes[:, 0]),
+        heights * (boxes[:, 3] - boxes[:, 1]),
+    ], axis=1)
+
+    splits = np.cumsum(np.bincount(batch_idx, minlength=batch_size))[:-1]
+    return list(zip(np.split(scaled, splits), np.split(det_confs, splits), np.split(class_ids, splits)))
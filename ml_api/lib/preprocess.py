@@ -0,0 +1,35 @@
+import numpy as np
+import cv2
+
+
+class Preprocessor:
+    """
+    Resizes and packs BGR, BGRA or grayscale images into a [batch, 3, h, w] RGB float32 buffer that is reused across calls.
+    Not thread-safe: the returned array is overwritten by the next call.
+    """
+
+    def __init__(self, input_w: int, input_h: int, batch_size: int = 1):
+        self.input_w = input_w
+        self.input_h = input_h
+        self.resized = np.empty((input_h, input_w, 3), dtype=np.uint8)
+        self.planes = [np.empty((input_h, input_w), dtype=np.uint8) for _ in range(3)]
+        self.buffer = np.empty((batch_size, 3, input_h, input_w), dtype=np.float32)
+
+    def __call__(self, images) -> np.ndarray:
+        if self.buffer.shape[0] < len(images):
+            self.buffer = np.empty((len(images), 3, self.input_h, self.input_w), dtype=np.float32)
+
+        for i, image in enumerate(images):
+            # cv2 returns a new array instead of writing into dst if dst doesn't fit (e.g. image is not 3-channel)
+            resized = cv2.resize(image, (self.input_w, self.input_h), dst=self.resized, interpolation=cv2.INTER_LINEAR)
+            if resized.ndim == 2 or resized.shape[2] == 1:
+                resized = cv2.cvtColor(resized, cv2.COLOR_GRAY2BGR, dst=self.resized)
+            elif resized.shape[2] == 4:
+                resized = cv2.cvtColor(resized, cv2.COLOR_BGRA2BGR, dst=self.resized)
+            # HWC -> CHW. Contiguous planes make the float conversion below much cheaper than a strided transpose.
+            b, g, r = cv2.split(resized, self.planes)
+            # BGR -> RGB, uint8 -> float32 and / 255, written straight into the input buffer
+            for c, plane in enumerate((r, g, b)):
+                np.multiply(plane, np.float32(1.0 / 255.0), out=self.buffer[i, c], casting='unsafe')
+
+        return self.buffer[:len(images)]
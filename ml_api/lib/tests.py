@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+import cv2
+import numpy as np
+
+from lib.batcher import MicroBatcher
+from lib.preprocess import Preprocessor
+
+
+class MicroBatcherTestCase(unittest.TestCase):
+
+    def test_bad_item_fails_alone(self):
+        started, release = threading.Event(), threading.Event()
+        batch_sizes = []
+
+        def process_batch(items):
+            started.set()
+            release.wait()
+            batch_sizes.append(len(items))
+            if 'bad' in items:
+                raise ValueError('bad item')
+            return [item.upper() for item in items]
+
+        batcher = MicroBatcher(process_batch, max_batch_size=4)
+        blocker = batcher.submit('first')  # Holds the worker until the others are queued up as one batch
+        started.wait(timeout=5)
+        futures = [batcher.submit(item) for item in ('a', 'bad', 'b')]
+        release.set()
+
+        self.assertEqual(blocker.result(timeout=5), 'FIRST')
+        self.assertEqual(futures[0].result(timeout=5), 'A')
+        self.assertEqual(futures[2].result(timeout=5), 'B')
+        with self.assertRaises(ValueError):
+            futures[1].result(timeout=5)
+        self.assertEqual(batch_sizes, [1, 3, 1, 1, 1])
+
+
+class PreprocessorTestCase(unittest.TestCase):
+
+    def test_bgra_and_grayscale_images(self):
+        bgr = np.random.RandomState(0).randint(0, 256, (48, 64, 3), dtype=np.uint8)
+        preprocess = Preprocessor(32, 24, batch_size=3)
+        expected = preprocess([bgr]).copy()
+
+        bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        buffer = preprocess([bgr, bgra, gray])
+
+        np.testing.assert_array_equal(buffer[1], expected[0])
+        self.assertEqual(buffer[2].shape, (3, 24, 32))
+        np.testing.assert_array_equal(buffer[2][0], buffer[2][1])
+        np.testing.assert_allclose(buffer[2][0], cv2.resize(gray, (32, 24), interpolation=cv2.INTER_LINEAR) / 255.0, rtol=1e-6)
@@ -0,0 +1,242 @@
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, List
+
+from lib.batcher import next_batch
+
+STARTING, READY, BUSY, DEAD = range(4)
+STATE_NAMES = {STARTING: 'starting', READY: 'ready', BUSY: 'busy', DEAD: 'dead'}
+
+MONITOR_INTERVAL_SECS = 1.0
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_slices(num_workers: int, cores_per_worker: int) -> List[List[int]]:
+    """Gives each worker its own cores. The cores are shared round-robin when there are not enough of them."""
+    cpus = available_cpus()
+    return [[cpus[(i * cores_per_worker + j) % len(cpus)] for j in range(cores_per_worker)] for i in range(num_workers)]
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _worker_main(conn, server_conns, cpus, load, prepare, infer, state, processed):
+    # Only the server process may hold the server ends of the pipes, so that the workers see EOF once it's gone
+    for server_conn in server_conns:
+        server_conn.close()
+
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        # Before the model is loaded, so that ONNX Runtime sizes its thread pool to these cores
+        os.sched_setaffinity(0, cpus)
+
+    try:
+        model = load()
+    except Exception:
+        traceback.print_exc()
+        state.value = DEAD
+        return
+
+    state.value = READY
+    conn.send(('ready',))
+    while True:
+        try:
+            batch = conn.recv()
+        except (EOFError, OSError):  # The server process is gone
+            return
+
+        state.value = BUSY
+        # An item that fails to be prepared (e.g. a corrupt image) fails alone instead of failing the whole batch
+        prepared = []
+        for task_id, payload in batch:
+            try:
+                prepared.append((task_id, prepare(payload)))
+            except Exception as e:
+                conn.send(('done', task_id, False, f'{type(e).__name__}: {e}'))
+
+        if prepared:
+            try:
+                outputs = infer(model, [item for _, item in prepared])
+                for (task_id, _), output in zip(prepared, outputs):
+                    conn.send(('done', task_id, True, output))
+            except Exception as e:
+                for task_id, _ in prepared:
+                    conn.send(('done', task_id, False, f'{type(e).__name__}: {e}'))
+
+        processed.value += len(batch)
+        state.value = READY
+        conn.send(('idle',))
+
+
+class WorkerPool:
+    """
+    Pre-forks `num_workers` inference processes, each pinned to `cores_per_worker` cores of its own and each
+    loading the model once with `load()`.
+
+    Submitted payloads queue up in the server process. A dispatcher thread hands them, in batches of up to
+    `max_batch_size`, to whichever worker is idle. The worker runs `prepare(payload)` on each one and
+    `infer(model, prepared_items)` on all of them, and sends the results back.
+    A worker that dies is restarted, and the futures it was holding fail.
+
+    Every worker talks to the server process over a pipe of its own, so that a worker that gets killed can't leave
+    a lock shared with the other workers locked.
+
+    The workers are forked, so `load`, `prepare` and `infer` don't need to be picklable, but the payloads and the results do.
+    Create the pool before starting threads or loading a model in the server process: neither survives a fork.
+    """
+
+    def __init__(self, load: Callable[[], Any], prepare: Callable[[Any], Any], infer: Callable[[Any, List[Any]], List[Any]],
+                 num_workers: int, cores_per_worker: int = 1, max_batch_size: int = 8, max_wait_ms: float = 0.0):
+        self._ctx = multiprocessing.get_context('fork')
+        self._worker_args = (load, prepare, infer)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_secs = max(0.0, max_wait_ms) / 1000.0
+        self._pending = queue.Queue()
+        self._idle = queue.Queue()
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._workers = []
+        for worker_id, cpus in enumerate(cpu_slices(num_workers, max(1, cores_per_worker))):
+            self._workers.append(dict(cpus=cpus, restarts=0))
+            self._start_worker(worker_id)
+
+        threading.Thread(target=self._dispatch, name='worker-pool-dispatcher', daemon=True).start()
+        threading.Thread(target=self._collect, name='worker-pool-collector', daemon=True).start()
+        # Runs before multiprocessing's own exit handler, so that no worker is restarted while it terminates them
+        atexit.register(self.close)
+
+    def _start_worker(self, worker_id):
+        worker = self._workers[worker_id]
+        conn, child_conn = self._ctx.Pipe()
+        worker['conn'] = conn
+        worker['in_flight'] = {}
+        worker['state'] = self._ctx.Value('i', STARTING, lock=False)
+        worker['processed'] = self._ctx.Value('l', 0, lock=False)
+        worker['process'] = self._ctx.Process(
+            target=_worker_main,
+            name=f'ml-worker-{worker_id}',
+            args=(child_conn, [w['conn'] for w in self._workers if 'conn' in w and not w['conn'].closed], worker['cpus'], *self._worker_args, worker['state'], worker['processed']),
+            daemon=True)
+        worker['process'].start()
+        child_conn.close()
+
+    def submit(self, payload: Any) -> Future:
+        future = Future()
+        self._pending.put((next(self._task_ids), payload, future))
+        return future
+
+    def _dispatch(self):
+        while True:
+            worker_id = self._idle.get()
+            worker = self._workers[worker_id]
+            # Ids of workers that died, or are starting again since, are stale. A restarted worker says when it's ready.
+            if worker['state'].value in (STARTING, DEAD) or not worker['process'].is_alive():
+                continue
+
+            # Waiting for an idle worker first lets the queue build up into a bigger batch while all workers are busy
+            batch = [(task_id, payload, future) for (task_id, payload, future) in next_batch(self._pending, self.max_batch_size, self.max_wait_secs)
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                self._idle.put(worker_id)
+                continue
+
+            with self._lock:
+                worker['in_flight'].update((task_id, future) for (task_id, _, future) in batch)
+            try:
+                worker['conn'].send([(task_id, payload) for (task_id, payload, _) in batch])
+            except (OSError, ValueError) as e:
+                with self._lock:
+                    futures = [worker['in_flight'].pop(task_id, None) for (task_id, _, _) in batch]
+                for future in futures:
+                    if future is not None:
+                        future.set_exception(WorkerError(f'Worker {worker_id} is gone - {e}'))
+
+    def _collect(self):
+        while True:
+            conns = {worker['conn']: worker_id for worker_id, worker in enumerate(self._workers) if not worker['conn'].closed}
+            for conn in wait(list(conns.keys()), timeout=MONITOR_INTERVAL_SECS):
+                worker_id = conns[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    conn.close()
+                    continue
+                self._handle_message(worker_id, message)
+
+            self._restart_dead_workers()
+
+    def _handle_message(self, worker_id, message):
+        worker = self._workers[worker_id]
+        if message[0] in ('ready', 'idle'):
+            self._idle.put(worker_id)
+            return
+
+        _, task_id, ok, value = message
+        with self._lock:
+            future = worker['in_flight'].pop(task_id, None)
+        if future is None:
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(WorkerError(value))
+
+    def _fail_in_flight(self, worker, error):
+        with self._lock:
+            futures = list(worker['in_flight'].values())
+            worker['in_flight'] = {}
+        for future in futures:
+            future.set_exception(error)
+
+    def _restart_dead_workers(self):
+        if self._closed:
+            return
+
+        for worker_id, worker in enumerate(self._workers):
+            if worker['process'].is_alive() or worker['state'].value == DEAD and worker['conn'].closed:
+                continue
+
+            worker['state'].value = DEAD
+            worker['conn'].close()
+            self._fail_in_flight(worker, WorkerError(f'Worker {worker_id} died with exit code {worker["process"].exitcode}'))
+
+            # A worker that failed to load the model would fail again. Don't restart it in a tight loop.
+            if worker['processed'].value > 0:
+                worker['restarts'] += 1
+                self._start_worker(worker_id)
+
+    def close(self):
+        self._closed = True
+        for worker in self._workers:
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+
+    def ready(self) -> bool:
+        return any(worker['state'].value in (READY, BUSY) for worker in self._workers)
+
+    def status(self) -> List[Dict]:
+        return [
+            dict(
+                id=worker_id,
+                pid=worker['process'].pid,
+                state=STATE_NAMES[worker['state'].value],
+                cpus=worker['cpus'],
+                processed=worker['processed'].value,
+                restarts=worker['restarts'],
+            )
+            for worker_id, worker in enumerate(self._workers)
+        ]
@@ -0,0 +1,196 @@
+#!python3
+# Micro-benchmarks of the CPU-bound stages around the net. Model weights are not needed.
+#
+#   python microbench.py post_processing --batch-size 8
+#   python microbench.py preprocessing --batch-size 8
+import argparse
+import time
+import cv2
+import numpy as np
+
+from lib.onnx import post_processing, detections_as_tuples
+from lib.preprocess import Preprocessor
+
+
+def reference_nms_cpu(boxes, confs, nms_thresh=0.5, min_mode=False):
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = confs.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        idx_self = order[0]
+        idx_other = order[1:]
+
+        keep.append(idx_self)
+
+        xx1 = np.maximum(x1[idx_self], x1[idx_other])
+        yy1 = np.maximum(y1[idx_self], y1[idx_other])
+        xx2 = np.minimum(x2[idx_self], x2[idx_other])
+        yy2 = np.minimum(y2[idx_self], y2[idx_other])
+
+        w = np.maximum(0.0, xx2 - xx1)
+        h = np.maximum(0.0, yy2 - yy1)
+        inter = w * h
+
+        if min_mode:
+            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
+        else:
+            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
+
+        inds = np.where(over <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep)
+
+
+def reference_post_processing(output, width, height, conf_thresh, nms_thresh, names):
+    """The per-class, per-box post-processing that lib.onnx.post_processing replaced (with h scaled by height instead of width)"""
+    box_array = output[0]
+    confs = output[1]
+
+    num_classes = confs.shape[2]
+
+    # [batch, num, 4]
+    box_array = box_array[:, :, 0]
+
+    # [batch, num, num_classes] --> [batch, num]
+    max_conf = np.max(confs, axis=2)
+    max_id = np.argmax(confs, axis=2)
+
+    box_x1x1x2y2_to_xcycwh_scaled = lambda b: \
+        (
+            float(0.5 * width * (b[0] + b[2])),
+            float(0.5 * height * (b[1] + b[3])),
+            float(width * (b[2] - b[0])),
+            float(height * (b[3] - b[1]))
+         )
+    dets_batch = []
+    for i in range(box_array.shape[0]):
+
+        argwhere = max_conf[i] > conf_thresh
+        l_box_array = box_array[i, argwhere, :]
+        l_max_conf = max_conf[i, argwhere]
+        l_max_id = max_id[i, argwhere]
+
+        bboxes = []
+        # nms for each class
+        for j in range(num_classes):
+
+            cls_argwhere = l_max_id == j
+            ll_box_array = l_box_array[cls_argwhere, :]
+            ll_max_conf = l_max_conf[cls_argwhere]
+            ll_max_id = l_max_id[cls_argwhere]
+
+            keep = reference_nms_cpu(ll_box_array, ll_max_conf, nms_thresh)
+
+            if (keep.size > 0):
+                ll_box_array = ll_box_array[keep, :]
+                ll_max_conf = ll_max_conf[keep]
+                ll_max_id = ll_max_id[keep]
+
+                for k in range(ll_box_array.shape[0]):
+                    bboxes.append([ll_box_array[k, 0], ll_box_array[k, 1], ll_box_array[k, 2], ll_box_array[k, 3], ll_max_conf[k], ll_max_conf[k], ll_max_id[k]])
+
+        detections = [(names[b[6]], float(b[4]), box_x1x1x2y2_to_xcycwh_scaled((b[0], b[1], b[2], b[3]))) for b in bboxes]
+        dets_batch.append(detections)
+
+    return dets_batch
+
+
+def reference_preprocess(images, input_w, input_h):
+    """The per-image preprocessing that lib.onnx.Preprocessor replaced"""
+    img_in = []
+    for image in images:
+        resized = cv2.resize(image, (input_w, input_h), interpolation=cv2.INTER_LINEAR)
+        resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+        resized = np.transpose(resized, (2, 0, 1)).astype(np.float32)
+        resized /= 255.0
+        img_in.append(resized)
+    return np.stack(img_in)
+
+
+def synthetic_yolo_output(batch_size, num_boxes, num_classes, seed=0):
+    """Boxes clustered around a few objects per image, like a real YOLO output before NMS"""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0.1, 0.9, size=(batch_size, 8, 2))
+    picked = centers[np.arange(batch_size)[:, None], rng.randint(0, 8, size=(batch_size, num_boxes))]
+    xy = picked + rng.normal(0, 0.02, size=(batch_size, num_boxes, 2))
+    wh = rng.uniform(0.02, 0.2, size=(batch_size, num_boxes, 2))
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], axis=2).astype(np.float32)[:, :, None, :]
+    confs = rng.beta(0.3, 10, size=(batch_size, num_boxes, num_classes)).astype(np.float32)
+    # Ties in confidence make NMS implementations legitimately keep different boxes. Avoid them.
+    _, first_idx = np.unique(confs, return_index=True)
+    duplicated = np.ones(confs.size, dtype=bool)
+    duplicated[first_idx] = False
+    confs.reshape(-1)[duplicated] = rng.uniform(0, 1e-3, size=duplicated.sum())
+    return [boxes, confs]
+
+
+def timeit(fn, repeat):
+    fn()  # warm-up
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started_at) / repeat
+
+
+def bench_post_processing(opt):
+    names = [f'class{i}' for i in range(opt.num_classes)]
+    output = synthetic_yolo_output(opt.batch_size, opt.num_boxes, opt.num_classes)
+    size = 640
+
+    expected = reference_post_processing(output, size, size, opt.det_threshold, opt.nms_threshold, names)
+    actual = [detections_as_tuples(d, names) for d in post_processing(output, size, size, opt.det_threshold, opt.nms_threshold)]
+    for e, a in zip(expected, actual):
+        assert [(n, round(c, 5)) for n, c, _ in e] == [(n, round(c, 5)) for n, c, _ in a], 'post_processing differs from the reference'
+        assert np.allclose([b for _, _, b in e], [b for _, _, b in a], atol=1e-3), 'post_processing differs from the reference'
+
+    ref_secs = timeit(lambda: reference_post_processing(output, size, size, opt.det_threshold, opt.nms_threshold, names), opt.repeat)
+    new_secs = timeit(lambda: [detections_as_tuples(d, names) for d in post_processing(output, size, size, opt.det_threshold, opt.nms_threshold)], opt.repeat)
+
+    print(f'post_processing: batch_size={opt.batch_size} num_boxes={opt.num_boxes} num_classes={opt.num_classes} '
+          f'detections={sum(len(d) for d in actual)}')
+    print(f'  reference:  {ref_secs * 1000:.3f} ms')
+    print(f'  vectorized: {new_secs * 1000:.3f} ms ({ref_secs / new_secs:.1f}x)')
+
+
+def bench_preprocessing(opt):
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, size=(opt.image_height, opt.image_width, 3), dtype=np.uint8) for _ in range(opt.batch_size)]
+    preprocess = Preprocessor(opt.input_size, opt.input_size, opt.batch_size)
+
+    assert np.allclose(reference_preprocess(images, opt.input_size, opt.input_size), preprocess(images), atol=1e-6), 'preprocessing differs from the reference'
+
+    ref_secs = timeit(lambda: reference_preprocess(images, opt.input_size, opt.input_size), opt.repeat)
+    new_secs = timeit(lambda: preprocess(images), opt.repeat)
+
+    print(f'preprocessing: batch_size={opt.batch_size} image={opt.image_width}x{opt.image_height} input={opt.input_size}x{opt.input_size}')
+    print(f'  reference:     {ref_secs * 1000:.3f} ms')
+    print(f'  preallocated:  {new_secs * 1000:.3f} ms ({ref_secs / new_secs:.1f}x)')
+
+
+BENCHMARKS = {
+    'post_processing': bench_post_processing,
+    'preprocessing': bench_preprocessing,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys(), help="Benchmark to run")
+    parser.add_argument("--batch-size", type=int, default=1, help="Number of images in a batch")
+    parser.add_argument("--num-boxes", type=int, default=845, help="Number of boxes the net outputs per image. 845 = 13 x 13 x 5 for the 416 x 416 model")
+    parser.add_argument("--num-classes", type=int, default=1, help="Number of classes")
+    parser.add_argument("--det-threshold", type=float, default=0.08, help="Detection threshold")
+    parser.add_argument("--nms-threshold", type=float, default=0.45, help="NMS threshold")
+    parser.add_argument("--image-width", type=int, default=1280, help="Width of the source images")
+    parser.add_argument("--image-height", type=int, default=960, help="Height of the source images")
+    parser.add_argument("--input-size", type=int, default=416, help="Width and height of the net input")
+    parser.add_argument("--repeat", type=int, default=50, help="Number of timed runs")
+    opt = parser.parse_args()
+
+    BENCHMARKS[opt.benchmark](opt)
@@ -0,0 +1,77 @@
+#!python3
+# Makes the quantized variants of model-weights.onnx that load_net picks up when they are in the model dir.
+# Needs the `onnx` package on top of onnxruntime. Check the result with compare_models.py before deploying it.
+#
+#   python quantize.py int8 --calibration-images path/to/print/snapshots/
+#   python quantize.py fp16
+import argparse
+import os
+import cv2
+
+from detect import KNOWN_IMAGE_EXTENSIONS
+from lib.preprocess import Preprocessor
+
+
+class ImageCalibrationReader:
+    """Feeds images, preprocessed the way OnnxNet does it, to the static quantization calibration"""
+
+    def __init__(self, image_dir: str, input_name: str, input_w: int, input_h: int, limit: int):
+        self.paths = sorted(
+            os.path.join(image_dir, f) for f in os.listdir(image_dir) if os.path.splitext(f)[1] in KNOWN_IMAGE_EXTENSIONS
+        )[:limit]
+        self.input_name = input_name
+        self.preprocess = Preprocessor(input_w, input_h)
+
+    def get_next(self):
+        while self.paths:
+            image = cv2.imread(self.paths.pop(0))
+            if image is not None:
+                # Copied, as the preprocessor reuses its buffer for the next image
+                return {self.input_name: self.preprocess([image]).copy()}
+        return None
+
+
+def quantize_int8(opt):
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantFormat, QuantType
+    import onnx
+
+    if not opt.calibration_images:
+        quantize_dynamic(opt.weights, opt.output, weight_type=QuantType.QUInt8)
+        return
+
+    model_input = onnx.load(opt.weights, load_external_data=False).graph.input[0]
+    _, _, input_h, input_w = [d.dim_value for d in model_input.type.tensor_type.shape.dim]
+    reader = ImageCalibrationReader(opt.calibration_images, model_input.name, input_w, input_h, opt.calibration_limit)
+    quantize_static(
+        opt.weights, opt.output, reader,
+        quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+
+
+def quantize_fp16(opt):
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+    import onnx
+
+    # Inputs and outputs stay float32, so that OnnxNet feeds and reads the model the same way
+    model = convert_float_to_float16(onnx.load(opt.weights), keep_io_types=True)
+    onnx.save(model, opt.output)
+
+
+QUANTIZATIONS = {
+    'int8': quantize_int8,
+    'fp16': quantize_fp16,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("quantization", choices=QUANTIZATIONS.keys(), help="int8 for CPU, fp16 for GPU")
+    parser.add_argument("--weights", type=str, default="model/model-weights.onnx", help="Full precision ONNX model")
+    parser.add_argument("--output", type=str, help="Quantized model. Defaults to model/model-weights.<quantization>.onnx")
+    parser.add_argument("--calibration-images", type=str, help="Directory of representative images. int8 only. Static quantization with them, dynamic without")
+    parser.add_argument("--calibration-limit", type=int, default=200, help="Max number of calibration images to use")
+    opt = parser.parse_args()
+
+    if not opt.output:
+        opt.output = os.path.join(os.path.dirname(opt.weights), f'model-weights.{opt.quantization}.onnx')
+
+    QUANTIZATIONS[opt.quantization](opt)
+    print(f'Saved {opt.quantization} model to {opt.output}')
@@ -2,6 +2,7 @@
 
 import flask
 from flask import request, jsonify
+import math
 from os import path, environ
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
@@ -10,10 +11,81 @@ import numpy as np
 import requests
 
 from auth import token_required
-from lib.detection_model import load_net, detect
+from lib.detection_model import load_net, detect_batch, crop_to_roi, to_full_frame
+from lib.batcher import MicroBatcher
+from lib.worker_pool import WorkerPool, available_cpus
 
 THRESH = 0.08  # The threshold for a box to be considered a positive detection
 SESSION_TTL_SECONDS = 60*2
+MAX_BATCH_SIZE = int(environ.get('ML_API_MAX_BATCH_SIZE', 8))  # Max number of images in one inference run
+BATCH_WAIT_MS = float(environ.get('ML_API_BATCH_WAIT_MS', 0))  # How long a batch waits for more images before it runs. 0 = never wait
+NUM_WORKERS = environ.get('ML_API_WORKERS', '0')  # Number of inference worker processes. 'auto' = one per ML_API_CORES_PER_WORKER cores. 0 = run the net in the server process
+CORES_PER_WORKER = int(environ.get('ML_API_CORES_PER_WORKER', 1))
+RESULT_TIMEOUT_SECS = 60
+MAX_INPUT_SIZE = 1024  # The input buffers of the net grow with the square of it
+
+model_dir = path.join(path.dirname(path.realpath(__file__)), 'model')
+
+
+def load_main_net():
+    return load_net(path.join(model_dir, 'model.cfg'), path.join(model_dir, 'model.meta'))
+
+
+def decode_img(img_bytes):
+    # Always 8-bit BGR, whatever the format of the image, e.g. PNGs with alpha or 16-bit PNGs
+    img = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:  # A bad image must not get into a batch, otherwise it fails the whole batch
+        raise ValueError('Can not decode image')
+    return img
+
+
+def raw_frames(body, shape):
+    '''The body as n frames of h x w BGR pixels, shape being "n,h,w"'''
+    frame_num, height, width = (int(v) for v in shape.split(','))
+    return np.frombuffer(body, dtype=np.uint8).reshape(frame_num, height, width, 3)
+
+
+def prepare_img(payload):
+    img, options = payload
+    if not isinstance(img, np.ndarray):  # Raw frames are ready to go as they are
+        img = decode_img(img)
+    img, offset = crop_to_roi(img, options.get('roi'))
+    return img, offset, options.get('input_size')
+
+
+def detect_imgs(net, prepared):
+    # Images to be run at different input sizes can't be in the same run of the net
+    detections = [None] * len(prepared)
+    for input_size in set(input_size for _, _, input_size in prepared):
+        indexes = [i for i, (_, _, size) in enumerate(prepared) if size == input_size]
+        results = detect_batch(net, [prepared[i][0] for i in indexes], thresh=THRESH, input_size=input_size)
+        for i, dets in zip(indexes, results):
+            detections[i] = to_full_frame(dets, prepared[i][1])
+    return detections
+
+
+if NUM_WORKERS == 'auto':
+    NUM_WORKERS = max(1, len(available_cpus()) // CORES_PER_WORKER)
+NUM_WORKERS = int(NUM_WORKERS)
+
+if NUM_WORKERS > 0:
+    # Forked before anything else starts a thread. The workers load the net and decode the images, so that this process only does I/O.
+    net_main = None
+    pool = WorkerPool(
+        load_main_net,
+        prepare_img,
+        detect_imgs,
+        num_workers=NUM_WORKERS,
+        cores_per_worker=CORES_PER_WORKER,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=BATCH_WAIT_MS)
+    submit_img = pool.submit
+else:
+    pool = None
+    net_main = load_main_net()
+    # All inferences go through the batcher so that concurrent requests are grouped into one run of the net
+    batcher = MicroBatcher(lambda prepared: detect_imgs(net_main, prepared), max_batch_size=MAX_BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS)
+    submit_img = lambda payload: batcher.submit(prepare_img(payload))
 
 # Sentry
 if environ.get('SENTRY_DSN'):
@@ -29,19 +101,42 @@ status = dict()
 # SECURITY WARNING: don't run with debug turned on in production!
 app.config['DEBUG'] = environ.get('DEBUG') == 'True'
 
-model_dir = path.join(path.dirname(path.realpath(__file__)), 'model')
-net_main = load_net(path.join(model_dir, 'model.cfg'), path.join(model_dir, 'model.meta'))
+
+def fetch_img(img_url):
+    resp = requests.get(img_url, stream=True, timeout=(0.1, 5))
+    resp.raise_for_status()
+    return resp.content
+
+
+def detection_options():
+    '''
+    Optional query params of the detection endpoints:
+      roi=x1,y1,x2,y2: only detect in this region of the image, given in fractions of the image width and height.
+          The boxes are still in the coordinates of the full image.
+      input_size=N: run the net at N x N instead of its default input size. Ignored by models with a fixed input size.
+    Aborts the request with a 400 on bad values.
+    '''
+    roi = request.args.get('roi')
+    input_size = request.args.get('input_size')
+    try:
+        roi = tuple(float(v) for v in roi.split(',')) if roi else None
+        input_size = int(input_size) if input_size else None
+    except ValueError:
+        flask.abort(400, 'roi and input_size must be numbers')
+    if roi is not None and (len(roi) != 4 or not all(math.isfinite(v) for v in roi)):
+        flask.abort(400, 'roi must be x1,y1,x2,y2')
+    if input_size is not None and not 0 < input_size <= MAX_INPUT_SIZE:
+        flask.abort(400, f'input_size must be between 1 and {MAX_INPUT_SIZE}')
+    return dict(roi=roi, input_size=input_size)
+
 
 @app.route('/p/', methods=['GET'])
 @token_required
 def get_p():
+    options = detection_options()
     if 'img' in request.args:
         try:
-            resp = requests.get(request.args['img'], stream=True, timeout=(0.1, 5))
-            resp.raise_for_status()
-            img_array = np.array(bytearray(resp.content), dtype=np.uint8)
-            img = cv2.imdecode(img_array, -1)
-            detections = detect(net_main, img, thresh=THRESH)
+            detections = submit_img((fetch_img(request.args['img']), options)).result(timeout=RESULT_TIMEOUT_SECS)
             return jsonify({'detections': detections})
         except:
             sentry_sdk.capture_exception()
@@ -51,9 +146,89 @@ def get_p():
     # todo, not a correct way to report an error if exception
     return jsonify({'detections': []})
 
+@app.route('/p/', methods=['POST'])
+@token_required
+def post_p():
+    '''
+    Same as GET /p/, but the image comes in the request, either as the raw request body (image/jpeg, image/png)
+    or as the first file of a multipart form. It saves the round trip of fetching the image from a url.
+    '''
+    options = detection_options()
+    try:
+        if request.files:
+            img_bytes = next(iter(request.files.values())).read()
+        else:
+            img_bytes = request.get_data()
+        detections = submit_img((img_bytes, options)).result(timeout=RESULT_TIMEOUT_SECS)
+        return jsonify({'detections': detections})
+    except:
+        sentry_sdk.capture_exception()
+
+    # todo, not a correct way to report an error if exception
+    return jsonify({'detections': []})
+
+@app.route('/p/batch/', methods=['POST'])
+@token_required
+def post_p_batch():
+    '''
+    Accepts either a JSON body {"img": [url1, url2, ...]}, or multipart files (one image per file),
+    or raw frames as an application/octet-stream body of n x h x w x 3 BGR bytes, with a shape=n,h,w query param.
+    Returns {"detections": [detections_of_img1, detections_of_img2, ...]} in the same order.
+    An image that fails to be fetched or decoded gets an empty detection list. A malformed JSON body gets a 400.
+    '''
+    options = detection_options()
+    futures = []
+    if request.files:
+        for f in request.files.values():
+            try:
+                futures.append(submit_img((f.read(), options)))
+            except:
+                sentry_sdk.capture_exception()
+                futures.append(None)
+    elif request.content_type == 'application/octet-stream' and 'shape' in request.args:
+        try:
+            frames = raw_frames(request.get_data(), request.args['shape'])
+            futures = [submit_img((frame, options)) for frame in frames]
+        except:
+            sentry_sdk.capture_exception()
+    elif request.is_json:
+        body = request.get_json()
+        if not isinstance(body, dict) or not isinstance(body.get('img'), list):
+            flask.abort(400, 'The JSON body must be {"img": [url1, url2, ...]}')
+        for img_url in body['img']:
+            try:
+                futures.append(submit_img((fetch_img(img_url), options)))
+            except:
+                sentry_sdk.capture_exception()
+                futures.append(None)
+    else:
+        app.logger.warn("Invalid request body for batch detection")
+
+    detections = []
+    for future in futures:
+        try:
+            detections.append(future.result(timeout=RESULT_TIMEOUT_SECS) if future else [])
+        except:
+            sentry_sdk.capture_exception()
+            detections.append([])
+
+    return jsonify({'detections': detections})
+
 @app.route('/hc/', methods=['GET'])
 def health_check():
-    return 'ok' if net_main is not None else 'error'
+    return 'ok' if net_main is not None or (pool and pool.ready()) else 'error'
+
+@app.route('/hc/workers/', methods=['GET'])
+def workers_health_check():
+    '''
+    Readiness of the server, with the state of every inference worker when it runs with ML_API_WORKERS.
+    503 until at least one worker has loaded the net.
+    '''
+    if pool is None:
+        return jsonify({'ready': net_main is not None, 'workers': []}), 200 if net_main is not None else 503
+
+    ready = pool.ready()
+    return jsonify({'ready': ready, 'workers': pool.status()}), 200 if ready else 503
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=3333, threaded=False)
+    app.run(host='0.0.0.0', port=3333, threaded=True)